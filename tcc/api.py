@@ -1,25 +1,52 @@
+import random
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import EmptyResultSet, ObjectDoesNotExist
+from django.core.paginator import Paginator, Page
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.http import int_to_base36
 
-from tcc.models import Comment
+from tcc.cache import invalidate
+from tcc.instrument import instrumented
+from tcc import paths
+from tcc.markup import get_markup
+from tcc.models import (
+    NEXT_PATH_COLUMN, PATH_COLUMN, Comment, CommentRowSet, Thread,
+    attach_enabled_users, path_range, path_range_sql, reserves_ids,
+    update_rows)
+from tcc.settings import (
+    BULK_CHUNK_SIZE, MAX_DEPTH, MAX_REPLIES, PER_PAGE, REPLY_LIMIT)
+from tcc.tree import iter_nodes, iter_tree
 
 SITE_ID = getattr(settings, 'SITE_ID', 1)
+# the most comments a thread can hold (see Comment.reply_allowed)
+MAX_THREAD_SIZE = sum(MAX_REPLIES ** level for level in range(MAX_DEPTH))
+# path ranges OR-ed together in one statement (SQLite allows 999 params)
+RANGES_PER_QUERY = 100
+# rows per INSERT where the INSERT hands out the ids (one parameter per
+# column, SQLite allows 999)
+ROWS_PER_INSERT = 999 // len(Comment._meta.fields)
 
 
+@instrumented('api.make_tree')
 def make_tree(comments):
     """ Makes a python tree-structure with nested lists of objects
 
     Loops the queryset
 
-    Large threads will consume quite a bit of memory
+    Large threads will consume quite a bit of memory; see
+    iter_comments_tree for a streaming alternative
     """
     root = []
     levels = []
     for c in comments:
         c.replies = []
         level = c.depth
-        if c.parent:
+        if c.parent_id:
             while len(levels) > level:
                 levels.pop() # pragma: no cover
             levels.append(c)
@@ -50,12 +77,32 @@ def get_comments_limited(content_type_id, object_pk, site_id=SITE_ID):
                                   ).select_related('user', 'userprofile')
 
 
+def get_comment_rows(content_type_id, object_pk, site_id=SITE_ID,
+                     limited=False):
+    """ get_comments (or get_comments_limited) as light CommentRow objects
+
+    For rendering lists: only the fields the templates use are read and
+    no model instances are created.
+    """
+    manager = limited and Comment.limited or Comment.objects
+    return CommentRowSet(manager.filter(content_type__id=content_type_id,
+                                        object_pk=object_pk,
+                                        site__id=site_id))
+
+
 def get_comments_as_tree(content_type_id, object_pk, site_id=SITE_ID):
     return make_tree(get_comments(content_type_id=content_type_id,
                                   object_pk=object_pk,
                                   site_id=site_id))
 
 
+def iter_comments_tree(content_type_id, object_pk, site_id=SITE_ID):
+    """ Streams the comments as (event, node) pairs, see tcc.tree """
+    return iter_tree(iter_nodes(
+            Comment.objects.filter(content_type__id=content_type_id,
+                                   object_pk=object_pk, site__id=site_id)))
+
+
 def get_comments_limited_as_tree(content_type_id, object_pk, site_id=SITE_ID):
     return make_tree( # pragma: no cover
         get_comments_limited(content_type_id=content_type_id,
@@ -63,6 +110,126 @@ def get_comments_limited_as_tree(content_type_id, object_pk, site_id=SITE_ID):
                              site_id=site_id))
 
 
+class ThreadPaginator(Paginator):
+    """ Paginates the comments of an object by thread
+
+    Counts and slices root comments (most recently active thread
+    first); a page holds those roots with their limited replies (see
+    get_threads). Can be handed to {% autopaginate %} as is.
+
+    count and first_page (the comments of page 1) may be known already,
+    see get_comments_for_objects.
+    """
+    def __init__(self, content_type_id, object_pk, per_page=PER_PAGE,
+                 site_id=SITE_ID, reply_limit=REPLY_LIMIT, count=None,
+                 first_page=None):
+        self.lookup = dict(content_type__id=content_type_id,
+                           object_pk=object_pk, site__id=site_id)
+        # an index range read on (content_type, object_pk, site, depth,
+        # thread_activity, path), see sql/comment.*.sql; depth=0 rather
+        # than parent__isnull, which joins the parent
+        roots = Comment.objects.filter(depth=0, **self.lookup).order_by(
+            '-thread_activity', '-path')
+        self.reply_limit = reply_limit
+        super(ThreadPaginator, self).__init__(roots, per_page)
+        if count is not None:
+            self._count = count
+        self.first_page = first_page
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if number == 1 and self.first_page is not None:
+            return Page(self.first_page, number, self)
+        bottom = (number - 1) * self.per_page
+        roots = self.object_list[bottom:bottom + self.per_page]
+        return Page(get_threads(roots, self.reply_limit, self.lookup),
+                    number, self)
+
+
+def has_window_functions():
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return False
+
+
+@instrumented('api.get_threads')
+def get_threads(roots, reply_limit=REPLY_LIMIT, lookup=None):
+    """ Returns the roots and their reply_limit most recent replies
+
+    roots is a (sliced) queryset of root comments, or a list of their
+    paths. The paths are read first, then the whole page with one query;
+    every level is limited on its own, like Comment.limited does. lookup
+    (filter kwargs, e.g. the object of the roots) narrows down the
+    comments that are matched against the roots.
+
+    Threads come in the order of roots, replies in path order.
+    """
+    if isinstance(roots, QuerySet):
+        roots = roots.values_list('path', flat=True)
+    root_paths = list(roots)
+    if not root_paths:
+        return []
+    if has_window_functions():
+        comments = _get_threads_window(root_paths, reply_limit, lookup)
+    else:
+        comments = _get_threads_limited(root_paths, lookup)
+    position = dict((path, i) for i, path in enumerate(root_paths))
+    # stable: path order within a thread
+    comments.sort(key=lambda c: position[c.get_root_path()])
+    return comments
+
+
+def _in_roots(root_paths):
+    """ (sql, params) matching the comments below root_paths """
+    column = '%s.%s' % (connection.ops.quote_name(Comment._meta.db_table),
+                        PATH_COLUMN)
+    return "%s IN (%s)" % (paths.codec.root_sql(column),
+                           ", ".join(["%s"] * len(root_paths))), root_paths
+
+
+def _get_threads_window(root_paths, reply_limit, lookup=None):
+    """ Comments below root_paths, reply_limit replies per parent, in path
+    order """
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    where, params = _in_roots(root_paths)
+    try:
+        sql, params = Comment.objects.filter(**lookup or {}).extra(
+            select={'rn': 'ROW_NUMBER() OVER (PARTITION BY %s.parent_id '
+                    'ORDER BY %s.submit_date DESC)' % (table, table)},
+            where=[where], params=params).order_by().query.sql_with_params()
+    except EmptyResultSet:
+        # nothing can match, e.g. no TCC_CONTENT_TYPES
+        return []
+    comments = list(Comment.unfiltered.raw(
+            "SELECT * FROM (%s) t WHERE t.parent_id IS NULL OR t.rn <= %%s "
+            "ORDER BY t.%s" % (sql, PATH_COLUMN),
+            list(params) + [reply_limit]))
+    _attach_users(comments)
+    return comments
+
+
+def _attach_users(comments):
+    """ raw() cannot select_related; one query for the users of all
+    comments """
+    users = User.objects.in_bulk(set(c.user_id for c in comments))
+    for c in comments:
+        c._user_cache = users[c.user_id]
+
+
+def _get_threads_limited(root_paths, lookup=None):
+    """ Fallback for databases without window functions
+
+    Relies on the denormalized limit of the parent instead
+    """
+    where, params = _in_roots(root_paths)
+    return list(Comment.limited.select_related('user').filter(
+            **lookup or {}).extra(where=[where], params=params).order_by(
+            'path'))
+
+
 def get_comments_removed(content_type_id, object_pk, site_id=SITE_ID):
     return Comment.removed.select_related('user').filter(
         content_type__id=content_type_id, object_pk=object_pk, site__id=site_id)
@@ -73,19 +240,24 @@ def get_comments_disapproved(content_type_id, object_pk, site_id=SITE_ID):
         content_type__id=content_type_id, object_pk=object_pk, site__id=site_id)
 
 
+@instrumented('api.post_comment')
 def post_comment(content_type_id, object_pk,
                  user_id, comment, parent_id=None, site_id=SITE_ID):
+    parent = None
     if parent_id:
         parent = get_comment(parent_id)
         if (not parent) or (not parent.is_open):
             return None
+    # pass the parent along so the model does not have to fetch it again
     c = Comment(
         content_type_id=content_type_id, object_pk=object_pk, site_id=site_id,
-        user_id=user_id, comment=comment, parent_id=parent_id)
+        user_id=user_id, comment=comment, parent=parent)
     c.save()
+    invalidate(c)
     return c
 
 
+@instrumented('api.post_reply')
 def post_reply(parent_id, user_id, comment):
     """ Shortcut for post_comment if there is a parent_id """
     parent = get_comment(parent_id)
@@ -94,11 +266,218 @@ def post_reply(parent_id, user_id, comment):
     c = Comment(
         content_type_id=parent.content_type_id, object_pk=parent.object_pk,
         site_id=parent.site_id, user_id=user_id, comment=comment,
-        parent_id=parent_id)
+        parent=parent)
     c.save()
+    invalidate(c)
     return c
 
 
+@instrumented('api.bulk_post_comments')
+def bulk_post_comments(comments, chunk_size=BULK_CHUNK_SIZE, site_id=SITE_ID,
+                       keys=None):
+    """ Inserts many comments at once, e.g. for imports
+
+    ``comments`` is an iterable of dicts with Comment fields
+    (content_type_id, object_pk, user_id, comment, submit_date, ...). A
+    reply refers to its parent either with ``parent_id`` (an existing
+    comment) or with ``parent_key``: the ``key`` of an earlier dict in
+    the same iterable. Parents have to come before their replies.
+
+    The iterable is consumed in chunks of chunk_size, each written in one
+    transaction: a bulk_create, then childcount and limit of the parents,
+    thread_activity of the threads and the Thread counters of the
+    objects in the chunk. Paths, depths and visibility are assigned in
+    memory; where the INSERT hands out the ids (see models.reserves_ids)
+    the paths follow with models.update_rows. A reply beyond MAX_DEPTH
+    or beyond the MAX_REPLIES of its parent raises ValueError. Only the
+    ids of keyed comments that can still get replies are kept from one
+    chunk to the next, in keys: a dict unless another mapping is given
+    (e.g. a shelve, for string keys, to keep a very large import on
+    disk).
+
+    Returns the number of comments inserted.
+    """
+    if keys is None:
+        keys = {}
+    count = 0
+    chunk = []
+    for data in comments:
+        chunk.append(data)
+        if len(chunk) == chunk_size:
+            count += _bulk_insert(chunk, keys, site_id)
+            chunk = []
+    if chunk:
+        count += _bulk_insert(chunk, keys, site_id)
+    return count
+
+
+def _path_ranges_sql(paths):
+    """ (sql, params) matching paths and everything below them """
+    ranges = [path_range_sql(path) for path in paths]
+    return (" OR ".join("(%s)" % where for where, params in ranges),
+            sum((params for where, params in ranges), []))
+
+
+def _update_activity(root_paths):
+    root_paths = sorted(root_paths)
+    for i in range(0, len(root_paths), RANGES_PER_QUERY):
+        Comment.update_activity(
+            *_path_ranges_sql(root_paths[i:i+RANGES_PER_QUERY]))
+
+
+def _update_counters(parent_ids):
+    parent_ids = list(parent_ids)
+    for i in range(0, len(parent_ids), RANGES_PER_QUERY):
+        ids = parent_ids[i:i+RANGES_PER_QUERY]
+        Comment.update_counters(
+            "id IN (%s)" % ", ".join(["%s"] * len(ids)), ids)
+
+
+def _bulk_insert(chunk, keys, site_id):
+    # the parents from earlier chunks (or outside the import)
+    existing = set()
+    for data in chunk:
+        if data.get('parent_key') is not None:
+            if data['parent_key'] in keys:
+                existing.add(keys[data['parent_key']])
+        elif data.get('parent_id'):
+            existing.add(data['parent_id'])
+    rows = list(Comment.unfiltered.filter(id__in=existing).values_list(
+            'id', 'path', 'is_visible', 'childcount'))
+    parents = dict((row[0], row[1:3]) for row in rows)
+    childcounts = dict((row[0], row[3]) for row in rows)
+    # the parents from this chunk, and the keys of those that cannot be one
+    keyed = {}
+    leaves = set()
+    comments = []
+    for data in chunk:
+        data = dict(data)
+        key = data.pop('key', None)
+        parent_key = data.pop('parent_key', None)
+        parent_id = data.pop('parent_id', None)
+        parent = None
+        if parent_key is not None:
+            if parent_key in keyed:
+                parent = keyed[parent_key]
+            elif parent_key in leaves:
+                raise ValueError("parent_key %r is at MAX_DEPTH - 1 and "
+                                 "cannot get replies" % (parent_key,))
+            elif keys.get(parent_key) in parents:
+                parent_id = keys[parent_key]
+            else:
+                # the keys of comments at MAX_DEPTH - 1 are not kept from
+                # one chunk to the next
+                raise ValueError("Unknown parent_key %r (or one at "
+                                 "MAX_DEPTH - 1 in an earlier chunk)" % (
+                        parent_key,))
+        elif parent_id and parent_id not in parents:
+            raise ValueError("Unknown parent_id %r" % (parent_id,))
+        data.setdefault('site_id', site_id)
+        c = Comment(parent_id=parent_id, **data)
+        c.render_comment()
+        if parent is not None:
+            c._bulk_parent = parent
+            c.depth = parent.depth + 1
+            c.is_visible = c.is_counted() and parent.is_visible
+        elif parent_id:
+            parent_path, parent_visible = parents[parent_id]
+            c.depth = paths.codec.depth(parent_path) + 1
+            c.is_visible = c.is_counted() and parent_visible
+        else:
+            c.depth = 0
+            c.is_visible = c.is_counted()
+            c.thread_activity = c.submit_date
+        if c.depth > MAX_DEPTH - 1:
+            raise ValueError("Comment %r exceeds MAX_DEPTH" % (key,))
+        if c.depth and c.is_counted():
+            if parent is not None:
+                childcount = parent.childcount = parent.childcount + 1
+            else:
+                childcount = childcounts[parent_id] = \
+                    childcounts[parent_id] + 1
+            if childcount > MAX_REPLIES:
+                raise ValueError("Comment %r exceeds MAX_REPLIES" % (key,))
+        if key is not None:
+            if c.depth < MAX_DEPTH - 1:
+                keyed[key] = c
+            else:
+                leaves.add(key)
+        comments.append(c)
+    with transaction.commit_on_success():
+        if reserves_ids():
+            for c, comment_id in zip(comments,
+                                     Comment._reserve_ids(len(comments))):
+                c.id = comment_id
+            _make_paths(comments, parents)
+            Comment.unfiltered.bulk_create(comments)
+        else:
+            # the INSERT hands out the ids: the comments go in under
+            # placeholder paths (no encoding starts with '~', see
+            # set_paths), are read back by those and get their parents
+            # from this chunk and their paths with update_rows
+            prefix = _placeholder_prefix(len(comments))
+            width = len(int_to_base36(len(comments)))
+            for i, c in enumerate(comments):
+                c.path = prefix + int_to_base36(i).zfill(width)
+            for i in range(0, len(comments), ROWS_PER_INSERT):
+                Comment.unfiltered.bulk_create(
+                    comments[i:i+ROWS_PER_INSERT])
+            ids = dict(Comment.unfiltered.filter(
+                    path__gte=prefix, path__lt=prefix + '~').values_list(
+                    'path', 'id'))
+            for c in comments:
+                c.id = ids[c.path]
+            _make_paths(comments, parents)
+            fields = ['parent_id', 'path']
+            if paths.next_codec:
+                fields.append('next_path')
+            update_rows([Comment._meta.get_field(f).column for f in fields],
+                        [(c.id,) + tuple(getattr(c, f) for f in fields)
+                         for c in comments])
+        for key, c in keyed.items():
+            keys[key] = c.id
+        _update_counters(set(c.parent_id for c in comments if c.parent_id))
+        _update_activity(set(c.get_root_path() for c in comments))
+        Thread.add_comments(comments)
+    # one bump per object and per thread in this chunk
+    invalidated = set()
+    for c in comments:
+        key = (c.content_type_id, c.object_pk, c.get_root_id())
+        if key not in invalidated:
+            invalidate(c)
+            invalidated.add(key)
+    return len(comments)
+
+
+def _make_paths(comments, parents):
+    """ Sets parent_id, path and next_path of comments that have their
+    ids; parents come before their replies """
+    for c in comments:
+        parent = getattr(c, '_bulk_parent', None)
+        if parent is not None:
+            c.parent_id = parent.id
+            c.path = c._make_path(parent.path)
+        elif c.parent_id:
+            c.path = c._make_path(parents[c.parent_id][0])
+        else:
+            c.path = c._make_path('')
+        c.next_path = paths.next_path(c.path)
+
+
+def _placeholder_prefix(n):
+    """ A random path prefix under which n comments can be parked
+
+    '~' and as many random base36 digits (up to 7) as the path column
+    leaves room for, next to the number of the comment.
+    """
+    room = Comment._meta.get_field('path').max_length - 1 - len(
+        int_to_base36(n))
+    digits = min(7, room)
+    return '~' + int_to_base36(
+        random.randrange(36 ** digits)).zfill(digits)
+
+
+@instrumented('api.get_comment')
 def get_comment(comment_id):
     try:
         return Comment.objects.select_related('user').get(id=comment_id)
@@ -115,7 +494,73 @@ def get_comment_thread(comment_id):
 def get_comment_replies(comment_id):
     c = get_comment(comment_id)
     if c:
-        return c.get_replies()
+        return c.get_replies().select_related('user')
+
+
+@instrumented('api.get_replies_for')
+def get_replies_for(parent_ids, limit_per_parent=None):
+    """ Returns {parent_id: [replies]} for many parents at once
+
+    Like get_comment_replies for each parent, but one query for the paths
+    of the parents and one for all their replies (OR-ed path ranges,
+    RANGES_PER_QUERY parents at a time). Replies are in path order; with
+    limit_per_parent only the limit_per_parent most recent replies of
+    every comment are read, every level on its own like get_threads does.
+    Parents that do not exist or are not visible are left out.
+    """
+    parent_paths = dict((path, parent_id) for parent_id, path in
+                        Comment.objects.filter(id__in=parent_ids).values_list(
+            'id', 'path'))
+    replies = dict((parent_id, []) for parent_id in parent_paths.values())
+    ordered = sorted(parent_paths)
+    for i in range(0, len(ordered), RANGES_PER_QUERY):
+        chunk = ordered[i:i+RANGES_PER_QUERY]
+        comments = _get_replies(chunk, limit_per_parent)
+        chunk = set(chunk)
+        for c in comments:
+            # every parent of this chunk above c (they may be nested; a
+            # parent of another chunk gets c from its own query)
+            for prefix in paths.codec.prefixes(c.path):
+                if prefix in chunk:
+                    replies[parent_paths[prefix]].append(c)
+    return replies
+
+
+def _get_replies(parent_paths, limit=None):
+    """ The comments in the path ranges of parent_paths, in path order;
+    the limit most recent replies per parent if limit is given
+
+    Without window functions the limit comes from Comment.limited, so it
+    is REPLY_LIMIT at most.
+    """
+    q = Q()
+    for path in parent_paths:
+        q |= Q(**path_range(path))
+    if limit is None:
+        return Comment.objects.select_related('user').filter(q).iterator()
+    if has_window_functions():
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        try:
+            sql, params = Comment.objects.filter(q).extra(
+                select={'rn': 'ROW_NUMBER() OVER (PARTITION BY %s.parent_id '
+                        'ORDER BY %s.submit_date DESC)' % (table, table)}
+                ).order_by().query.sql_with_params()
+        except EmptyResultSet:
+            return []
+        comments = list(Comment.unfiltered.raw(
+                "SELECT * FROM (%s) t WHERE t.rn <= %%s ORDER BY t.%s" % (
+                    sql, PATH_COLUMN), list(params) + [limit]))
+        _attach_users(comments)
+        return comments
+    comments = list(Comment.limited.select_related('user').filter(q))
+    if limit < REPLY_LIMIT:
+        recent = {}
+        for c in sorted(comments, key=lambda c: c.submit_date,
+                        reverse=True):
+            recent.setdefault(c.parent_id, []).append(c)
+        keep = set(c.id for group in recent.values() for c in group[:limit])
+        comments = [c for c in comments if c.id in keep]
+    return comments
 
 
 def get_comment_parents(comment_id):
@@ -124,6 +569,7 @@ def get_comment_parents(comment_id):
         return c.get_parents()
 
 
+@instrumented('api.remove_comment')
 def remove_comment(comment_id, user):
     """ mark comment as removed """
     c = get_comment(comment_id)
@@ -132,9 +578,11 @@ def remove_comment(comment_id, user):
             return None
         c.is_removed = True
         c.save()
+        invalidate(c)
     return c
 
 
+@instrumented('api.restore_comment')
 def restore_comment(comment_id, user):
     """ restore remove comment """
     try:
@@ -143,11 +591,13 @@ def restore_comment(comment_id, user):
             return None
         c.is_removed = False
         c.save()
+        invalidate(c)
         return c
     except Comment.DoesNotExist:
         return None
 
 
+@instrumented('api.disapprove_comment')
 def disapprove_comment(comment_id, user):
     """ disapprove comment """
     c = get_comment(comment_id)
@@ -156,9 +606,11 @@ def disapprove_comment(comment_id, user):
             return None
         c.is_approved = False
         c.save()
+        invalidate(c)
     return c
 
 
+@instrumented('api.approve_comment')
 def approve_comment(comment_id, user):
     """ approve comment """
     try:
@@ -167,11 +619,13 @@ def approve_comment(comment_id, user):
             return None
         c.is_approved = True
         c.save()
+        invalidate(c)
         return c
     except Comment.DoesNotExist:
         return None
 
 
+@instrumented('api.open_comment')
 def open_comment(comment_id, user):
     """ Mark comment 'open' (replies welcome) """
     c = get_comment(comment_id)
@@ -180,9 +634,11 @@ def open_comment(comment_id, user):
             return None
         c.is_open = True
         c.save()
+        invalidate(c)
     return c
 
 
+@instrumented('api.close_comment')
 def close_comment(comment_id, user):
     """ Mark a comment as closed (no more replies possible) """
     c = get_comment(comment_id)
@@ -191,9 +647,396 @@ def close_comment(comment_id, user):
             return None
         c.is_open = False
         c.save()
+        invalidate(c)
     return c
 
 
+def _bulk_moderate(comments, user, action, manager, **changes):
+    """ Sets changes on the comments user may apply action to
+
+    comments is a list of ids (looked up through manager) or a queryset.
+    Comments are loaded, permission checked and updated RANGES_PER_QUERY
+    at a time, with set-based UPDATEs: one for the comments, one for the
+    visibility of their subtrees (if removed or approved changed). The
+    counters of the parents, the thread activity and the Thread counters
+    are recomputed once at the end.
+
+    Returns the list of updated comments.
+    """
+    if isinstance(comments, QuerySet):
+        comments = comments.values_list('id', flat=True)
+    ids = list(comments)
+    flags = 'is_removed' in changes or 'is_approved' in changes
+    updated = []
+    with transaction.commit_on_success():
+        for i in range(0, len(ids), RANGES_PER_QUERY):
+            chunk = manager.filter(id__in=ids[i:i+RANGES_PER_QUERY]).exclude(
+                **changes)
+            chunk = [c for c in attach_enabled_users(chunk, action)
+                     if getattr(c, 'can_' + action)(user)]
+            if not chunk:
+                continue
+            Comment.unfiltered.filter(
+                id__in=[c.id for c in chunk]).update(**changes)
+            if flags:
+                Comment.update_visibility(
+                    *_path_ranges_sql(c.path for c in chunk))
+            for c in chunk:
+                for field, value in changes.items():
+                    setattr(c, field, value)
+                c._flags = c._get_flags()
+            updated.extend(chunk)
+        if flags and updated:
+            _update_counters(set(c.parent_id for c in updated
+                                 if c.parent_id))
+            _update_activity(set(c.get_root_path() for c in updated))
+            for content_type_id, object_pk, site_id in set(
+                (c.content_type_id, c.object_pk, c.site_id) for c in updated):
+                Thread.update_counts(content_type_id, object_pk, site_id)
+    invalidated = set()
+    for c in updated:
+        key = (c.content_type_id, c.object_pk, c.get_root_id())
+        if key not in invalidated:
+            invalidate(c)
+            invalidated.add(key)
+    return updated
+
+
+@instrumented('api.bulk_remove')
+def bulk_remove(comments, user):
+    """ remove_comment for many comments (ids or a queryset) at once """
+    return _bulk_moderate(comments, user, 'remove', Comment.objects,
+                          is_removed=True)
+
+
+@instrumented('api.bulk_restore')
+def bulk_restore(comments, user):
+    return _bulk_moderate(comments, user, 'restore', Comment.unfiltered,
+                          is_removed=False)
+
+
+@instrumented('api.bulk_approve')
+def bulk_approve(comments, user):
+    return _bulk_moderate(comments, user, 'approve', Comment.unfiltered,
+                          is_approved=True)
+
+
+@instrumented('api.bulk_disapprove')
+def bulk_disapprove(comments, user):
+    return _bulk_moderate(comments, user, 'disapprove', Comment.objects,
+                          is_approved=False)
+
+
+@instrumented('api.bulk_open')
+def bulk_open(comments, user):
+    return _bulk_moderate(comments, user, 'open', Comment.objects,
+                          is_open=True)
+
+
+@instrumented('api.bulk_close')
+def bulk_close(comments, user):
+    return _bulk_moderate(comments, user, 'close', Comment.objects,
+                          is_open=False)
+
+
+def _where_object(content_type_id=None, object_pk=None, site_id=None):
+    where = ["1 = 1"]
+    params = []
+    if content_type_id:
+        where.append("content_type_id = %s")
+        params.append(content_type_id)
+    if object_pk:
+        where.append("object_pk = %s")
+        params.append(object_pk)
+    if site_id:
+        where.append("site_id = %s")
+        params.append(site_id)
+    return " AND ".join(where), params
+
+
+def repair_counters(content_type_id=None, object_pk=None, site_id=None):
+    """ Recomputes childcount and limit in bulk, in one transaction
+
+    Restricted to the comments of one object (and/or site) if given.
+    Returns the number of comments changed.
+    """
+    with transaction.commit_on_success():
+        return Comment.update_counters(
+            *_where_object(content_type_id, object_pk, site_id))
+
+
+def repair_visibility(content_type_id=None, object_pk=None, site_id=None):
+    """ Recomputes is_visible in bulk, like repair_counters """
+    with transaction.commit_on_success():
+        return Comment.update_visibility(
+            *_where_object(content_type_id, object_pk, site_id))
+
+
+def repair_activity(content_type_id=None, object_pk=None, site_id=None):
+    """ Recomputes thread_activity in bulk, like repair_counters
+
+    Run it after repair_visibility, it only looks at visible comments.
+    """
+    with transaction.commit_on_success():
+        return Comment.update_activity(
+            *_where_object(content_type_id, object_pk, site_id))
+
+
+def rerender_comments(content_type_id=None, object_pk=None, site_id=None,
+                      chunk_size=BULK_CHUNK_SIZE):
+    """ Renders comment_raw into comment again, e.g. after TCC_MARKUP or
+    TCC_ALLOWED_TAGS changed
+
+    Reads chunk_size rows at a time (only the columns needed) and writes
+    only the comments whose HTML changed, one transaction per chunk.
+    Comments from before comment_raw was filled get their comment as
+    raw text. Returns the number of comments updated.
+    """
+    markup = get_markup()
+    where, params = _where_object(content_type_id, object_pk, site_id)
+    comments = Comment.unfiltered.extra(where=[where], params=params)
+    count = 0
+    last_id = 0
+    while True:
+        chunk = list(comments.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'comment_raw', 'comment', 'content_type', 'object_pk',
+                'path')[:chunk_size])
+        if not chunk:
+            return count
+        last_id = chunk[-1][0]
+        # one invalidation per object and thread
+        invalidated = {}
+        with transaction.commit_on_success():
+            for comment_id, raw, html, ct_id, pk, path in chunk:
+                new_html = markup(raw or html)
+                if new_html != html or (html and not raw):
+                    Comment.unfiltered.filter(id=comment_id).update(
+                        comment=new_html, comment_raw=raw or html)
+                    invalidated[(ct_id, pk, paths.codec.root(path))] = Comment(
+                        path=path, content_type_id=ct_id, object_pk=pk)
+                    count += 1
+        for c in invalidated.values():
+            invalidate(c)
+
+
+def repair_thread_counts(content_type_id=None, object_pk=None, site_id=None):
+    """ Recounts the Thread counters of every object with comments
+
+    Run it after repair_visibility. Returns the number of objects.
+    """
+    where, params = _where_object(content_type_id, object_pk, site_id)
+    objects = Comment.unfiltered.extra(where=[where], params=params).order_by(
+        ).values_list('content_type', 'object_pk', 'site').distinct()
+    count = 0
+    for content_type_id, object_pk, site_id in objects.iterator():
+        Thread.update_counts(content_type_id, object_pk, site_id)
+        count += 1
+    return count
+
+
+def convert_paths(source, target=None, chunk_size=RANGES_PER_QUERY):
+    """ Rewrites the paths from the encoding source to target (by default
+    the one in use), see tcc.paths
+
+    Switch TCC_PATH_ENCODING (and widen the path column to the new
+    max_length) first, then run this; until it is done the old paths are
+    not found. Comments are read chunk_size at a time, each chunk written
+    in one transaction; paths already in the target encoding are left
+    alone, so an interrupted run can simply be started again. Returns the
+    number of comments updated.
+    """
+    target = target or paths.codec
+    count = 0
+    last_id = 0
+    while True:
+        chunk = list(Comment.unfiltered.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'path')[:chunk_size])
+        if not chunk:
+            return count
+        last_id = chunk[-1][0]
+        with transaction.commit_on_success():
+            count += _convert_paths(dict(chunk), source, target)
+
+
+def _convert_paths(rows, source, target):
+    old = {}
+    new = {}
+    for comment_id, path in rows.items():
+        if not target.matches(path, comment_id):
+            old[comment_id] = path
+            new[comment_id] = target.convert(path, source)
+    return set_paths(new, old, source, target)
+
+
+def set_paths(new, old, source, target=None):
+    """ Writes the paths new ({id: path}) of the comments, which now have
+    the paths old
+
+    Comments holding one of the new paths are converted from source to
+    target along, or parked under a path no encoding produces ('~' and
+    the id) if that does not free it; clashing paths are parked before
+    they are taken, so the unique index never sees a duplicate. While a
+    re-path runs next_path follows (see tcc.paths.next_path). Returns
+    the number of comments updated.
+    """
+    target = target or paths.codec
+    while True:
+        holders = {}
+        values = new.values()
+        for i in range(0, len(values), RANGES_PER_QUERY):
+            holders.update(Comment.unfiltered.filter(
+                    path__in=values[i:i+RANGES_PER_QUERY]).exclude(
+                    id__in=new.keys()).values_list('id', 'path'))
+        if not holders:
+            break
+        taken = set(values)
+        for comment_id, path in holders.items():
+            old[comment_id] = path
+            try:
+                new[comment_id] = target.convert(path, source)
+            except ValueError:
+                new[comment_id] = path
+            if new[comment_id] in taken:
+                new[comment_id] = '~%d' % comment_id
+    if not new:
+        return 0
+    qn = connection.ops.quote_name
+    table = qn(Comment._meta.db_table)
+    # next_path is unique as well; a parked comment has none
+    columns = [PATH_COLUMN]
+    if paths.next_codec:
+        columns.append(NEXT_PATH_COLUMN)
+    cursor = connection.cursor()
+    clashes = set(old.values()) & set(new.values())
+    for comment_id, path in old.items():
+        if path in clashes:
+            cursor.execute("UPDATE %s SET %s WHERE id = %%s" % (
+                    table, ", ".join("%s = %%s" % qn(c) for c in columns)),
+                           ['~%d' % comment_id] + [None] * (len(columns) - 1)
+                           + [comment_id])
+    update_rows(columns, [
+            (comment_id, path) + (paths.next_path(path, target),) * (
+                len(columns) - 1) for comment_id, path in new.items()])
+    return len(new)
+
+
+def _objects_by_content_type(objects):
+    """ Returns {content_type_id: {object_pk: object}} """
+    pks = {}
+    for obj in objects:
+        ct = ContentType.objects.get_for_model(obj)
+        pks.setdefault(ct.id, {})[unicode(obj.pk)] = obj
+    return pks
+
+
+def _objects_q(pks):
+    q = Q()
+    for content_type_id, objs in pks.items():
+        q |= Q(content_type__id=content_type_id, object_pk__in=objs.keys())
+    return q
+
+
+@instrumented('api.get_comment_counts')
+def get_comment_counts(objects, site_id=SITE_ID):
+    """ Returns {object: Thread} for a list of objects, in one query
+
+    The Thread holds the denormalized comment_count, removed_count,
+    disapproved_count and last_comment_date. Objects without comments
+    get an unsaved Thread with zero counts.
+    """
+    pks = _objects_by_content_type(objects)
+    counts = {}
+    if not pks:
+        return counts
+    for thread in Thread.objects.filter(_objects_q(pks), site__id=site_id):
+        counts[pks[thread.content_type_id][thread.object_pk]] = thread
+    for content_type_id, objs in pks.items():
+        for object_pk, obj in objs.items():
+            if obj not in counts:
+                counts[obj] = Thread(content_type_id=content_type_id,
+                                     object_pk=object_pk, site_id=site_id)
+    return counts
+
+
+@instrumented('api.get_comments_for_objects')
+def get_comments_for_objects(objects, per_page=PER_PAGE, site_id=SITE_ID,
+                             reply_limit=REPLY_LIMIT):
+    """ Returns {object: ThreadPaginator} for a list of objects, each with
+    its first page loaded
+
+    For e.g. all objects of a feed page: one query for the roots on the
+    first page of every object (and their number), then their comments
+    through get_threads, RANGES_PER_QUERY threads at a time. Page 1 is
+    what ThreadPaginator(...).page(1) gives; other pages are read when
+    asked for.
+    """
+    pks = _objects_by_content_type(objects)
+    roots = {}
+    counts = {}
+    for content_type_id, objs in pks.items():
+        for object_pk in objs:
+            roots[(content_type_id, object_pk)] = []
+            counts[(content_type_id, object_pk)] = 0
+    if pks:
+        if has_window_functions():
+            rows = _first_roots_window(pks, per_page, site_id)
+        else:
+            rows = _first_roots(pks, per_page, site_id)
+        for content_type_id, object_pk, path, count in rows:
+            roots[(content_type_id, object_pk)].append(path)
+            counts[(content_type_id, object_pk)] = count
+    comments = dict((key, []) for key in roots)
+    root_paths = sum(roots.values(), [])
+    for i in range(0, len(root_paths), RANGES_PER_QUERY):
+        for c in get_threads(root_paths[i:i+RANGES_PER_QUERY], reply_limit,
+                             {'site__id': site_id}):
+            comments[(c.content_type_id, c.object_pk)].append(c)
+    paginators = {}
+    for (content_type_id, object_pk), page in comments.items():
+        paginators[pks[content_type_id][object_pk]] = ThreadPaginator(
+            content_type_id, object_pk, per_page, site_id, reply_limit,
+            count=counts[(content_type_id, object_pk)], first_page=page)
+    return paginators
+
+
+def _first_roots_window(pks, per_page, site_id):
+    """ (content_type_id, object_pk, path, number of roots) of the first
+    per_page roots of every object, in ThreadPaginator's order """
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    partition = "PARTITION BY %s.content_type_id, %s.object_pk" % (
+        table, table)
+    try:
+        sql, params = Comment.objects.filter(
+            _objects_q(pks), depth=0, site__id=site_id).extra(select={
+                'rn': 'ROW_NUMBER() OVER (%s ORDER BY %s.thread_activity '
+                'DESC, %s.%s DESC)' % (partition, table, table, PATH_COLUMN),
+                'total': 'COUNT(*) OVER (%s)' % partition}).values_list(
+            'content_type', 'object_pk', 'path', 'rn', 'total').order_by(
+            ).query.sql_with_params()
+    except EmptyResultSet:
+        # nothing can match, e.g. no TCC_CONTENT_TYPES
+        return []
+    cursor = connection.cursor()
+    cursor.execute("SELECT t.content_type_id, t.object_pk, t.%s, t.total "
+                   "FROM (%s) t WHERE t.rn <= %%s ORDER BY t.rn" % (
+            PATH_COLUMN, sql), list(params) + [per_page])
+    return cursor.fetchall()
+
+
+def _first_roots(pks, per_page, site_id):
+    """ _first_roots_window for databases without window functions: the
+    paths of all roots are read, the first per_page kept """
+    roots = {}
+    for content_type_id, object_pk, path in Comment.objects.filter(
+        _objects_q(pks), depth=0, site__id=site_id).order_by(
+        '-thread_activity', '-path').values_list(
+        'content_type', 'object_pk', 'path').iterator():
+        roots.setdefault((content_type_id, object_pk), []).append(path)
+    return [key + (path, len(object_roots))
+            for key, object_roots in roots.items()
+            for path in object_roots[:per_page]]
+
+
 def get_user_comments(user_id,
                       content_type_id=None, object_pk=None, site_id=None):
     """ Returns all (approved, unremoved) comments by user """
@@ -0,0 +1,283 @@
+""" Benchmarks for the hot paths of tcc
+
+These run against the configured database; use a scratch database.
+Timings are the best of ``repeat`` runs, in seconds. Query counts are
+those of a single run.
+
+run() builds synthetic workloads on one object, times the read, write
+and moderation paths on each and returns the results as a list of dicts
+(see the tcc_benchmark management command for JSON output):
+
+- wide: root comments only
+- deep: threads as deep as MAX_DEPTH allows
+- saturated: parents with more than REPLY_LIMIT replies each
+
+path_encodings() compares the path encodings of tcc.paths on one
+workload: path and index sizes and the path lookups.
+"""
+import timeit
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+
+from tcc import api
+from tcc import paths
+from tcc import views
+from tcc.models import PATH_COLUMN, Comment, Thread
+from tcc.settings import MAX_DEPTH, MAX_REPLIES, REPLY_LIMIT
+
+WORKLOADS = ('wide', 'deep', 'saturated')
+# replies per parent in the saturated workload
+SATURATED_REPLIES = min(REPLY_LIMIT * 3, MAX_REPLIES)
+
+
+def best_of(func, repeat=5, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def count_queries(func):
+    """ Runs func once, returns the number of queries it executed """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        func()
+        return len(connection.queries) - start
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+
+def measure(func, repeat=5):
+    return {'seconds': best_of(func, repeat), 'queries': count_queries(func)}
+
+
+def _render_fields(comments):
+    # roughly what comment.html reads
+    return [(c.id, c.get_base36(), c.comment, unicode(c.user), c.user.id,
+             c.submit_date, c.reply_allowed()) for c in comments]
+
+
+def read_path(content_type_id, object_pk):
+    """ {name: func} reading and 'rendering' all comments of an object
+
+    Compares full Comment instances (api.get_comments) with CommentRow
+    objects (api.get_comment_rows); part of operations().
+    """
+    def models():
+        _render_fields(api.get_comments(content_type_id, object_pk))
+
+    def rows():
+        _render_fields(api.get_comment_rows(content_type_id, object_pk))
+
+    return {'read_models': models, 'read_rows': rows}
+
+
+def _generate(workload, size, content_type_id, object_pk, user_id):
+    """ Yields the dicts for api.bulk_post_comments """
+    base = {'content_type_id': content_type_id, 'object_pk': object_pk,
+            'user_id': user_id}
+    if workload == 'wide':
+        for i in xrange(size):
+            yield dict(base, comment='Root %d' % i)
+    elif workload == 'deep':
+        for i in xrange(size):
+            depth = i % MAX_DEPTH
+            data = dict(base, comment='Level %d' % depth, key=i)
+            if depth:
+                data['parent_key'] = i - 1
+            yield data
+    elif workload == 'saturated':
+        for i in xrange(size):
+            data = dict(base, comment='Comment %d' % i)
+            root = i - i % (SATURATED_REPLIES + 1)
+            if i == root:
+                data['key'] = i
+            else:
+                data['parent_key'] = root
+            yield data
+    else:
+        raise ValueError("Unknown workload %r" % (workload,))
+
+
+def make_workload(workload, size, content_type_id, object_pk, user_id):
+    """ Replaces the comments of the object by size synthetic ones """
+    clear(content_type_id, object_pk)
+    api.bulk_post_comments(
+        _generate(workload, size, content_type_id, object_pk, user_id))
+
+
+def clear(content_type_id, object_pk):
+    """ Deletes the comments of the object, without loading them """
+    cursor = connection.cursor()
+    cursor.execute(
+        "DELETE FROM %s WHERE content_type_id = %%s AND object_pk = %%s" % (
+            connection.ops.quote_name(Comment._meta.db_table)),
+        [content_type_id, unicode(object_pk)])
+    Thread.objects.filter(content_type__id=content_type_id,
+                          object_pk=object_pk).delete()
+    transaction.commit_unless_managed()
+
+
+def operations(content_type_id, object_pk, user):
+    """ {name: func} of the operations timed on a workload """
+    comments = Comment.unfiltered.filter(
+        content_type__id=content_type_id, object_pk=object_pk)
+    root = comments.filter(depth=0).order_by('-id')[0]
+    parent = comments.order_by('-childcount', '-id')[0]
+    roots = list(comments.filter(depth=0).order_by('-id').values_list(
+            'id', flat=True)[:100])
+    request = RequestFactory().get('/')
+    request.user = AnonymousUser()
+
+    def post_comment():
+        api.post_comment(content_type_id=content_type_id,
+                         object_pk=object_pk, user_id=user.id,
+                         comment="Benchmark")
+
+    def post_reply():
+        api.post_reply(parent_id=root.id, user_id=user.id,
+                       comment="Benchmark")
+
+    def moderate():
+        api.remove_comment(root.id, user)
+        api.restore_comment(root.id, user)
+
+    def bulk_moderate():
+        api.bulk_remove(roots, user)
+        api.bulk_restore(roots, user)
+
+    funcs = read_path(content_type_id, object_pk)
+    funcs.update({
+        'post_comment': post_comment,
+        'post_reply': post_reply,
+        'set_limit': parent.set_limit,
+        'get_comments_limited': lambda: list(api.get_comments_limited(
+                content_type_id, object_pk)),
+        'make_tree': lambda: api.make_tree(api.get_comments(
+                content_type_id, object_pk)),
+        'views.index': lambda: views.index(
+            request, content_type_id, object_pk),
+        'views.thread': lambda: views.thread(request, root.id),
+        'moderate': moderate,
+        'bulk_moderate': bulk_moderate,
+        })
+    return funcs
+
+
+def run(content_type_id, object_pk, user, sizes=(1000,), workloads=WORKLOADS,
+        repeat=5, only=None):
+    """ Times every operation (or those in only) on every workload
+
+    The comments of the object are replaced; they are deleted at the
+    end. Returns a list of {workload, size, operation, seconds, queries}.
+    """
+    results = []
+    try:
+        for workload in workloads:
+            for size in sizes:
+                make_workload(workload, size, content_type_id, object_pk,
+                              user.id)
+                for name, func in sorted(operations(
+                        content_type_id, object_pk, user).items()):
+                    if only and name not in only:
+                        continue
+                    result = measure(func, repeat)
+                    result.update({'workload': workload, 'size': size,
+                                   'operation': name})
+                    results.append(result)
+    finally:
+        clear(content_type_id, object_pk)
+    return results
+
+
+def path_index_size():
+    """ Bytes taken by the indexes on path, None if the database does not
+    tell """
+    table = Comment._meta.db_table
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute(
+            "SELECT SUM(pg_relation_size(i.indexrelid)) FROM pg_index i "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid "
+            "AND a.attnum = i.indkey[0] "
+            "WHERE i.indrelid = %s::regclass AND a.attname = %s",
+            [table, PATH_COLUMN])
+        return cursor.fetchone()[0]
+    if connection.vendor == 'sqlite':
+        names = []
+        cursor.execute("PRAGMA index_list(%s)" % connection.ops.quote_name(
+                table))
+        for row in cursor.fetchall():
+            cursor.execute("PRAGMA index_info(%s)" %
+                           connection.ops.quote_name(row[1]))
+            if [info[2] for info in cursor.fetchall()][:1] == [PATH_COLUMN]:
+                names.append(row[1])
+        try:
+            cursor.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name IN (%s)" % (
+                    ", ".join(["%s"] * len(names)) or "NULL"), names)
+        except Exception:
+            # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB
+            return None
+        return cursor.fetchone()[0]
+    return None
+
+
+def _reindex():
+    """ Rebuilds the indexes of the comment table (their size only
+    shrinks then) """
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute("REINDEX TABLE %s" % table)
+    elif connection.vendor == 'sqlite':
+        connection.cursor().execute("REINDEX %s" % table)
+    transaction.commit_unless_managed()
+
+
+def _path_lookups(content_type_id, object_pk):
+    comments = Comment.unfiltered.filter(
+        content_type__id=content_type_id, object_pk=object_pk)
+    leaf = comments.order_by('-depth', '-id')[0]
+    parent = comments.order_by('-childcount', '-id')[0]
+    return {
+        'get_thread': lambda: list(leaf.get_thread()),
+        'get_replies': lambda: list(parent.get_replies()),
+        'get_parents': lambda: list(leaf.get_parents()),
+        'get_threads': lambda: list(api.ThreadPaginator(
+                content_type_id, object_pk).page(1).object_list),
+        }
+
+
+def path_encodings(content_type_id, object_pk, user, size=1000,
+                   workload='saturated', encodings=None, repeat=5):
+    """ Converts the paths of a workload to each encoding (paths.CODECS
+    by default) and measures them
+
+    Returns {encoding: {'path_bytes', 'index_bytes', lookup: seconds}}.
+    The encoding in use is restored (and the workload deleted) at the
+    end.
+    """
+    codec = paths.codec
+    results = {}
+    make_workload(workload, size, content_type_id, object_pk, user.id)
+    try:
+        for name in encodings or sorted(paths.CODECS):
+            target = paths.get_codec(name)
+            api.convert_paths(paths.codec, target)
+            paths.codec = target
+            _reindex()
+            result = results[name] = {
+                'path_bytes': sum(len(path) for path in
+                                  Comment.unfiltered.values_list(
+                        'path', flat=True).iterator()),
+                'index_bytes': path_index_size(),
+                }
+            for lookup, func in _path_lookups(
+                content_type_id, object_pk).items():
+                result[lookup] = best_of(func, repeat)
+    finally:
+        api.convert_paths(paths.codec, codec)
+        paths.codec = codec
+        clear(content_type_id, object_pk)
+    return results
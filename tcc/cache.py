@@ -0,0 +1,84 @@
+""" Versioned cache for rendered comment fragments
+
+Fragments are stored under a key that contains a version counter, one
+counter per object (for the index page) and one per root comment (for
+the thread page). Any change to a comment bumps both counters; the old
+fragments are then simply never asked for again and expire on their own.
+Invalidation is O(1) and never has to find or delete keys.
+
+Caching is off unless TCC_CACHE names a cache (an alias from CACHES or a
+backend path, e.g. 'django.core.cache.backends.locmem.LocMemCache').
+"""
+import time
+
+from django.core.cache import get_cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.safestring import mark_safe
+
+from tcc.pipeline import defer
+from tcc.settings import CACHE, CACHE_TIMEOUT
+
+cache = None
+if CACHE:
+    cache = get_cache(CACHE)
+
+
+def object_version_key(content_type_id, object_pk):
+    return 'tcc:v:obj:%s:%s' % (content_type_id, object_pk)
+
+
+def root_version_key(root_id):
+    return 'tcc:v:root:%s' % root_id
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so a counter that got evicted does not
+        # restart at a number that old fragments were stored under
+        cache.add(key, int(time.time() * 1000), CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump(key):
+    if cache is None:
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        # nothing cached under this counter yet
+        pass
+
+
+def invalidate_key(key):
+    """ bump(key), deferred and coalesced if TCC_DEFERRED """
+    if cache is not None:
+        defer(('bump', key), bump, key)
+
+
+def invalidate_object(content_type_id, object_pk):
+    invalidate_key(object_version_key(content_type_id, object_pk))
+
+
+def invalidate(comment):
+    """ Invalidates the index and thread fragments containing comment """
+    invalidate_object(comment.content_type_id, comment.object_pk)
+    invalidate_key(root_version_key(comment.get_root_id()))
+
+
+def cached_fragment(name, version_key, render, vary=''):
+    """ Returns render() from the cache under the current version
+
+    vary distinguishes fragments that share a version counter, e.g.
+    the pages of a paginated list.
+    """
+    if cache is None:
+        return render()
+    key = 'tcc:%s:%s:%s:%s' % (name, version_key, get_version(version_key),
+                               md5_constructor(vary).hexdigest())
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, unicode(html), CACHE_TIMEOUT)
+    return mark_safe(html)
@@ -1,12 +1,41 @@
+import hmac
 import time
 
 from django import forms
 from django.conf import settings
-from django.utils.crypto import salted_hmac, constant_time_compare
+from django.contrib.contenttypes.models import ContentType
+from django.core.validators import EMPTY_VALUES
+from django.forms.util import ErrorDict
+from django.utils.crypto import constant_time_compare
 from django.utils.hashcompat import sha_constructor
 from django.utils.translation import ungettext, ugettext_lazy as _
 
 from tcc.models import Comment
+from tcc.settings import LEGACY_HASH
+
+# {(key_salt, SECRET_KEY): key}, see _security_key
+_security_keys = {}
+
+
+def _security_key(key_salt):
+    """ The HMAC key salted_hmac would derive, computed once """
+    secret = settings.SECRET_KEY
+    key = _security_keys.get((key_salt, secret))
+    if key is None:
+        key = _security_keys[(key_salt, secret)] = \
+            sha_constructor(key_salt + secret).digest()
+    return key
+
+
+class ContentTypeChoiceField(forms.ModelChoiceField):
+    """ Looks the content type up in the ContentType cache """
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            return ContentType.objects.get_for_id(int(value))
+        except (ValueError, ContentType.DoesNotExist):
+            raise forms.ValidationError(self.error_messages['invalid_choice'])
 
 
 class CommentForm(forms.ModelForm):
@@ -17,6 +46,8 @@ class CommentForm(forms.ModelForm):
     security_hash = forms.CharField(min_length=40, max_length=40,
                                     widget=forms.HiddenInput)
     next = forms.CharField(widget=forms.HiddenInput, required=False)
+    content_type = ContentTypeChoiceField(
+        queryset=ContentType.objects.all(), widget=forms.HiddenInput)
     honeypot = forms.CharField(
         required=False,
         label=_('If you enter anything in this field '\
@@ -26,7 +57,8 @@ class CommentForm(forms.ModelForm):
         model = Comment
         exclude = ['submit_date', 'is_open', 'is_removed', 'is_approved', 
                    'is_public', 'site', 'limit', 'path', 'user_name',
-                   'user_email', 'user_url', 'comment_raw', 'childcount', 'depth']
+                   'user_email', 'user_url', 'comment_raw', 'childcount', 'depth',
+                   'is_visible', 'thread_activity']
         widgets = {
             'content_type': forms.HiddenInput,
             'object_pk': forms.HiddenInput,
@@ -34,16 +66,28 @@ class CommentForm(forms.ModelForm):
             'parent': forms.HiddenInput,
             }
         
-    def __init__(self, target_object, data=None, initial=None):
+    def __init__(self, target_object, data=None, initial=None,
+                 timestamp=None):
+        """ target_object may be None if initial has the object_pk """
         self.target_object = target_object
         if initial is None:
-            from django.contrib.contenttypes.models import ContentType
             ct = ContentType.objects.get_for_model(target_object)
             initial = {'content_type': ct.id}
         self.content_type = initial['content_type']
-        initial.update(self.generate_security_data())
+        self.object_pk = initial.get('object_pk')
+        if self.object_pk is None:
+            self.object_pk = target_object._get_pk_val()
+        if data is None:
+            # a bound form is validated, not rendered: no fresh hash
+            initial.update(self.generate_security_data(timestamp))
         super(CommentForm, self).__init__(data=data, initial=initial)
 
+    def _get_validation_exclusions(self):
+        # the form fields just looked these up; the model validation of
+        # the foreign keys would query them once more
+        exclude = super(CommentForm, self)._get_validation_exclusions()
+        return exclude + ['content_type', 'user', 'parent']
+
     def clean_honeypot(self):
         """Check that nothing's been entered into the honeypot."""
         value = self.cleaned_data["honeypot"]
@@ -66,9 +110,14 @@ class CommentForm(forms.ModelForm):
             'object_pk' : self.data.get("object_pk", ""),
             'timestamp' : self.data.get("timestamp", ""),
             }
-        expected_hash = self.generate_security_hash(**security_hash_dict)
         actual_hash = self.cleaned_data["security_hash"]
+        if "timestamp" not in self.cleaned_data:
+            # invalid or expired already, no need to hash
+            return actual_hash
+        expected_hash = self.generate_security_hash(**security_hash_dict)
         if not constant_time_compare(expected_hash, actual_hash):
+            if not LEGACY_HASH:
+                raise forms.ValidationError("Security hash check failed.")
             # Fallback to Django 1.2 method for compatibility
             # PendingDeprecationWarning <- here to remind us to remove this
             # fallback in Django 1.5
@@ -84,12 +133,13 @@ class CommentForm(forms.ModelForm):
             raise forms.ValidationError("Timestamp check failed")
         return ts
 
-    def generate_security_data(self):
+    def generate_security_data(self, timestamp=None):
         """Generate a dict of security data for "initial" data."""
-        timestamp = int(time.time())
+        if timestamp is None:
+            timestamp = int(time.time())
         security_dict =   {
             'content_type'  : str(self.content_type),
-            'object_pk'     : str(self.target_object._get_pk_val()),
+            'object_pk'     : str(self.object_pk),
             'timestamp'     : str(timestamp),
             'security_hash' : self.initial_security_hash(timestamp),
             }
@@ -103,7 +153,7 @@ class CommentForm(forms.ModelForm):
 
         initial_security_dict = {
             'content_type' : str(self.content_type),
-            'object_pk' : str(self.target_object._get_pk_val()),
+            'object_pk' : str(self.object_pk),
             'timestamp' : str(timestamp),
           }
         return self.generate_security_hash(**initial_security_dict)
@@ -115,7 +165,9 @@ class CommentForm(forms.ModelForm):
         info = (content_type, object_pk, timestamp)
         key_salt = "django.contrib.forms.CommentSecurityForm"
         value = "-".join(info)
-        return salted_hmac(key_salt, value).hexdigest()
+        # same as salted_hmac(key_salt, value), without deriving the key
+        return hmac.new(_security_key(key_salt), msg=value,
+                        digestmod=sha_constructor).hexdigest()
 
     def _generate_security_hash_old(self, content_type, object_pk, timestamp):
         """Generate a (SHA1) security hash from the provided info."""
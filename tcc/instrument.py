@@ -0,0 +1,255 @@
+""" Per operation query counts and timings
+
+The hot paths of tcc.api and tcc.views are wrapped with instrumented();
+while a sink is set up every call is measured and handed to the sink as
+a record:
+
+    {'operation': 'views.index', 'queries': 3, 'db_time': 0.002,
+     'rows': 28, 'render_time': 0.011, 'time': 0.015}
+
+Times are in seconds. The queries of nested operations (an api function
+called by a view) count for both. TCC_INSTRUMENT picks the sink:
+
+- None (default): off, instrumented functions cost one check per call
+- 'logging': a debug line per record on the 'tcc.instrument' logger
+- 'statsd': UDP packets to TCC_STATSD_HOST:TCC_STATSD_PORT
+- the path of a callable returning an object with emit(record)
+
+Tests collect records with collect() and check query budgets with
+QueryBudgetMixin, whatever TCC_INSTRUMENT says.
+"""
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.core.urlresolvers import get_callable
+from django.db.backends import BaseDatabaseWrapper
+
+from tcc.settings import (
+    INSTRUMENT, STATSD_HOST, STATSD_PORT, STATSD_PREFIX)
+
+logger = logging.getLogger('tcc.instrument')
+
+FIELDS = ('queries', 'db_time', 'rows', 'render_time', 'time')
+
+_local = threading.local()
+_sink = None
+_installed = False
+
+
+class LoggingSink(object):
+    def emit(self, record):
+        logger.debug(
+            "%(operation)s: %(queries)d queries, %(rows)d rows, "
+            "db %(db_time).4fs, render %(render_time).4fs, "
+            "total %(time).4fs", record, extra={'tcc': record})
+
+
+class StatsdSink(object):
+    """ Sends a record as one statsd packet: times as timers (ms),
+    queries and rows as counters """
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT,
+                 prefix=STATSD_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, record):
+        name = '%s.%s' % (self.prefix, record['operation'])
+        lines = ['%s.calls:1|c' % name,
+                 '%s.queries:%d|c' % (name, record['queries']),
+                 '%s.rows:%d|c' % (name, record['rows'])]
+        for field in ('db_time', 'render_time', 'time'):
+            lines.append('%s.%s:%.3f|ms' % (name, field, record[field] * 1000))
+        return '\n'.join(lines)
+
+    def emit(self, record):
+        try:
+            self.socket.sendto(self.format(record), self.address)
+        except socket.error:
+            # metrics are best effort
+            pass
+
+
+class Collector(object):
+    """ Keeps the records in memory """
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def get(self, operation):
+        """ The records of operation """
+        return [r for r in self.records if r['operation'] == operation]
+
+
+def get_sink():
+    global _sink
+    sinks = getattr(_local, 'sinks', None)
+    if sinks:
+        return sinks[-1]
+    if _sink is None and INSTRUMENT:
+        if INSTRUMENT == 'logging':
+            _sink = LoggingSink()
+        elif INSTRUMENT == 'statsd':
+            _sink = StatsdSink()
+        else:
+            _sink = get_callable(INSTRUMENT)()
+    return _sink
+
+
+class InstrumentedCursor(object):
+    """ Counts queries, their time and the rows fetched into the
+    innermost running operation """
+    def __init__(self, cursor, record):
+        self.cursor = cursor
+        self.record = record
+
+    def _timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.record['queries'] += 1
+            self.record['db_time'] += time.time() - start
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def _fetched(self, rows):
+        self.record['rows'] += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.record['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        return self._fetched(self.cursor.fetchmany(*args))
+
+    def fetchall(self):
+        return self._fetched(self.cursor.fetchall())
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.record['rows'] += 1
+            yield row
+
+
+def _install():
+    """ Wraps the cursors of every connection, once """
+    global _installed
+    if _installed:
+        return
+    cursor = BaseDatabaseWrapper.cursor
+
+    def instrumented_cursor(self):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            return InstrumentedCursor(cursor(self), stack[-1])
+        return cursor(self)
+    BaseDatabaseWrapper.cursor = instrumented_cursor
+    _installed = True
+
+
+def _new_record(operation):
+    record = dict.fromkeys(FIELDS, 0)
+    record['operation'] = operation
+    return record
+
+
+@contextmanager
+def operation(name):
+    """ Measures the block as operation name """
+    sink = get_sink()
+    if sink is None:
+        yield None
+        return
+    _install()
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    record = _new_record(name)
+    _local.stack.append(record)
+    start = time.time()
+    try:
+        yield record
+    finally:
+        record['time'] = time.time() - start
+        _local.stack.pop()
+        if _local.stack:
+            parent = _local.stack[-1]
+            for field in ('queries', 'db_time', 'rows', 'render_time'):
+                parent[field] += record[field]
+        sink.emit(record)
+
+
+@contextmanager
+def rendering():
+    """ Adds the time of the block to the render time of the running
+    operation """
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        yield
+        return
+    record = stack[-1]
+    start = time.time()
+    try:
+        yield
+    finally:
+        record['render_time'] += time.time() - start
+
+
+def instrumented(name):
+    """ Decorator, measures each call as operation name """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_sink() is None:
+                return func(*args, **kwargs)
+            with operation(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect():
+    """ Sends the records of the block (in this thread) to a Collector """
+    collector = Collector()
+    if not hasattr(_local, 'sinks'):
+        _local.sinks = []
+    _local.sinks.append(collector)
+    try:
+        yield collector
+    finally:
+        _local.sinks.pop()
+
+
+class QueryBudgetMixin(object):
+    """ For TestCases: fails when an operation runs more queries than
+    budgeted """
+    def assertQueryBudget(self, operation, budget, func, *args, **kwargs):
+        """ Calls func, every call of operation in it must stay within
+        budget queries """
+        with collect() as collector:
+            result = func(*args, **kwargs)
+        records = collector.get(operation)
+        if not records:
+            self.fail("%s was not called" % operation)
+        for record in records:
+            if record['queries'] > budget:
+                self.fail("%s ran %d queries, the budget is %d" % (
+                        operation, record['queries'], budget))
+        return result
@@ -0,0 +1,101 @@
+import platform
+from optparse import make_option
+
+import django
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from tcc import benchmarks
+from tcc import settings as tcc_settings
+from tcc.settings import get_content_types
+
+
+class Command(BaseCommand):
+    help = ("Times the hot paths of tcc on synthetic workloads and writes "
+            "the results as JSON. Replaces (and finally deletes) the "
+            "comments of the object; use a scratch database.")
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='1000',
+                    help="Comma separated numbers of comments "
+                    "(e.g. 1000,100000,1000000)"),
+        make_option('--workloads', default=','.join(benchmarks.WORKLOADS),
+                    help="Comma separated, of: %s" % ", ".join(
+                benchmarks.WORKLOADS)),
+        make_option('--operations', default=None,
+                    help="Comma separated; all by default"),
+        make_option('--repeat', type='int', default=5),
+        make_option('--object', default=None,
+                    help="app_label.model:pk of the object to comment on; "
+                    "the first object of TCC_CONTENT_TYPES by default"),
+        make_option('--user', default=None,
+                    help="Username of the commenter; the first user by "
+                    "default"),
+        make_option('--path-encodings', action='store_true', default=False,
+                    help="Also compare the path encodings (sizes and "
+                    "lookups) on the saturated workload"),
+        make_option('--output', default=None,
+                    help="File to write the JSON to; stdout by default"),
+        )
+
+    def handle(self, *args, **options):
+        ct, object_pk = self._get_object(options['object'])
+        try:
+            if options['user']:
+                user = User.objects.get(username=options['user'])
+            else:
+                user = User.objects.order_by('id')[0]
+        except (User.DoesNotExist, IndexError):
+            raise CommandError("No such user")
+        operations = options['operations'] and \
+            options['operations'].split(',') or None
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = benchmarks.run(
+            ct.id, object_pk, user, sizes=sizes,
+            workloads=options['workloads'].split(','),
+            repeat=options['repeat'], only=operations)
+        report = {
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'settings': dict((name, getattr(tcc_settings, name)) for name in (
+                        'MAX_DEPTH', 'REPLY_LIMIT', 'MAX_REPLIES', 'STEPLEN',
+                        'PATH_ENCODING', 'SINGLE_WRITE', 'DEFERRED')),
+            'results': results,
+            }
+        if options['path_encodings']:
+            report['path_encodings'] = dict(
+                (size, benchmarks.path_encodings(
+                        ct.id, object_pk, user, size,
+                        repeat=options['repeat']))
+                for size in sizes)
+        json = simplejson.dumps(report, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(json)
+            finally:
+                f.close()
+        else:
+            self.stdout.write(json + '\n')
+
+    def _get_object(self, label):
+        if label:
+            try:
+                model, object_pk = label.split(':', 1)
+                ct = ContentType.objects.get_by_natural_key(
+                    *model.split('.'))
+            except (ValueError, ContentType.DoesNotExist):
+                raise CommandError("--object must be app_label.model:pk")
+            if ct.id not in get_content_types():
+                raise CommandError("%s is not in TCC_CONTENT_TYPES" % model)
+            return ct, object_pk
+        for content_type_id in get_content_types():
+            ct = ContentType.objects.get_for_id(content_type_id)
+            pks = ct.model_class()._default_manager.values_list(
+                'pk', flat=True).order_by('pk')[:1]
+            if pks:
+                return ct, pks[0]
+        raise CommandError("No object to comment on, use --object")
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tcc import api
+from tcc import paths
+
+
+class Command(BaseCommand):
+    help = ("Rewrites the comment paths from another encoding into the one "
+            "of TCC_PATH_ENCODING (see tcc.paths). Widen the path column "
+            "first if the new encoding needs longer paths.")
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='source', default='fixed',
+                    help="Encoding of the stored paths: %s" % ", ".join(
+                sorted(paths.CODECS))),
+        make_option('--from-steplen', type='int', default=None,
+                    help="TCC_STEPLEN the stored 'fixed' paths were made "
+                    "with"),
+        make_option('--chunk-size', type='int',
+                    default=api.RANGES_PER_QUERY),
+        )
+
+    def handle(self, *args, **options):
+        kwargs = {}
+        if options['from_steplen']:
+            kwargs['steplen'] = options['from_steplen']
+        try:
+            source = paths.get_codec(options['source'], **kwargs)
+        except (ValueError, TypeError), e:
+            raise CommandError(e)
+        count = api.convert_paths(source, chunk_size=options['chunk_size'])
+        self.stdout.write("%d paths converted\n" % count)
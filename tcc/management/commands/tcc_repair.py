@@ -0,0 +1,113 @@
+import threading
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from tcc import paths
+from tcc import repair
+from tcc.pipeline import ThreadPoolExecutor
+
+
+class Command(BaseCommand):
+    help = ("Recomputes path, depth, childcount and limit of all comments, "
+            "object by object (see tcc.repair), and optionally re-paths "
+            "them to another encoding or step length (offline). While "
+            "TCC_NEXT_PATH_ENCODING is set it fills Comment.next_path "
+            "as well, which is safe while the site runs.")
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only count what is wrong"),
+        make_option('--checkpoint', default=None,
+                    help="File recording the objects done; objects in it "
+                    "are skipped, so an interrupted run can be resumed"),
+        make_option('--workers', type='int', default=1,
+                    help="Objects repaired in parallel, each in its own "
+                    "thread and connection"),
+        make_option('--batch-size', type='int', default=100,
+                    help="Fixes per UPDATE batch and transaction"),
+        make_option('--content-type', default=None,
+                    help="Only the objects of app_label.model"),
+        make_option('--encoding', default=None,
+                    help="Re-path to this encoding: %s" % ", ".join(
+                sorted(paths.CODECS))),
+        make_option('--steplen', type='int', default=None,
+                    help="Re-path to this step length ('fixed' encoding)"),
+        )
+
+    def handle(self, *args, **options):
+        target = self._get_target(options['encoding'], options['steplen'])
+        content_type_id = None
+        if options['content_type']:
+            try:
+                content_type_id = ContentType.objects.get_by_natural_key(
+                    *options['content_type'].split('.')).id
+            except (TypeError, ContentType.DoesNotExist):
+                raise CommandError("Unknown content type %s" %
+                                   options['content_type'])
+        done = set()
+        checkpoint = None
+        if options['checkpoint'] and not options['dry_run']:
+            try:
+                for line in open(options['checkpoint']):
+                    done.add(tuple(simplejson.loads(line)['object']))
+            except IOError:
+                pass
+            checkpoint = open(options['checkpoint'], 'a')
+        totals = {}
+        failed = []
+        lock = threading.Lock()
+        verbosity = int(options['verbosity'])
+
+        def run(obj):
+            try:
+                stats = repair.repair_object(
+                    *obj, target=target, dry_run=options['dry_run'],
+                    batch_size=options['batch_size'])
+            except Exception, e:
+                # the other objects go on; this one is retried next run
+                with lock:
+                    failed.append(obj)
+                    self.stderr.write("%s.%s.%s: %s\n" % (obj + (e,)))
+                return
+            with lock:
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+                if checkpoint:
+                    checkpoint.write(simplejson.dumps(
+                            {'object': obj, 'stats': stats}) + '\n')
+                    checkpoint.flush()
+                if verbosity > 1:
+                    self.stdout.write("%s.%s.%s: %r\n" % (obj + (stats,)))
+
+        objects = (obj for obj in repair.get_objects(content_type_id)
+                   if obj not in done)
+        try:
+            if options['workers'] > 1:
+                executor = ThreadPoolExecutor(options['workers'])
+                for obj in objects:
+                    executor.submit(run, obj)
+                executor.join()
+            else:
+                for obj in objects:
+                    run(obj)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        self.stdout.write("%s%s\n" % (
+                options['dry_run'] and "(dry run) " or "",
+                ", ".join("%s: %d" % item for item in sorted(totals.items()))))
+        if failed:
+            raise CommandError("%d objects failed" % len(failed))
+
+    def _get_target(self, encoding, steplen):
+        if not encoding and not steplen:
+            return None
+        kwargs = {}
+        if steplen:
+            kwargs['steplen'] = steplen
+        try:
+            return paths.get_codec(encoding or paths.codec.name, **kwargs)
+        except (ValueError, TypeError), e:
+            raise CommandError(e)
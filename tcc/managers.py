@@ -1,6 +1,6 @@
 from django.db.models import Manager, F, Q
 
-from tcc.settings import CONTENT_TYPES
+from tcc.settings import get_content_types
 
 
 class CurrentCommentManager(Manager):
@@ -8,21 +8,25 @@ class CurrentCommentManager(Manager):
 
     Also filters is_public == False for backwards compatibility
 
-    Also only returns comments whose CONTENT_TYPES are allowed
+    The same goes for all their parents; this is denormalized into
+    is_visible, so no join is needed
+
+    Also only returns comments whose content types are allowed
+    (TCC_CONTENT_TYPES)
     """
     def get_query_set(self, *args, **kwargs):
         return super(CurrentCommentManager, self).get_query_set(
             *args, **kwargs).filter(
-            is_removed=False, is_approved=True, is_public=True,
-            content_type__id__in=CONTENT_TYPES
-            ).filter(
-                Q(parent__isnull=True) | \
-                    Q(parent__is_removed=False,
-                      parent__is_approved=True,
-                      parent__is_public=True))
+            is_visible=True, content_type__id__in=get_content_types())
 
 
 class LimitedCurrentCommentManager(CurrentCommentManager):
+    """ CurrentCommentManager, but only the replies from the limit of
+    their parent on (the REPLY_LIMIT most recent ones)
+
+    One join, to the limit of the parent: that moves with every reply
+    past REPLY_LIMIT, so it is not copied onto the replies
+    """
     def get_query_set(self, *args, **kwargs):
         return super(LimitedCurrentCommentManager, self).get_query_set(
             *args, **kwargs).filter(
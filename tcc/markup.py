@@ -0,0 +1,96 @@
+""" From comment_raw (what the user typed) to comment (safe HTML)
+
+Comments are rendered once, when their text changes, and stored; the
+templates output the stored HTML as is. TCC_MARKUP is the path of the
+render function (raw text -> HTML); the default keeps the tags and
+attributes in TCC_ALLOWED_TAGS, escapes everything else and turns
+newlines into <br />.
+
+When the rules change, re-render what is stored with
+api.rerender_comments().
+"""
+import re
+
+from django.core.urlresolvers import get_callable
+from django.utils.html import escape
+
+from tcc.settings import ALLOWED_TAGS, MARKUP
+
+TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^<>]*?)(/?)>')
+ATTR_RE = re.compile(
+    r'''([a-zA-Z][a-zA-Z-]*)\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+)''')
+SAFE_URL_RE = re.compile(r'^(https?://|mailto:|/|#)', re.I)
+VOID_TAGS = frozenset(['br', 'hr'])
+NEWLINE_RE = re.compile(r'\r\n|\r|\n')
+
+_markup = None
+
+
+class Sanitizer(object):
+    """ Keeps whitelisted tags and attributes, escapes everything else
+
+    allowed is {tag: [attribute, ...]}. Tags are balanced: stray closing
+    tags are escaped, open ones are closed at the end. Links must be
+    http(s), mailto or relative.
+    """
+    def __init__(self, allowed):
+        self.allowed = dict((tag.lower(), frozenset(attrs))
+                            for tag, attrs in allowed.items())
+
+    def __call__(self, text):
+        out = []
+        stack = []
+        pos = 0
+        for match in TAG_RE.finditer(text):
+            out.append(escape(text[pos:match.start()]))
+            out.append(self._tag(match, stack) or escape(match.group(0)))
+            pos = match.end()
+        out.append(escape(text[pos:]))
+        while stack:
+            out.append('</%s>' % stack.pop())
+        return u''.join(out)
+
+    def _tag(self, match, stack):
+        closing, name, attrs, selfclosing = match.groups()
+        name = name.lower()
+        if name not in self.allowed:
+            return None
+        if closing:
+            if name not in stack:
+                return None
+            html = []
+            while True:
+                tag = stack.pop()
+                html.append('</%s>' % tag)
+                if tag == name:
+                    return ''.join(html)
+        kept = []
+        for attr, value in ATTR_RE.findall(attrs):
+            attr = attr.lower()
+            if attr not in self.allowed[name]:
+                continue
+            if value[:1] in ('"', "'"):
+                value = value[1:-1]
+            if attr in ('href', 'src') and not SAFE_URL_RE.match(value):
+                continue
+            kept.append(' %s="%s"' % (attr, escape(value)))
+        if name in VOID_TAGS:
+            return '<%s%s />' % (name, ''.join(kept))
+        stack.append(name)
+        return '<%s%s>' % (name, ''.join(kept))
+
+
+sanitize = Sanitizer(ALLOWED_TAGS)
+
+
+def render(raw):
+    """ The default TCC_MARKUP """
+    return NEWLINE_RE.sub('<br />', sanitize(raw.strip()))
+
+
+def get_markup():
+    """ The TCC_MARKUP function, resolved only once """
+    global _markup
+    if _markup is None:
+        _markup = get_callable(MARKUP)
+    return _markup
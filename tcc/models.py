@@ -7,15 +7,25 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse, get_callable
-from django.db import models
+from django.db import (
+    DEFAULT_DB_ALIAS, models, connection, connections, router, transaction,
+    IntegrityError)
+from django.db.models import F, Max, Q
 from django.template.defaultfilters import striptags
-from django.utils.http import base36_to_int, int_to_base36
+from django.utils.datastructures import SortedDict
+from django.utils.http import int_to_base36
 from django.utils.translation import ugettext_lazy as _
 
+from tcc import paths
+from tcc.paths import PATH_DIGITS
 from tcc.settings import (
-    STEPLEN, COMMENT_MAX_LENGTH, MODERATED, REPLY_LIMIT, CONTENT_TYPES,
-    MAX_DEPTH, MAX_REPLIES, ADMIN_CALLBACK
+    COMMENT_MAX_LENGTH, MODERATED, REPLY_LIMIT,
+    MAX_DEPTH, MAX_REPLIES, ADMIN_CALLBACK, ADMIN_BATCH_CALLBACK, SINGLE_WRITE,
+    PATH_COLUMNS
     )
+from tcc.cache import invalidate
+from tcc.markup import get_markup
+from tcc.pipeline import defer
 from tcc.managers import (
     CurrentCommentManager, LimitedCurrentCommentManager,
     RemovedCommentManager, DisapprovedCommentManager,
@@ -23,6 +33,123 @@ from tcc.managers import (
 
 SITE_ID = getattr(settings, 'SITE_ID', 1)
 
+ADMIN_ACTIONS = ['open', 'close', 'remove', 'restore', 'approve', 'disapprove']
+# the columns of Comment.path and Comment.next_path, for raw SQL
+PATH_COLUMN, NEXT_PATH_COLUMN = PATH_COLUMNS
+# (batch callback, callback); resolved on first use
+_admin_callbacks = None
+
+# Replies that count towards childcount and limit
+VISIBLE_REPLY = "%(r)s.is_removed = %%s AND %(r)s.is_approved = %%s " \
+    "AND %(r)s.is_public = %%s"
+VISIBLE_REPLY_PARAMS = [False, True, True]
+
+# Rows per UPDATE in update_rows (3 columns of 2 parameters per row stay
+# below SQLite's 999 parameters)
+ROWS_PER_UPDATE = 100
+
+# childcount and limit (the date of the REPLY_LIMIT-th most recent reply,
+# or of the oldest if there are fewer) recomputed from the replies
+CHILDCOUNT_SQL = """
+SELECT COUNT(*) FROM %(table)s r
+WHERE r.parent_id = %(table)s.id AND %(visible_r)s
+"""
+LIMIT_SQL = """
+SELECT MIN(r.submit_date) FROM %(table)s r
+WHERE r.parent_id = %(table)s.id AND %(visible_r)s AND (
+  SELECT COUNT(*) FROM %(table)s r2
+  WHERE r2.parent_id = r.parent_id AND r2.submit_date > r.submit_date
+  AND %(visible_r2)s) < %%s
+"""
+
+# Counts a new reply on its parent, unless that is full; the first one
+# sets the limit
+ADD_REPLY_SQL = """
+UPDATE %(table)s SET childcount = childcount + 1,
+  %(limit)s = COALESCE(%(limit)s, %%s)
+WHERE id = %%s AND childcount < %%s
+"""
+
+# A comment is visible if its own flags and those of all its parents (the
+# prefixes of its path) are in order
+VISIBILITY_SQL = """
+CASE WHEN %(visible_t)s AND NOT EXISTS (
+  SELECT 1 FROM %(table)s a
+  WHERE a.%(path)s IN (%(prefixes)s) AND a.%(path)s <> %(table)s.%(path)s
+  AND NOT (%(visible_a)s))
+THEN %%s ELSE %%s END
+"""
+
+# The newest visible comment of the thread of a root, or the root's own
+# date if none is; replies do not keep one (NULL)
+ACTIVITY_SQL = """
+CASE WHEN %(table)s.parent_id IS NULL THEN COALESCE(
+  (SELECT MAX(s.submit_date) FROM %(table)s s
+   WHERE s.content_type_id = %(table)s.content_type_id
+   AND s.object_pk = %(table)s.object_pk AND s.site_id = %(table)s.site_id
+   AND %(root_s)s = %(table)s.%(path)s
+   AND s.is_visible = %%s),
+  %(table)s.submit_date) END
+"""
+
+
+def get_path_successor(path):
+    """ The smallest string greater than path and all paths below it
+
+    None if there is none (path is all 'z's).
+    >>> get_path_successor('00000z')
+    '00001'
+    """
+    path = path.rstrip(PATH_DIGITS[-1])
+    if not path:
+        return None
+    return path[:-1] + PATH_DIGITS[PATH_DIGITS.index(path[-1]) + 1]
+
+
+def path_range(path):
+    """ Lookups for path and all paths below it, as a half-open range
+
+    Unlike path__startswith (LIKE 'path%') a range can use the plain
+    btree index on path, whatever the collation.
+    """
+    successor = get_path_successor(path)
+    if successor is None:
+        return {'path__gte': path}
+    return {'path__gte': path, 'path__lt': successor}
+
+
+def path_range_sql(path, column=PATH_COLUMN):
+    """ path_range as (sql, params) for raw queries """
+    successor = get_path_successor(path)
+    if successor is None:
+        return "%s >= %%s" % column, [path]
+    return "%s >= %%s AND %s < %%s" % (column, column), [path, successor]
+
+
+def reserves_ids():
+    """ Whether ids can be taken before the INSERT, from a sequence
+
+    Only PostgreSQL has one. Elsewhere the INSERT hands out the id: a
+    MAX(id) + 1 of our own would race with concurrent writers (under
+    REPEATABLE READ a retry sees the same maximum) and hand out the id
+    of a deleted newest comment again, which stale cache keys still
+    point at.
+    """
+    return connection.vendor == 'postgresql'
+
+
+THREAD_COUNTERS = ('comment_count', 'removed_count', 'disapproved_count',
+                   'last_comment_date')
+THREAD_COUNTS_SQL = """
+SELECT
+  SUM(CASE WHEN is_visible = %%s THEN 1 ELSE 0 END),
+  SUM(CASE WHEN is_removed = %%s THEN 1 ELSE 0 END),
+  SUM(CASE WHEN is_removed = %%s AND is_approved = %%s THEN 1 ELSE 0 END),
+  MAX(CASE WHEN is_visible = %%s THEN submit_date END)
+FROM %(table)s
+WHERE content_type_id = %%s AND object_pk = %%s AND site_id = %%s
+"""
+
 
 class Thread(models.Model):
     content_type = models.ForeignKey(
@@ -35,16 +162,182 @@ class Thread(models.Model):
                              related_name='tccthreads')
     is_open = models.BooleanField(_('Open'), default=True)
     is_moderated = models.BooleanField(_('Moderated'), default=MODERATED)
+    # denormalized counters, one row per object (see sql/thread.*.sql)
+    comment_count = models.IntegerField(_('Comments'), default=0)
+    removed_count = models.IntegerField(_('Removed comments'), default=0)
+    disapproved_count = models.IntegerField(
+        _('Disapproved comments'), default=0)
+    last_comment_date = models.DateTimeField(
+        _('Last comment'), null=True, blank=True)
 
+    def __unicode__(self):
+        return u"%s %s: %d" % (
+            self.content_type_id, self.object_pk, self.comment_count)
 
-class Comment(models.Model):
-    """ A comment table, aimed to be compatible with django.contrib.comments
+    @classmethod
+    def add_comment(cls, comment):
+        """ Counts a new comment with one UPDATE
 
+        The first comment of an object creates the row (update_counts).
+        """
+        counters = {
+            'comment_count': F('comment_count') + int(comment.is_visible),
+            'removed_count': F('removed_count') + int(comment.is_removed),
+            'disapproved_count': F('disapproved_count') + int(
+                not comment.is_removed and not comment.is_approved),
+            }
+        if comment.is_visible:
+            counters['last_comment_date'] = comment.submit_date
+        updated = cls.objects.filter(
+            content_type__id=comment.content_type_id,
+            object_pk=comment.object_pk,
+            site__id=comment.site_id).update(**counters)
+        if not updated:
+            cls.update_counts(comment.content_type_id, comment.object_pk,
+                              comment.site_id)
+
+    @classmethod
+    def add_comments(cls, comments):
+        """ Counts new comments of any objects, one UPDATE per object
+
+        Unlike with add_comment the comments may be older than those
+        counted already (imports): last_comment_date only moves forward,
+        with a second UPDATE.
+        """
+        counts = {}
+        for c in comments:
+            count = counts.setdefault(
+                (c.content_type_id, c.object_pk, c.site_id), [0, 0, 0, None])
+            count[0] += int(c.is_visible)
+            count[1] += int(c.is_removed)
+            count[2] += int(not c.is_removed and not c.is_approved)
+            if c.is_visible and (count[3] is None or
+                                 c.submit_date > count[3]):
+                count[3] = c.submit_date
+        for (content_type_id, object_pk, site_id), count in counts.items():
+            threads = cls.objects.filter(content_type__id=content_type_id,
+                                         object_pk=object_pk, site__id=site_id)
+            if not threads.update(
+                comment_count=F('comment_count') + count[0],
+                removed_count=F('removed_count') + count[1],
+                disapproved_count=F('disapproved_count') + count[2]):
+                cls.update_counts(content_type_id, object_pk, site_id)
+            elif count[3]:
+                threads.filter(Q(last_comment_date__isnull=True) |
+                               Q(last_comment_date__lt=count[3])).update(
+                    last_comment_date=count[3])
+
+    @classmethod
+    def update_counts(cls, content_type_id, object_pk, site_id=SITE_ID,
+                      using=None):
+        """ Recounts the comments of an object in one query
+
+        Creates the row if needed; returns the Thread.
+        """
+        conn = connections[using or DEFAULT_DB_ALIAS]
+        cursor = conn.cursor()
+        cursor.execute(THREAD_COUNTS_SQL % {
+                'table': conn.ops.quote_name(Comment._meta.db_table)},
+                       [True, True, False, False, True,
+                        content_type_id, unicode(object_pk), site_id])
+        counts = dict(zip(THREAD_COUNTERS, cursor.fetchone()))
+        for field in THREAD_COUNTERS[:3]:
+            counts[field] = counts[field] or 0
+        kwargs = dict(content_type_id=content_type_id, object_pk=object_pk,
+                      site_id=site_id)
+        threads = cls.objects.using(using)
+        if not threads.filter(**kwargs).update(**counts):
+            kwargs.update(counts)
+            # savepoints only inside a managed transaction; otherwise the
+            # insert commits on its own (e.g. tcc_repair, flag saves)
+            managed = transaction.is_managed(using=using)
+            if managed:
+                sid = transaction.savepoint(using=using)
+            try:
+                thread = threads.create(**kwargs)
+            except IntegrityError:
+                # created concurrently, and counted by that transaction
+                if managed:
+                    transaction.savepoint_rollback(sid, using=using)
+                else:
+                    transaction.rollback_unless_managed(using=using)
+            else:
+                if managed:
+                    transaction.savepoint_commit(sid, using=using)
+                return thread
+        return threads.get(content_type__id=content_type_id,
+                           object_pk=object_pk, site__id=site_id)
+
+
+class CommentMixin(object):
+    """ What Comment and CommentRow have in common
+
+    Everything here works on the plain fields of a comment, without
+    hitting the database.
     """
     # constants
     MAX_REPLIES = MAX_REPLIES
     REPLY_LIMIT = REPLY_LIMIT
 
+    def get_root_path(self):
+        return paths.codec.root(self.path)
+
+    # The following two methods may seem superfluous and/or convoluted
+    # but they get the root.id of any 'node' without hitting the
+    # database (again)
+    def get_root_id(self):
+        return paths.codec.decode(self.get_root_path())
+
+    def get_root_base36(self):
+        return int_to_base36(self.get_root_id())
+
+    def get_depth(self):
+        return paths.codec.depth(self.path)
+
+    def reply_allowed(self):
+        return self.is_open and self.childcount < self.MAX_REPLIES \
+            and ( self.depth < MAX_DEPTH - 1 )
+
+    # compare ids so the user does not have to be fetched
+    def can_open(self, user):
+        return self.user_id == user.id
+
+    def can_close(self, user):
+        return self.user_id == user.id
+
+    def can_approve(self, user):
+        return self.user_id == user.id
+
+    def can_disapprove(self, user):
+        return self.user_id == user.id
+
+    def can_remove(self, user):
+        return self.user_id == user.id or \
+            user in self.get_enabled_users('remove')
+
+    def can_restore(self, user):
+        return self.user_id == user.id
+
+    def get_base36(self):
+        return int_to_base36(self.id)
+
+    def get_enabled_users(self, action):
+        """ Users (besides the author) allowed to perform action
+
+        Uses the result of attach_enabled_users if that ran for the page
+        this comment is on.
+        """
+        assert action in ADMIN_ACTIONS
+        enabled = getattr(self, '_enabled_users', {})
+        if action not in enabled:
+            attach_enabled_users([self], action)
+        return self._enabled_users[action]
+
+
+class Comment(CommentMixin, models.Model):
+    """ A comment table, aimed to be compatible with django.contrib.comments
+
+    """
     # From comments BaseCommentAbstractModel
     content_type = models.ForeignKey(
         ContentType, verbose_name=_('content type'),
@@ -73,12 +366,25 @@ class Comment(models.Model):
     # is_public is rather pointless icw is_removed?
     # Keeping it for compatibility w/ contrib.comments
     is_public = models.BooleanField(_('Public'), default=True)
-    path = models.CharField(_('Path'), unique=True, max_length=MAX_DEPTH*STEPLEN)
+    path = models.CharField(_('Path'), unique=True, db_column=PATH_COLUMN,
+                            max_length=paths.codec.max_length(MAX_DEPTH))
+    # the path in the encoding a re-path moves to (see tcc.repair), NULL
+    # while none runs
+    next_path = models.CharField(
+        _('Next path'), unique=True, null=True, blank=True,
+        db_column=NEXT_PATH_COLUMN,
+        max_length=(paths.next_codec or paths.codec).max_length(MAX_DEPTH))
     limit = models.DateTimeField(
         _('Show replies from'), null=True, blank=True)
     # denormalized cache
     childcount = models.IntegerField(_('Reply count'), default=0)
     depth = models.IntegerField(_('Depth'), default=0)
+    # not removed, approved and public, and so are all its parents
+    is_visible = models.BooleanField(_('Visible'), default=True)
+    # date of the newest visible comment in the thread, on the root only
+    # (NULL on replies); the sort key of the index (see sql/comment.*.sql)
+    thread_activity = models.DateTimeField(
+        _('Thread activity'), null=True, blank=True)
 
     unfiltered = models.Manager()
     objects = CurrentCommentManager()
@@ -99,39 +405,28 @@ class Comment(models.Model):
         return "%s#%s" % (link, self.get_base36())
 
     def clean(self):
-        if self.parent:
-            if not self.pk and self.parent.childcount >= self.MAX_REPLIES:
+        if self.parent_id and not self.pk:
+            if self.parent.childcount >= self.MAX_REPLIES:
                 raise ValidationError(_('Maximum number of replies reached'))
-        if self.comment <> "" and striptags(self.comment).strip() == "":
-            raise ValidationError(_("This field is required."))
-
-    def get_root_path(self):
-        return self.path[0:STEPLEN]
-
-    # The following two methods may seem superfluous and/or convoluted
-    # but they get the root.id of any 'node' without hitting the
-    # database (again)
-    def get_root_id(self):
-        return base36_to_int(self.get_root_path())
-
-    def get_root_base36(self):
-        return int_to_base36(self.get_root_id())
+        if self._text_changed():
+            text = self.comment_raw or self.comment
+            if text <> "" and striptags(text).strip() == "":
+                raise ValidationError(_("This field is required."))
 
     def get_thread(self):
         """ returns the entire 'thread' (a 'root' comment and all replies)
 
         a root comment is a comment without a parent
         """
-        return Comment.objects.filter(path__startswith=self.get_root_path())
+        return Comment.objects.filter(**path_range(self.get_root_path()))
 
     def get_replies(self, levels=None, include_self=False):
         if self.parent and self.parent.depth == MAX_DEPTH - 1:
             return Comment.objects.none()
         else:
-            replies = Comment.objects.filter(path__startswith=self.path)
+            replies = Comment.objects.filter(**path_range(self.path))
             if levels:
-                # 'z' is the highest value in base36 (as implemented in django)
-                replies = replies.filter(path__lte="%s%s" % (self.path, (levels * STEPLEN * 'z')))
+                replies = replies.filter(depth__lte=self.depth + levels)
             if not include_self:
                 replies = replies.exclude(id=self.id)
             return replies
@@ -143,11 +438,9 @@ class Comment(models.Model):
 
     def get_parents(self):
         if self.parent:
-            parentpaths = []
-            l = len(self.path)
-            for i in range(0, l, STEPLEN):
-                parentpaths.append(self.path[i:i+STEPLEN])
-            return Comment.objects.filter(path__in=parentpaths)
+            # the prefixes of the path, looked up by equality
+            return Comment.objects.filter(
+                path__in=paths.codec.prefixes(self.path))
         else:
             return Comment.objects.none()
 
@@ -162,6 +455,28 @@ class Comment(models.Model):
             filter(pk=self.pk).values(field).get()[field]
         return not getattr(self, field) == old_value
 
+    def __init__(self, *args, **kwargs):
+        super(Comment, self).__init__(*args, **kwargs)
+        self._flags = self._get_flags()
+        self._raw = self.comment_raw
+
+    def _text_changed(self):
+        return not self.pk or self.comment_raw != self._raw
+
+    def render_comment(self):
+        """ Renders comment_raw into comment (see tcc.markup)
+
+        Callers that only set comment (as before comment_raw was used)
+        have it taken as the raw text.
+        """
+        if not self.comment_raw:
+            self.comment_raw = self.comment
+        self.comment = get_markup()(self.comment_raw)
+        self._raw = self.comment_raw
+
+    def _get_flags(self):
+        return (self.is_removed, self.is_approved, self.is_public)
+
     def save(self, *args, **kwargs):
 
         if self.id:
@@ -171,62 +486,277 @@ class Comment(models.Model):
 
         self.clean()
 
-        super(Comment, self).save(*args, **kwargs)
+        # only when the text changed, not for moderation
+        if self._text_changed():
+            self.render_comment()
 
         if is_new:
-            self._set_path()
-
-        if REPLY_LIMIT and self.parent:
-            self.parent.set_limit()
-
-    def delete(self, *args, **kwargs):
-        self.get_replies(include_self=True).delete()
-        super(Comment, self).delete(*args, **kwargs)
-        if self.parent:
-            self.parent.set_limit()
-
-    def set_limit(self):
-        replies = self.get_replies(levels=1).order_by('-submit_date')
-        n = replies.count()
-        self.childcount = n
-        if n == 0:
-            self.limit is None
-        elif n < REPLY_LIMIT:
-            self.limit = replies[0].submit_date
-        else:
-            self.limit = replies[REPLY_LIMIT-1].submit_date
-        self.save()
-
-    def get_depth(self):
-        return ( len(self.path) / STEPLEN ) - 1
-
-    def reply_allowed(self):
-        return self.is_open and self.childcount < self.MAX_REPLIES \
-            and ( self.depth < MAX_DEPTH - 1 )
-
-    def can_open(self, user):
-        return self.user == user
-
-    def can_close(self, user):
-        return self.user == user
+            self.is_visible = self.is_counted() and \
+                (not self.parent_id or self.parent.is_visible)
+            self._flags = self._get_flags()
+            # kept on the root only
+            if not self.parent_id:
+                self.thread_activity = self.submit_date
 
-    def can_approve(self, user):
-        return self.user == user
+        if is_new:
+            # one INSERT for the comment (see reserves_ids), one UPDATE
+            # for the parent and one for the root
+            moves_limit = False
+            with transaction.commit_on_success():
+                if REPLY_LIMIT and self.parent_id and self.is_counted():
+                    # claims the reply slot first; nothing is inserted
+                    # when the parent is full
+                    moves_limit = self.parent._add_reply(self)
+                if self.parent_id and self.is_visible:
+                    self._touch_thread(self.parent.get_root_path())
+                if SINGLE_WRITE and reserves_ids():
+                    self._insert(*args, **kwargs)
+                else:
+                    super(Comment, self).save(*args, **kwargs)
+                    self._set_path()
+                Thread.add_comment(self)
+            # once this reply is in: the recount has to see it
+            if moves_limit:
+                defer(('counters', self.parent_id), Comment.update_counters,
+                      "id = %s", [self.parent_id])
+            return
+
+        flags_changed = False
+        with transaction.commit_on_success():
+            super(Comment, self).save(*args, **kwargs)
+            if self._flags != self._get_flags():
+                self._update_visibility()
+                self._flags = self._get_flags()
+                flags_changed = True
+
+        # recomputes, which may run later (see tcc.pipeline)
+        if flags_changed:
+            defer(('activity', self.get_root_path()),
+                  self._update_thread_activity)
+            defer(('thread', self.content_type_id, self.object_pk,
+                   self.site_id), Thread.update_counts,
+                  self.content_type_id, self.object_pk, self.site_id)
+            # only the flags decide whether a reply is counted; opening,
+            # closing or editing it leaves the parent alone
+            if REPLY_LIMIT and self.parent_id:
+                defer(('counters', self.parent_id), Comment.update_counters,
+                      "id = %s", [self.parent_id])
+
+    def _update_visibility(self):
+        """ Recomputes is_visible for this comment and its replies """
+        Comment.update_visibility(*path_range_sql(self.path))
+        self.is_visible = Comment.unfiltered.filter(
+            pk=self.pk).values_list('is_visible', flat=True)[0]
+
+    @classmethod
+    def update_visibility(cls, where="1 = 1", params=None):
+        """ Recomputes is_visible for all rows matching where
+
+        The flags of the parents are looked up by path (see
+        update_computed). Returns the number of rows changed.
+        """
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        prefixes = ", ".join(
+            paths.codec.prefix_sql('%s.%s' % (table, PATH_COLUMN), i)
+            for i in range(1, MAX_DEPTH)) or "NULL"
+        sql = VISIBILITY_SQL % {
+            'table': table, 'path': PATH_COLUMN, 'prefixes': prefixes,
+            'visible_t': VISIBLE_REPLY % {'r': table},
+            'visible_a': VISIBLE_REPLY % {'r': 'a'}}
+        return update_computed(where, params, [
+                ('is_visible', sql, VISIBLE_REPLY_PARAMS * 2 + [True, False])])
+
+    def _touch_thread(self, root_path):
+        """ Moves thread_activity of the thread (on its root) up to this
+        comment's date """
+        Comment.unfiltered.filter(path=root_path).filter(
+            Q(thread_activity__isnull=True) |
+            Q(thread_activity__lt=self.submit_date)).update(
+            thread_activity=self.submit_date)
+
+    def _update_thread_activity(self, using=None):
+        """ Recomputes thread_activity for the thread of this comment
+
+        A range scan on path and a single row UPDATE of the root, rather
+        than update_activity's correlated subquery.
+        """
+        root_path = self.get_root_path()
+        comments = Comment.unfiltered.using(using)
+        latest = comments.filter(
+            is_visible=True, **path_range(root_path)).aggregate(
+            latest=Max('submit_date'))['latest']
+        # nothing is shown; fall back to the date of the root
+        comments.filter(path=root_path).update(
+            thread_activity=latest or F('submit_date'))
+
+    @classmethod
+    def update_activity(cls, where="1 = 1", params=None):
+        """ Recomputes thread_activity for all rows matching where
+
+        Sets it on the roots and clears it on the replies (see
+        update_computed). Returns the number of rows changed.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        sql = ACTIVITY_SQL % {
+            'table': table, 'path': PATH_COLUMN,
+            'root_s': paths.codec.root_sql('s.%s' % PATH_COLUMN)}
+        return update_computed(where, params, [
+                ('thread_activity', sql, [True])])
+
+    def _insert(self, *args, **kwargs):
+        """ Inserts a new comment with path and depth already set
+
+        The id is reserved before the INSERT (see _reserve_id) so the
+        path, which is derived from the id, does not need a second write.
+        """
+        kwargs['force_insert'] = True
+        self.id = self._reserve_id()
+        self.path = self._make_path()
+        self.next_path = paths.next_path(self.path)
+        self.depth = self.get_depth()
+        super(Comment, self).save(*args, **kwargs)
 
-    def can_disapprove(self, user):
-        return self.user == user
+    def _reserve_id(self):
+        """ Returns the id for a comment that is about to be inserted """
+        return self._reserve_ids(1)[0]
 
-    def can_remove(self, user):
-        return self.user == user or user in self.get_enabled_users('remove')
+    @classmethod
+    def _reserve_ids(cls, n):
+        """ Returns n ids for comments that are about to be inserted
 
-    def can_restore(self, user):
-        return self.user == user
+        Only where reserves_ids() says so.
+        """
+        if not reserves_ids():
+            raise ValueError("%s hands out ids on INSERT only" %
+                             connection.vendor)
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)", [cls._meta.db_table, n])
+        return sorted(row[0] for row in cursor.fetchall())
 
-    def get_base36(self):
-        return int_to_base36(self.id)
+    def delete(self, *args, **kwargs):
+        """ Deletes this comment and all its replies
+
+        See delete_subtree, which gets chunk_size; the counters of the
+        parent, the thread and the object are fixed once afterwards, in
+        one transaction (with the DELETE unless chunked). Chunks are
+        committed before that: if the delete fails halfway, the counters
+        stay wrong until api.repair_counters, repair_activity and
+        repair_thread_counts (or tcc_repair) recompute them.
+        """
+        chunk_size = kwargs.pop('chunk_size', None)
+        using = kwargs.pop('using', None) or (args and args[0]) or \
+            router.db_for_write(Comment, instance=self)
+        if chunk_size:
+            Comment.delete_subtree(self.path, chunk_size, using)
+        with transaction.commit_on_success(using=using):
+            if not chunk_size:
+                Comment.delete_subtree(self.path, using=using)
+            if self.parent_id:
+                self.parent.set_limit(using)
+                self._update_thread_activity(using)
+            self.update_thread_counts(using)
+        invalidate(self)
+
+    @classmethod
+    def delete_subtree(cls, path, chunk_size=None, using=None):
+        """ Deletes the comment at path and everything below it
+
+        One DELETE on the path range; no instances are loaded (Django's
+        cascade would collect every reply in memory). Replies go before
+        their parents: MySQL checks the foreign key on parent_id row by
+        row. With chunk_size the subtree goes chunk_size rows per
+        statement, deepest first, each chunk committed on its own so
+        locks stay short; inside a managed transaction they are only
+        committed with it. Returns the number of comments deleted.
+        """
+        conn = connections[using or DEFAULT_DB_ALIAS]
+        table = conn.ops.quote_name(cls._meta.db_table)
+        # DELETE ... ORDER BY is MySQL only; the other databases check
+        # the foreign key at the end of the statement (or transaction)
+        order = conn.vendor == 'mysql' and \
+            " ORDER BY %s DESC" % PATH_COLUMN or ""
+        cursor = conn.cursor()
+        if not chunk_size:
+            where, params = path_range_sql(path)
+            cursor.execute("DELETE FROM %s WHERE %s%s" % (
+                    table, where, order), params)
+            return cursor.rowcount
+        subtree = cls.unfiltered.using(using).filter(**path_range(path))
+        count = 0
+        while True:
+            # replies sort after their parents
+            ids = list(subtree.order_by('-path').values_list(
+                    'id', flat=True)[:chunk_size])
+            if not ids:
+                return count
+            cursor.execute("DELETE FROM %s WHERE id IN (%s)%s" % (
+                    table, ", ".join(["%s"] * len(ids)), order), ids)
+            transaction.commit_unless_managed(using=using)
+            count += len(ids)
+
+    def update_thread_counts(self, using=None):
+        return Thread.update_counts(
+            self.content_type_id, self.object_pk, self.site_id, using)
+
+    def set_limit(self, using=None):
+        """ Recomputes childcount and limit in the database
+
+        The in-memory values are not refreshed.
+        """
+        Comment.update_counters("id = %s", [self.pk], using)
+
+    def _add_reply(self, reply):
+        """ Counts a new (not yet inserted) reply
+
+        One UPDATE of the parent row and nothing read: it fails when the
+        parent reached MAX_REPLIES (ValidationError), and sets the limit
+        if there was none (the first reply shown). A new reply is always
+        the most recent one, so once the parent shows REPLY_LIMIT
+        replies it moves the limit to the reply after it, which only the
+        replies know. Returns whether it does: save() has the parent
+        recounted after the write (see tcc.pipeline), and it shows one
+        reply more until then. That is decided on the parent as loaded;
+        replies racing past REPLY_LIMIT may leave the extra reply until
+        the next recount.
+        """
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(ADD_REPLY_SQL % {
+                'table': qn(Comment._meta.db_table), 'limit': qn('limit')},
+                       [reply.submit_date, self.pk, self.MAX_REPLIES])
+        if not cursor.rowcount:
+            raise ValidationError(_('Maximum number of replies reached'))
+        moves_limit = self.childcount >= REPLY_LIMIT
+        self.childcount += 1
+        self.limit = self.limit or reply.submit_date
+        return moves_limit
+
+    def is_counted(self):
+        """ Whether this comment counts towards its parent's childcount """
+        return not self.is_removed and self.is_approved and self.is_public
+
+    @classmethod
+    def update_counters(cls, where="1 = 1", params=None, using=None):
+        """ Recomputes childcount and limit for all rows matching where
+
+        Use it to repair counters that drifted (see update_computed).
+        Returns the number of rows changed.
+        """
+        qn = connections[using or DEFAULT_DB_ALIAS].ops.quote_name
+        sql = {'table': qn(cls._meta.db_table),
+               'visible_r': VISIBLE_REPLY % {'r': 'r'},
+               'visible_r2': VISIBLE_REPLY % {'r': 'r2'}}
+        return update_computed(where, params, [
+                ('childcount', CHILDCOUNT_SQL % sql, VISIBLE_REPLY_PARAMS),
+                ('limit', LIMIT_SQL % sql,
+                 VISIBLE_REPLY_PARAMS * 2 + [REPLY_LIMIT])], using)
 
     def _set_path(self):
-        """ This will set the path to a base36 encoding of the comment-id
+        """ This will set the path to an encoding of the comment-id, see
+        tcc.paths
 
         >>> 2**31
         2147483648
@@ -241,20 +771,219 @@ class Comment(models.Model):
         9223372036854775808L
 
         """
-        if self.parent:
-            self.path = "%s%s" % (self.parent.path, self.get_base36().zfill(STEPLEN))
-        else:
-            self.path = "%s" % (self.get_base36().zfill(STEPLEN))
-
+        self.path = self._make_path()
+        self.next_path = paths.next_path(self.path)
         self.depth = self.get_depth()
 
-        self.save()
+        Comment.unfiltered.filter(pk=self.pk).update(
+            path=self.path, next_path=self.next_path, depth=self.depth)
 
-    def get_enabled_users(self, action):
-        if not callable(ADMIN_CALLBACK):
-            return []
-        assert action in ['open', 'close', 'remove', 'restore',
-                          'approve', 'disapprove']
-        func = get_callable(ADMIN_CALLBACK)
-        return func(self, action)
+    def _make_path(self, parent_path=None):
+        if parent_path is None and self.parent_id:
+            parent_path = self.parent.path
+        return paths.codec.join(parent_path, self.id)
+
+
+def update_computed(where, params, columns, using=None):
+    """ Sets columns of the comments matching where (raw SQL on the
+    comment table, with params) to computed values
+
+    columns is a list of (column, sql, params); sql computes the new
+    value for a row of the comment table. The values are read with a
+    SELECT, ROWS_PER_UPDATE rows at a time by id, and only those that
+    differ are written, by id (see update_rows): MySQL does not let an
+    UPDATE read its own table in a subquery. Returns the number of
+    comments changed.
+    """
+    select = SortedDict()
+    select_params = []
+    for column, sql, sql_params in columns:
+        select['new_' + column] = sql
+        select_params.extend(sql_params)
+    fields = [Comment._meta.get_field(column) for column, sql, p in columns]
+    names = [field.name for field in fields]
+    # Django does not put an extra where in parentheses, and where may
+    # be an OR of path ranges
+    comments = Comment.unfiltered.using(using).extra(
+        select=select, select_params=select_params, where=["(%s)" % where],
+        params=params or []).values_list('id', *(names + select.keys()))
+    count = 0
+    last_id = 0
+    while True:
+        rows = list(comments.filter(id__gt=last_id).order_by(
+                'id')[:ROWS_PER_UPDATE])
+        if not rows:
+            return count
+        last_id = rows[-1][0]
+        changed = []
+        for row in rows:
+            # expressions come back untyped on some databases
+            new = tuple(field.to_python(value) for field, value in
+                        zip(fields, row[1 + len(fields):]))
+            if new != tuple(row[1:1 + len(fields)]):
+                changed.append((row[0],) + new)
+        update_rows([field.column for field in fields], changed, using)
+        count += len(changed)
+
+
+def update_rows(columns, rows, using=None):
+    """ Writes rows ([(id, value, ...)]) into columns of the comments,
+    one UPDATE per ROWS_PER_UPDATE rows, and commits unless managed """
+    conn = connections[using or DEFAULT_DB_ALIAS]
+    qn = conn.ops.quote_name
+    cursor = conn.cursor()
+    for i in range(0, len(rows), ROWS_PER_UPDATE):
+        chunk = rows[i:i + ROWS_PER_UPDATE]
+        sets = []
+        params = []
+        for index, column in enumerate(columns):
+            # ELSE gives the CASE the type of the column, even if every
+            # value is NULL
+            sets.append("%s = CASE id %s ELSE %s END" % (
+                    qn(column), " ".join(["WHEN %s THEN %s"] * len(chunk)),
+                    qn(column)))
+            for row in chunk:
+                params.extend([row[0], row[index + 1]])
+        cursor.execute("UPDATE %s SET %s WHERE id IN (%s)" % (
+                qn(Comment._meta.db_table), ", ".join(sets),
+                ", ".join(["%s"] * len(chunk))),
+                       params + [row[0] for row in chunk])
+    transaction.commit_unless_managed(using=using)
+
+
+class Ref(object):
+    """ Stand-in for a related object of which only a few fields are read """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __unicode__(self):
+        return unicode(getattr(self, 'username', self.id))
+
+
+class CommentRow(CommentMixin):
+    """ A read-only comment with just the fields the templates use
+
+    Built from values_list(*CommentRow.FIELDS), which is a lot cheaper
+    than instantiating Comment (see api.get_comment_rows). c.user and
+    c.parent are stand-ins carrying the id plus username and childcount
+    respectively.
+    """
+    # field lookups, in the order of the values
+    FIELDS = ('id', 'parent_id', 'path', 'depth', 'user_id',
+              'user__username', 'submit_date', 'comment', 'is_open',
+              'childcount', 'parent__childcount', 'content_type_id',
+              'object_pk')
+    __slots__ = ('id', 'parent_id', 'path', 'depth', 'user_id', 'username',
+                 'submit_date', 'comment', 'is_open', 'childcount',
+                 'parent_childcount', 'content_type_id', 'object_pk',
+                 '_enabled_users')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @property
+    def user(self):
+        return Ref(id=self.user_id, username=self.username)
+
+    @property
+    def parent(self):
+        if self.parent_id is None:
+            return None
+        return Ref(id=self.parent_id, childcount=self.parent_childcount)
+
+
+class CommentRowSet(object):
+    """ A queryset of comments read as CommentRow objects
+
+    Lazy, countable and sliceable, which is all Paginator and
+    {% autopaginate %} need.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self._rows = None
+
+    def _values(self):
+        return self.queryset.values_list(*CommentRow.FIELDS)
+
+    def __iter__(self):
+        if self._rows is None:
+            self._rows = [CommentRow(*values) for values in self._values()]
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __getitem__(self, k):
+        if self._rows is not None:
+            return self._rows[k]
+        if isinstance(k, slice):
+            return [CommentRow(*values) for values in self._values()[k]]
+        return CommentRow(*self._values()[k])
+
+    def count(self):
+        if self._rows is not None:
+            return len(self._rows)
+        return self.queryset.count()
+
+    def order_by(self, *fields):
+        return CommentRowSet(self.queryset.order_by(*fields))
+
+
+def get_admin_callbacks():
+    """ Returns (batch callback, callback), resolved only once """
+    global _admin_callbacks
+    if _admin_callbacks is None:
+        _admin_callbacks = tuple(
+            callback and get_callable(callback) or None
+            for callback in (ADMIN_BATCH_CALLBACK, ADMIN_CALLBACK))
+    return _admin_callbacks
+
+
+def attach_parents(comments):
+    """ Sets c.parent from the list itself, or one query for the parents
+    that are not in it; returns the comments as a list
+
+    Templates read c.parent.childcount; without this that is a query
+    per reply. Anything but Comment instances (e.g. CommentRow) is left
+    alone.
+    """
+    comments = list(comments)
+    loaded = dict((c.id, c) for c in comments if isinstance(c, Comment))
+    missing = set(c.parent_id for c in loaded.values()
+                  if c.parent_id and c.parent_id not in loaded and
+                  not hasattr(c, '_parent_cache'))
+    if missing:
+        loaded.update(Comment.unfiltered.in_bulk(missing))
+    for c in comments:
+        if isinstance(c, Comment) and c.parent_id in loaded:
+            c._parent_cache = loaded[c.parent_id]
+    return comments
+
+
+def attach_enabled_users(comments, action):
+    """ Resolves get_enabled_users(action) for a page of comments at once
+
+    The batch callback gets all comments in one call; the per comment
+    callback is the fallback and always gets Comment instances, loaded
+    with one query for the rest (e.g. CommentRow). Returns the comments
+    as a list.
+    """
+    assert action in ADMIN_ACTIONS
+    comments = list(comments)
+    batch_callback, callback = get_admin_callbacks()
+    if batch_callback:
+        enabled = batch_callback(comments, action)
+    elif callback:
+        loaded = Comment.unfiltered.in_bulk(
+            [c.id for c in comments if not isinstance(c, Comment)])
+        enabled = dict((c.id, callback(loaded.get(c.id, c), action))
+                       for c in comments)
+    else:
+        enabled = {}
+    for c in comments:
+        if not hasattr(c, '_enabled_users'):
+            c._enabled_users = {}
+        c._enabled_users[action] = list(enabled.get(c.id, []))
+    return comments
 
@@ -0,0 +1,195 @@
+""" Encodings of the materialized path
+
+A path is the concatenation of one segment per level, each encoding the
+id of a comment: the root first, the comment itself last. Encodings are
+order preserving (a smaller id gives a smaller segment) and prefix free
+(no segment is the start of another), so a path sorts right after its
+parent and the paths below it form one range (see models.path_range).
+
+TCC_PATH_ENCODING picks one per deployment:
+
+- 'fixed' (default): zero padded base36 segments of TCC_STEPLEN digits;
+  TCC_STEPLEN=6 allows ids up to 36**6 (about 2.1 billion)
+- 'varlen': base36 segments with their number of digits in front, so
+  id 5 is '15' and id 50000 is '412kw'; ids up to 36**9 - 1 (9 digits).
+  Against TCC_STEPLEN=6 its paths (and path index) are shorter for ids
+  below 36**4 (1,679,616), as long below 36**5 (60,466,176) and longer
+  from there on
+
+Existing paths are converted with api.convert_paths() (tcc_convert_paths)
+or rewritten from the tree by tcc.repair (tcc_repair), both offline.
+While TCC_NEXT_PATH_ENCODING is set every comment also keeps its path in
+that encoding (next_codec) in Comment.next_path, which tcc_repair fills
+online; see tcc.repair for the switch.
+"""
+from django.utils.http import base36_to_int, int_to_base36
+
+from tcc.settings import (
+    NEXT_PATH_ENCODING, NEXT_STEPLEN, PATH_ENCODING, STEPLEN)
+
+# the digits of a path segment, in sort order (see django.utils.http)
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class Codec(object):
+    """ What all encodings share
+
+    A subclass defines name and how a segment is laid out:
+    encode(id) gives the segment of id, digits(segment) the number of
+    base36 digits at its end, segment_length(path, start) the length of
+    the segment starting at path[start], max_length(depth) the longest
+    path of depth levels and prefix_sql(column, depth) SQL for the first
+    depth segments of column.
+    """
+    name = None
+
+    def decode(self, segment):
+        return base36_to_int(segment[-self.digits(segment):])
+
+    def split(self, path):
+        segments = []
+        start = 0
+        while start < len(path):
+            end = start + self.segment_length(path, start)
+            segments.append(path[start:end])
+            start = end
+        return segments
+
+    def join(self, parent_path, id):
+        """ The path of comment id below parent_path ('' or None for a
+        root) """
+        return (parent_path or '') + self.encode(id)
+
+    def root(self, path):
+        return path[:self.segment_length(path, 0)]
+
+    def prefixes(self, path):
+        """ The paths of the parents, root first """
+        prefixes = []
+        end = 0
+        for segment in self.split(path)[:-1]:
+            end += len(segment)
+            prefixes.append(path[:end])
+        return prefixes
+
+    def depth(self, path):
+        return len(self.split(path)) - 1
+
+    def ids(self, path):
+        return [self.decode(segment) for segment in self.split(path)]
+
+    def root_sql(self, column):
+        return self.prefix_sql(column, 1)
+
+    def matches(self, path, id):
+        """ Whether path is a well formed path of comment id """
+        try:
+            ids = self.ids(path)
+        except ValueError:
+            return False
+        return bool(ids) and ids[-1] == id and \
+            ''.join(self.encode(i) for i in ids) == path
+
+    def convert(self, path, source):
+        """ path, encoded by the codec source, in this encoding """
+        return ''.join(self.encode(id) for id in source.ids(path))
+
+
+class FixedCodec(Codec):
+    """ Zero padded base36 segments of steplen digits """
+    name = 'fixed'
+
+    def __init__(self, steplen=STEPLEN):
+        self.steplen = steplen
+
+    def encode(self, id):
+        segment = int_to_base36(id)
+        if len(segment) > self.steplen:
+            raise ValueError("id %d does not fit in %d digits" % (
+                    id, self.steplen))
+        return segment.zfill(self.steplen)
+
+    def digits(self, segment):
+        return self.steplen
+
+    def segment_length(self, path, start):
+        return self.steplen
+
+    def split(self, path):
+        # the common case, without the loop
+        return [path[i:i + self.steplen]
+                for i in range(0, len(path), self.steplen)]
+
+    def max_length(self, depth):
+        return depth * self.steplen
+
+    def prefix_sql(self, column, depth):
+        return "SUBSTR(%s, 1, %d)" % (column, depth * self.steplen)
+
+
+class VarlenCodec(Codec):
+    """ base36 segments behind a digit giving their length (1 - 9) """
+    name = 'varlen'
+    MAX_DIGITS = 9
+
+    def encode(self, id):
+        digits = int_to_base36(id)
+        if len(digits) > self.MAX_DIGITS:
+            raise ValueError("id %d has more than %d digits" % (
+                    id, self.MAX_DIGITS))
+        return str(len(digits)) + digits
+
+    def digits(self, segment):
+        return int(segment[0])
+
+    def segment_length(self, path, start):
+        return 1 + int(path[start])
+
+    def max_length(self, depth):
+        return depth * (1 + self.MAX_DIGITS)
+
+    def prefix_sql(self, column, depth):
+        # the length digits are read with CASE rather than a CAST, which
+        # differs between databases and fails on '' on some; the
+        # expression doubles per level, fine for the usual MAX_DEPTH
+        length = "0"
+        for i in range(depth):
+            digit = "SUBSTR(%s, %s + 1, 1)" % (column, length)
+            length = "(%s + 1 + CASE %s %s ELSE 0 END)" % (
+                length, digit, " ".join(
+                    "WHEN '%d' THEN %d" % (n, n)
+                    for n in range(1, self.MAX_DIGITS + 1)))
+        return "SUBSTR(%s, 1, %s)" % (column, length)
+
+
+CODECS = {'fixed': FixedCodec, 'varlen': VarlenCodec}
+
+
+def get_codec(name=PATH_ENCODING, **kwargs):
+    try:
+        return CODECS[name](**kwargs)
+    except KeyError:
+        raise ValueError("Unknown path encoding %r" % (name,))
+
+
+# the encoding in use; tcc reads it from here on every call
+codec = get_codec()
+# the encoding of Comment.next_path, None unless a re-path runs
+next_codec = None
+if NEXT_PATH_ENCODING:
+    next_codec = get_codec(NEXT_PATH_ENCODING, **(
+            NEXT_PATH_ENCODING == 'fixed' and {'steplen': NEXT_STEPLEN} or {}))
+
+
+def next_path(path, source=None):
+    """ path (in source, codec by default) in next_codec
+
+    None if no re-path runs, or if path is no path (yet, or a comment
+    parked under '~', see api.set_paths).
+    """
+    if next_codec is None or not path:
+        return None
+    try:
+        return next_codec.convert(path, source or codec)
+    except ValueError:
+        return None
@@ -0,0 +1,150 @@
+""" Deferred work after a write
+
+Recounting a parent, the thread counters of an object, invalidating the
+cache: none of it has to hold up the request that posted a comment. With
+TCC_DEFERRED such work is queued with defer() and handed to an executor
+once the write is committed:
+
+- 'thread' (default): a small in-process pool of TCC_EXECUTOR_WORKERS
+  threads
+- 'sync': run right away, in the calling thread (tests)
+- the path of a callable returning an object with submit(func, *args)
+
+Work is keyed; deferring a key that is already queued in this thread is
+a no-op, and so is flushing one that waits in the executor, so a burst of
+replies to one parent is recounted once. A key only counts as waiting
+once it is flushed: work queued by a transaction that never flushes does
+not hold up anybody else's. Only idempotent work (recomputes,
+invalidation) belongs here.
+
+Outside a managed transaction the queue is flushed by defer() itself.
+Inside one (TransactionMiddleware, commit_on_success) it waits for
+flush(); add FlushMiddleware *before* TransactionMiddleware so it runs
+after the commit. Without TCC_DEFERRED, defer() simply calls the function.
+"""
+import logging
+import threading
+import Queue
+
+from django.core.urlresolvers import get_callable
+from django.db import close_connection, transaction
+
+from tcc.settings import DEFERRED, EXECUTOR, EXECUTOR_WORKERS
+
+logger = logging.getLogger('tcc')
+
+_local = threading.local()
+_executor = None
+# keys that are submitted but not started yet
+_pending = set()
+_lock = threading.Lock()
+
+
+class SyncExecutor(object):
+    def submit(self, func, *args):
+        func(*args)
+
+
+class ThreadPoolExecutor(object):
+    """ Runs submitted functions on a few daemon threads """
+    def __init__(self, workers=EXECUTOR_WORKERS):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+
+    def submit(self, func, *args):
+        if not self.threads:
+            self._start()
+        self.queue.put((func, args))
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='tcc-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            finally:
+                # no connections left behind between tasks
+                close_connection()
+                self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if EXECUTOR == 'sync':
+            _executor = SyncExecutor()
+        elif EXECUTOR == 'thread':
+            _executor = ThreadPoolExecutor()
+        else:
+            _executor = get_callable(EXECUTOR)()
+    return _executor
+
+
+def _queue():
+    if not hasattr(_local, 'queue'):
+        _local.queue = []
+    return _local.queue
+
+
+def defer(key, func, *args):
+    """ Runs func(*args) after the current write, once per key """
+    if not DEFERRED:
+        func(*args)
+        return
+    queue = _queue()
+    if key not in [item[0] for item in queue]:
+        queue.append((key, func, args))
+    if not transaction.is_managed():
+        flush()
+
+
+def flush():
+    """ Hands the queued work of this thread to the executor, but for
+    the keys already waiting there """
+    queue = _queue()
+    executor = get_executor()
+    while queue:
+        key, func, args = queue.pop(0)
+        with _lock:
+            if key in _pending:
+                continue
+            _pending.add(key)
+        executor.submit(_run, key, func, args)
+
+
+def discard():
+    """ Drops the queued work of this thread (the write rolled back) """
+    del _queue()[:]
+
+
+def _run(key, func, args):
+    # released first: whatever is deferred from now on sees our result
+    # too late and has to run again
+    with _lock:
+        _pending.discard(key)
+    try:
+        with transaction.commit_on_success():
+            func(*args)
+    except Exception:
+        logger.exception("tcc: deferred %r failed", key)
+
+
+class FlushMiddleware(object):
+    """ Flushes deferred work after the response (and the commit) """
+    def process_response(self, request, response):
+        flush()
+        return response
+
+    def process_exception(self, request, exception):
+        discard()
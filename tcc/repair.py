@@ -0,0 +1,265 @@
+""" Streaming repair of the denormalized tree fields
+
+path, depth, childcount and limit all follow from parent_id, the ids and
+the flags and dates of the replies, but they are written by separate
+saves (Comment.save, _set_path, set_limit) and drift when a process dies
+in between. repair_object() recomputes them for the comments of one
+object in a single pass in path order, keeping only the open ancestors
+of the current comment in memory, and writes what differs in batched
+UPDATEs.
+
+The same pass can re-path in place: given a target encoding (e.g.
+another TCC_STEPLEN, see tcc.paths) every path is rewritten, object by
+object. That is offline: tcc reads and writes paths with
+TCC_PATH_ENCODING only, so nothing may read or post comments until the
+new setting is deployed.
+
+Online the new paths go into a second column, Comment.next_path:
+
+1. add the column (NULL, unique, as wide as the new encoding needs) and
+   deploy TCC_NEXT_PATH_ENCODING (and TCC_NEXT_STEPLEN): new comments
+   get their next_path in the same write, from their own path
+2. once every process runs with it, run tcc_repair: repair_object()
+   fills next_path object by object, in batches (fill_next_paths). It
+   only depends on path, so it agrees with every concurrent write. Run
+   it again until it finds no wrong next_path
+3. deploy the new encoding on the swapped columns: TCC_PATH_ENCODING
+   and TCC_STEPLEN, TCC_PATH_COLUMNS = ('next_path', 'path') and the old
+   encoding as TCC_NEXT_PATH_ENCODING (and TCC_NEXT_STEPLEN), so
+   processes on either side of the deploy keep both columns current.
+   Create the indexes of sql/comment.<backend>.sql on the new column
+4. unset TCC_NEXT_PATH_ENCODING, then drop the old column
+
+The tcc_repair management command runs it over all objects, in
+parallel and resumable.
+"""
+import heapq
+
+from django.db import transaction
+
+from tcc import api
+from tcc import cache
+from tcc import paths
+from tcc.models import NEXT_PATH_COLUMN, Comment, update_rows
+from tcc.settings import REPLY_LIMIT
+
+FIELDS = ('path', 'depth', 'childcount', 'limit')
+COLUMNS = ('id', 'parent_id', 'path', 'depth', 'childcount', 'limit',
+           'submit_date', 'is_removed', 'is_approved', 'is_public')
+
+
+def get_objects(content_type_id=None):
+    """ (content_type_id, object_pk, site_id) of every object with
+    comments, in a stable order """
+    objects = Comment.unfiltered.all()
+    if content_type_id:
+        objects = objects.filter(content_type__id=content_type_id)
+    return objects.order_by(
+        'content_type__id', 'object_pk', 'site__id').values_list(
+        'content_type', 'object_pk', 'site').distinct().iterator()
+
+
+class _Node(object):
+    """ A comment whose replies are still being counted """
+    __slots__ = ('row', 'path', 'count', 'dates')
+
+    def __init__(self, row, path):
+        self.row = row
+        self.path = path
+        self.count = 0
+        # the REPLY_LIMIT most recent dates of the visible replies
+        self.dates = []
+
+    def add_reply(self, submit_date):
+        self.count += 1
+        if len(self.dates) < REPLY_LIMIT:
+            heapq.heappush(self.dates, submit_date)
+        else:
+            heapq.heappushpop(self.dates, submit_date)
+
+    def limit(self):
+        return self.dates and self.dates[0] or None
+
+
+def _visible(row):
+    is_removed, is_approved, is_public = row[-3:]
+    return not is_removed and is_approved and is_public
+
+
+class Repair(object):
+    """ The repair of one object; see repair_object """
+    def __init__(self, source, target, dry_run, batch_size):
+        self.source = source
+        self.target = target
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.stats = dict.fromkeys(('comments', 'unresolved') + FIELDS, 0)
+        # {id: (old row, path, depth, childcount, limit)} to be written
+        self.fixes = {}
+        self.roots = set()
+
+    def run(self, comments):
+        stack = []
+        displaced = []
+        for row in comments.iterator():
+            self.stats['comments'] += 1
+            parent_id = row[1]
+            if parent_id and parent_id not in [n.row[0] for n in stack]:
+                # its path does not put it below its parent (or the
+                # parent's path is off); sorted out at the end
+                displaced.append(row)
+                continue
+            while stack and stack[-1].row[0] != parent_id:
+                self.finish(stack.pop())
+            parent = stack and stack[-1] or None
+            if parent and _visible(row):
+                parent.add_reply(row[6])
+            stack.append(_Node(row, self.target.join(
+                        parent and parent.path, row[0])))
+        while stack:
+            self.finish(stack.pop())
+        if displaced:
+            self.run_displaced(sorted(displaced))
+        self.flush()
+        return self.stats
+
+    def finish(self, node, path=None):
+        path = path or node.path
+        self.check(node.row, path, self.target.depth(path), node.count,
+                   node.limit())
+
+    def check(self, row, path, depth, childcount, limit):
+        new = (path, depth, childcount, limit)
+        if row[2:6] == new:
+            # a recount may take back an earlier fix
+            self.fixes.pop(row[0], None)
+            return
+        self.fixes[row[0]] = (row,) + new
+        if len(self.fixes) >= self.batch_size:
+            self.flush()
+
+    def run_displaced(self, rows):
+        """ Parents come before their replies in id order; the counters of
+        all parents involved are recounted from their replies """
+        known = {}
+        parent_ids = set(row[1] for row in rows)
+        stored = dict((row[0], row) for row in Comment.unfiltered.filter(
+                id__in=parent_ids).values_list(*COLUMNS))
+        for row in rows:
+            path = known.get(row[1]) or self._known_path(stored.get(row[1]))
+            if path is None:
+                self.stats['unresolved'] += 1
+                continue
+            known[row[0]] = self.target.join(path, row[0])
+        nodes = dict((row[0], _Node(row, known.get(row[0])))
+                     for row in stored.values() + rows)
+        for reply in Comment.unfiltered.filter(parent__in=nodes.keys(
+                )).values_list(*COLUMNS).iterator():
+            if _visible(reply):
+                nodes[reply[1]].add_reply(reply[6])
+        for node in nodes.values():
+            path = node.path or self._known_path(node.row)
+            if path is not None:
+                self.finish(node, path)
+
+    def _known_path(self, row):
+        """ The path of row in the target encoding, if it can tell """
+        if row is None:
+            return None
+        comment_id, path = row[0], row[2]
+        pending = self.fixes.get(comment_id)
+        if pending:
+            return pending[1]
+        if self.target.matches(path, comment_id):
+            return path
+        if self.source.matches(path, comment_id):
+            return self.target.convert(path, self.source)
+        return None
+
+    def flush(self):
+        """ Writes the pending fixes, in one transaction """
+        fixes, self.fixes = self.fixes, {}
+        for fix in fixes.values():
+            for field, old, value in zip(FIELDS, fix[0][2:6], fix[1:]):
+                if old != value:
+                    self.stats[field] += 1
+            self.roots.add(self.target.ids(fix[1])[0])
+        if self.dry_run or not fixes:
+            return
+        with transaction.commit_on_success():
+            new = dict((i, fix[1]) for i, fix in fixes.items()
+                       if fix[1] != fix[0][2])
+            api.set_paths(new, dict((i, fixes[i][0][2]) for i in new),
+                          self.source, self.target)
+            update_rows(('depth', 'childcount', 'limit'), [
+                    (i,) + fix[2:] for i, fix in fixes.items()])
+
+
+def repair_object(content_type_id, object_pk, site_id, target=None,
+                  source=None, dry_run=False,
+                  batch_size=api.RANGES_PER_QUERY):
+    """ Recomputes path, depth, childcount and limit for the comments of
+    one object, and re-paths them if target (a tcc.paths codec) is not
+    the encoding in use (source, TCC_PATH_ENCODING by default); that is
+    offline, see the module docstring. While a re-path runs online the
+    next_path of the comments is filled as well (fill_next_paths).
+
+    Comments are read once, in path order; a comment whose path does not
+    put it below its parent is handled at the end, by id, and its parent
+    is recounted (and possibly written again). The whole
+    result is read before the first write (Django reads it on execute on
+    the backends tcc supports). Fixes are written batch_size at a time,
+    one transaction per batch, unless dry_run.
+
+    Returns {'comments': n, 'unresolved': n, field: wrong values, ...};
+    unresolved comments have no parent to hang them under.
+    """
+    source = source or paths.codec
+    repair = Repair(source, target or source, dry_run, batch_size)
+    stats = repair.run(Comment.unfiltered.filter(
+            content_type__id=content_type_id, object_pk=object_pk,
+            site__id=site_id).order_by('path').values_list(*COLUMNS))
+    if paths.next_codec:
+        stats['next_path'] = fill_next_paths(
+            content_type_id, object_pk, site_id, target or source, dry_run,
+            batch_size)
+    if not dry_run and repair.roots:
+        cache.invalidate_object(content_type_id, object_pk)
+        for root_id in repair.roots:
+            cache.invalidate_key(cache.root_version_key(root_id))
+    return stats
+
+
+def fill_next_paths(content_type_id, object_pk, site_id, source=None,
+                    dry_run=False, batch_size=api.RANGES_PER_QUERY):
+    """ Sets next_path of the comments of one object from their path (in
+    source, TCC_PATH_ENCODING by default), see tcc.paths.next_path
+
+    Comments are read once, by id; what differs is written batch_size
+    at a time, one transaction per batch, unless dry_run. Returns the
+    number of comments whose next_path was wrong.
+    """
+    source = source or paths.codec
+    count = 0
+    fixes = []
+    for comment_id, path, next_path in Comment.unfiltered.filter(
+            content_type__id=content_type_id, object_pk=object_pk,
+            site__id=site_id).order_by('id').values_list(
+        'id', 'path', 'next_path').iterator():
+        value = paths.next_path(path, source)
+        if value == next_path:
+            continue
+        count += 1
+        fixes.append((comment_id, value))
+        if len(fixes) >= batch_size:
+            _write_next_paths(fixes, dry_run)
+            fixes = []
+    _write_next_paths(fixes, dry_run)
+    return count
+
+
+def _write_next_paths(fixes, dry_run):
+    if dry_run or not fixes:
+        return
+    with transaction.commit_on_success():
+        update_rows([NEXT_PATH_COLUMN], fixes)
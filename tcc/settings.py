@@ -1,28 +1,98 @@
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection
+from django.core.exceptions import ImproperlyConfigured
+from django.test.signals import setting_changed
 
 # Tree related
 MAX_DEPTH = getattr(settings, 'TCC_MAX_DEPTH', 2)
 REPLY_LIMIT = getattr(settings, 'TCC_REPLY_LIMIT', 3)
 MAX_REPLIES = getattr(settings, 'TCC_MAX_REPLIES', 50)
 STEPLEN = getattr(settings, 'TCC_STEPLEN', 6)
+# 'fixed' (STEPLEN digits per level) or 'varlen', see tcc.paths
+PATH_ENCODING = getattr(settings, 'TCC_PATH_ENCODING', 'fixed')
+# online re-pathing (see tcc.repair): while set, comments also get their
+# path in this encoding (with TCC_NEXT_STEPLEN) in Comment.next_path
+NEXT_PATH_ENCODING = getattr(settings, 'TCC_NEXT_PATH_ENCODING', None)
+NEXT_STEPLEN = getattr(settings, 'TCC_NEXT_STEPLEN', STEPLEN)
+# the columns of Comment.path and Comment.next_path; swapped to move on
+# to the next encoding
+PATH_COLUMNS = getattr(settings, 'TCC_PATH_COLUMNS', ('path', 'next_path'))
+# reserve the id up front so a new comment is written with one INSERT;
+# PostgreSQL only (a sequence), elsewhere the path is set by a second
+# write in the same transaction (see models.reserves_ids)
+SINGLE_WRITE = getattr(settings, 'TCC_SINGLE_WRITE', True)
+# comments per bulk_create in api.bulk_post_comments
+BULK_CHUNK_SIZE = getattr(settings, 'TCC_BULK_CHUNK_SIZE', 1000)
 # paginator stuff
 PER_PAGE = getattr(settings, 'PER_PAGE', 25)
 PAGE_WINDOW = getattr(settings, 'PAGE_WINDOW', 3)
 PAGE_ORPHANS = getattr(settings, 'PAGE_ORPHANS', REPLY_LIMIT+1)
+# fragment cache (see tcc.cache)
+CACHE = getattr(settings, 'TCC_CACHE', None)
+CACHE_TIMEOUT = getattr(settings, 'TCC_CACHE_TIMEOUT', 60 * 60)
+# deferred work after writes (see tcc.pipeline)
+DEFERRED = getattr(settings, 'TCC_DEFERRED', False)
+# 'thread', 'sync' or the path of an executor factory
+EXECUTOR = getattr(settings, 'TCC_EXECUTOR', 'thread')
+EXECUTOR_WORKERS = getattr(settings, 'TCC_EXECUTOR_WORKERS', 2)
+# per operation query counts and timings (see tcc.instrument): None,
+# 'logging', 'statsd' or the path of a sink factory
+INSTRUMENT = getattr(settings, 'TCC_INSTRUMENT', None)
+STATSD_HOST = getattr(settings, 'TCC_STATSD_HOST', 'localhost')
+STATSD_PORT = getattr(settings, 'TCC_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'TCC_STATSD_PREFIX', 'tcc')
 # special perms
+# callback(comment, action) -> users; always gets a Comment instance
 ADMIN_CALLBACK = getattr(settings, 'TCC_ADMIN_CALLBACK', None)
+# callback(comments, action) -> {comment.id: users}, preferred if set
+ADMIN_BATCH_CALLBACK = getattr(settings, 'TCC_ADMIN_BATCH_CALLBACK', None)
 # comment related
 COMMENT_MAX_LENGTH = getattr(settings,'COMMENT_MAX_LENGTH',3000)
+# comment_raw -> comment (see tcc.markup)
+MARKUP = getattr(settings, 'TCC_MARKUP', 'tcc.markup.render')
+ALLOWED_TAGS = getattr(settings, 'TCC_ALLOWED_TAGS', {
+        'a': ['href', 'title'], 'b': [], 'blockquote': [], 'br': [],
+        'code': [], 'em': [], 'i': [], 'p': [], 'pre': [], 'strong': [],
+        })
 MODERATED = getattr(settings, 'TCC_MODERATE', False)
+# how views.post makes sure the commented object exists: 'exists' (one
+# EXISTS query), 'load' (fetch the object) or None (don't check)
+TARGET_CHECK = getattr(settings, 'TCC_TARGET_CHECK', 'exists')
+# also accept the (Django 1.2) SHA1 security hash
+LEGACY_HASH = getattr(settings, 'TCC_LEGACY_HASH', True)
 TCC_CONTENT_TYPES = getattr(settings, 'TCC_CONTENT_TYPES', [])
-CONTENT_TYPES = []
-if connection.introspection.table_names() != []:
-    # syncdb has run -- can now assume django_content_type table exists
-    for label in TCC_CONTENT_TYPES:
-        ct = ContentType.objects.get_by_natural_key(*label.split("."))
-        CONTENT_TYPES.append(ct.id)
+# ids of TCC_CONTENT_TYPES, see get_content_types()
+_content_types = None
+
+
+def get_content_types():
+    """ Returns the ids of the allowed content types
+
+    Looked up on first use (not at import, when the database may not
+    even exist yet) through the ContentType cache and kept for the
+    lifetime of the process. Call refresh_content_types() when
+    TCC_CONTENT_TYPES or the content types change.
+    """
+    global _content_types
+    if _content_types is None:
+        ids = []
+        for label in getattr(settings, 'TCC_CONTENT_TYPES', []):
+            try:
+                ct = ContentType.objects.get_by_natural_key(*label.split("."))
+            except ContentType.DoesNotExist:
+                raise ImproperlyConfigured(
+                    "TCC_CONTENT_TYPES: unknown content type '%s'" % label)
+            ids.append(ct.id)
+        _content_types = ids
+    return _content_types
+
+
+def refresh_content_types(**kwargs):
+    global _content_types
+    if kwargs.get('setting', 'TCC_CONTENT_TYPES') == 'TCC_CONTENT_TYPES':
+        _content_types = None
+
+setting_changed.connect(refresh_content_types)
 
 
 # Wow ... weirdness occurs without the following monkeypatch for python2.6
@@ -0,0 +1,7 @@
+-- Django runs comment.<backend>.sql as well as comment.sql, so the
+-- indexes live in one file per database.
+-- The index page reads the roots of one object by thread activity
+-- (api.ThreadPaginator); replies have none, depth puts the roots in one
+-- range. object_pk is TEXT, which MySQL only indexes by prefix (191
+-- characters fit the key length limit in utf8mb4).
+CREATE INDEX tcc_comment_thread_activity ON tcc_comment (content_type_id, object_pk(191), site_id, depth, thread_activity, path);
@@ -0,0 +1,11 @@
+-- Django runs comment.<backend>.sql as well as comment.sql, so the
+-- indexes live in one file per database.
+-- Subtree lookups are ranges on path (see models.path_range), served by
+-- the unique index under any collation. This one is for LIKE 'prefix%'
+-- lookups (path__startswith) outside tcc, which need a pattern_ops index
+-- unless the database uses the C collation.
+CREATE INDEX tcc_comment_path_like ON tcc_comment (path varchar_pattern_ops);
+-- The index page reads the roots of one object by thread activity
+-- (api.ThreadPaginator); replies have none, depth puts the roots in one
+-- range
+CREATE INDEX tcc_comment_thread_activity ON tcc_comment (content_type_id, object_pk, site_id, depth, thread_activity, path);
@@ -0,0 +1,7 @@
+-- Django runs thread.<backend>.sql as well as thread.sql, so the
+-- index lives in one file per database.
+-- One row of counters per object (Thread.update_counts relies on it).
+-- object_pk is TEXT, which MySQL only indexes by prefix (191
+-- characters fit the key length limit in utf8mb4), so keys longer than
+-- that must differ within the prefix.
+CREATE UNIQUE INDEX tcc_thread_object ON tcc_thread (content_type_id, object_pk(191), site_id);
@@ -0,0 +1,4 @@
+-- Django runs thread.<backend>.sql as well as thread.sql, so the
+-- index lives in one file per database.
+-- One row of counters per object (Thread.update_counts relies on it)
+CREATE UNIQUE INDEX tcc_thread_object ON tcc_thread (content_type_id, object_pk, site_id);
@@ -3,8 +3,13 @@ try:
 except NameError:
     from sets import Set as set
 
+import base64
+from datetime import datetime
+
 from django.core.paginator import Paginator, InvalidPage
+from django.db import connection
 from django.http import Http404
+from django.utils import simplejson
 
 from coffin import template
 from jinja2 import nodes
@@ -18,6 +23,167 @@ register = template.Library()
 # Most of the code below is borrowed from the django_pagination module by James Tauber and Pinax Team,
 # http://pinaxproject.com/docs/dev/external/pagination/index.html
 
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class CursorPaginator(object):
+    """ Keyset pagination: seeks past the last row instead of OFFSET
+
+    The queryset's ordering (its order_by, or the model's default
+    ordering) is the key; extra(select=...) columns may be part of it.
+    The pk is appended when the ordering does not end in a unique field
+    (path or pk). Nullable fields may be part of it; NULLs sort where
+    the database puts them. A page reads per_page + 1 rows and never
+    counts unless asked to:
+
+    count=None       no total
+    count='exact'    COUNT(*) over the queryset
+    count='approx'   counts at most count_cap rows
+    """
+    def __init__(self, object_list, per_page, count=None, count_cap=1000):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.count_mode = count
+        self.count_cap = count_cap
+        self.model = object_list.model
+        query = object_list.query
+        ordering = list(query.order_by or query.extra_order_by or
+                        (query.default_ordering and self.model._meta.ordering)
+                        or [])
+        names = [o.lstrip('-') for o in ordering]
+        if not set(names).intersection(['path', 'pk', 'id']):
+            ordering.append('pk')
+        self.ordering = ordering
+
+    def _expression(self, name):
+        """ (sql, params, nullable) of an ordering field """
+        qn = connection.ops.quote_name
+        extra = self.object_list.query.extra_select
+        if name in extra:
+            return '(%s)' % extra[name][0], list(extra[name][1]), True
+        if name == 'pk':
+            field = self.model._meta.pk
+        else:
+            field = self.model._meta.get_field(name)
+        return '%s.%s' % (qn(self.model._meta.db_table), qn(field.column)), \
+            [], field.null
+
+    def _value(self, obj, name):
+        if name == 'pk':
+            return obj.pk
+        return getattr(obj, name)
+
+    def _after(self, name, value, op):
+        """ SQL for the rows of which name sorts after value (op '>') or
+        before it (op '<'), or None if there are none
+
+        NULL sorts above any value on PostgreSQL and Oracle and below it
+        elsewhere; a plain comparison with NULL matches nothing.
+        """
+        sql, params, nullable = self._expression(name)
+        nulls_largest = connection.vendor in ('postgresql', 'oracle')
+        if value is None:
+            if nulls_largest == (op == '>'):
+                return None
+            return '%s IS NOT NULL' % sql, params
+        if nullable and nulls_largest == (op == '>'):
+            return '(%s %s %%s OR %s IS NULL)' % (sql, op, sql), \
+                params + [value] + params
+        return '%s %s %%s' % (sql, op), params + [value]
+
+    def _seek(self, values, backwards):
+        """ WHERE clause for rows after (or before) the given key """
+        alternatives = []
+        params = []
+        for i, order in enumerate(self.ordering):
+            descending = order.startswith('-') != backwards
+            after = self._after(order.lstrip('-'), values[i],
+                                descending and '<' or '>')
+            if after is None:
+                continue
+            parts = []
+            for prev, value in zip(self.ordering[:i], values[:i]):
+                sql, sql_params, nullable = self._expression(prev.lstrip('-'))
+                if value is None:
+                    parts.append('%s IS NULL' % sql)
+                    params.extend(sql_params)
+                else:
+                    parts.append('%s = %%s' % sql)
+                    params.extend(sql_params + [value])
+            parts.append(after[0])
+            params.extend(after[1])
+            alternatives.append('(%s)' % ' AND '.join(parts))
+        return '(%s)' % (' OR '.join(alternatives) or '1 = 0'), params
+
+    def encode(self, obj, backwards=False):
+        values = []
+        for order in self.ordering:
+            value = self._value(obj, order.lstrip('-'))
+            if isinstance(value, datetime):
+                value = {'dt': value.strftime(DATETIME_FORMAT)}
+            values.append(value)
+        data = simplejson.dumps([backwards and 'p' or 'n', values])
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            data = base64.urlsafe_b64decode(
+                str(cursor) + '=' * (-len(cursor) % 4))
+            direction, values = simplejson.loads(data)
+            if direction not in ('n', 'p') or \
+                    len(values) != len(self.ordering):
+                raise ValueError
+            for i, value in enumerate(values):
+                if isinstance(value, dict):
+                    values[i] = datetime.strptime(value['dt'], DATETIME_FORMAT)
+        except (TypeError, ValueError, KeyError):
+            raise InvalidCursor('Invalid cursor')
+        return values, direction == 'p'
+
+    def page(self, cursor=None):
+        qs = self.object_list
+        backwards = False
+        if cursor:
+            values, backwards = self.decode(cursor)
+            where, params = self._seek(values, backwards)
+            qs = qs.extra(where=[where], params=params)
+        if backwards:
+            qs = qs.order_by(*[o.startswith('-') and o[1:] or '-' + o
+                               for o in self.ordering])
+        else:
+            qs = qs.order_by(*self.ordering)
+        rows = list(qs[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = bool(cursor), more
+        page = {
+            'object_list': rows,
+            'has_next': has_next,
+            'has_previous': has_previous,
+            'next_cursor': None,
+            'previous_cursor': None,
+            'count': None,
+            'count_is_approximate': False,
+            }
+        if rows and has_next:
+            page['next_cursor'] = self.encode(rows[-1])
+        if rows and has_previous:
+            page['previous_cursor'] = self.encode(rows[0], backwards=True)
+        if self.count_mode == 'exact':
+            page['count'] = self.object_list.count()
+        elif self.count_mode == 'approx':
+            page['count'] = self.object_list.all()[:self.count_cap].count()
+            page['count_is_approximate'] = page['count'] == self.count_cap
+        return page
+
 
 class AutopaginateExtension(Extension):
     """ 
@@ -31,6 +197,13 @@ class AutopaginateExtension(Extension):
         context variable.
         Pagination data is saved to the NAME_pages context variable, where NAME is
         original name of the dataset or ctx_variable
+
+        dataset may also be a Paginator (per_page and orphans are then
+        ignored).
+
+        With cursor=True the (queryset) dataset is paginated with
+        CursorPaginator: pages are addressed by opaque cursors instead of
+        numbers, and count=None|'exact'|'approx' selects the total.
     """
     tags = set(['autopaginate'])
     default_kwargs = {
@@ -39,6 +212,8 @@ class AutopaginateExtension(Extension):
         'window': settings.PAGE_WINDOW,
         'hashtag': '',
         'prefix': '',
+        'cursor': False,
+        'count': None,
         }
 
     def parse(self, parser):
@@ -85,8 +260,17 @@ class AutopaginateExtension(Extension):
         prefix = mykwargs.pop('prefix')
         window = mykwargs.pop('window')
         hashtag = mykwargs.pop('hashtag')
+        if mykwargs.pop('cursor'):
+            return self._render_cursor_pages(
+                objs, request, prefix, hashtag, mykwargs['per_page'],
+                mykwargs['count'])
+        del mykwargs['count']
         try:
-            paginator = Paginator(objs, **mykwargs)
+            if isinstance(objs, Paginator):
+                # e.g. api.ThreadPaginator, which does its own slicing
+                paginator = objs
+            else:
+                paginator = Paginator(objs, **mykwargs)
 
             key = 'page'
             if prefix:
@@ -194,6 +378,30 @@ class AutopaginateExtension(Extension):
             return to_return
         except KeyError, AttributeError:
             return {}
-    
+
+    def _render_cursor_pages(self, objs, request, prefix, hashtag, per_page,
+                             count):
+        paginator = CursorPaginator(objs, per_page, count=count)
+        key = prefix + 'cursor'
+        try:
+            page = paginator.page(request.GET.get(key))
+        except InvalidCursor:
+            raise Http404('Invalid cursor requested.')
+        page.update({
+            'cursor': True,
+            'prefix': prefix,
+            'hashtag': hashtag,
+            'paginator': paginator,
+            'is_paginated': page['has_next'] or page['has_previous'],
+            })
+        getvars = request.GET.copy()
+        if key in getvars:
+            del getvars[key]
+        if len(getvars.keys()) > 0:
+            page['getvars'] = "&%s" % getvars.urlencode()
+        else:
+            page['getvars'] = ''
+        return page
+
 
 register.tag(AutopaginateExtension)
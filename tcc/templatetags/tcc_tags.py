@@ -1,3 +1,5 @@
+import time
+
 from django import template
 from django.contrib.contenttypes.models import ContentType
 
@@ -5,23 +7,73 @@ from coffin.template.loader import render_to_string
 
 from tcc import api
 from tcc.forms import CommentForm
-from tcc.settings import CONTENT_TYPES
+from tcc.models import attach_parents
+from tcc.settings import get_content_types
 
 register = template.Library()
 
 
+# context variable for the comments prefetched by get_comments_for_objects
+PREFETCHED = 'tcc_prefetched'
+
+
 @register.simple_tag(takes_context=True)
 def get_comments_for_object(context, object, next=None):
     ct = ContentType.objects.get_for_model(object)
-    if ct.id not in CONTENT_TYPES:
+    if ct.id not in get_content_types():
         return 'Not supported'
-    comments = api.get_comments(ct.id, object.pk)
-    comments = comments.order_by('-submit_date')
+    prefetched = context.get(PREFETCHED) or {}
+    # paginated by thread, as comment-list.html expects; the same first
+    # page either way
+    if object in prefetched:
+        comments = prefetched[object]
+    else:
+        comments = api.ThreadPaginator(ct.id, object.pk)
     initial = {'content_type': ct.id,
                'object_pk': object.pk,
                'next': next,
                }
-    form = CommentForm(object, initial=initial)
+    form = CommentForm(object, initial=initial,
+                       timestamp=context.get('tcc_timestamp'))
     context.update({'comments': comments, 'form': form})
-    return render_to_string('tcc/list-comments.html',
-                            context_instance=context)
+    try:
+        return render_to_string('tcc/list-comments.html',
+                                context_instance=context)
+    finally:
+        context.pop()
+
+
+@register.simple_tag(takes_context=True)
+def get_comments_for_objects(context, objects):
+    """ Fetches the comments of many objects for get_comments_for_object
+
+    {% get_comments_for_objects object_list %}
+    {% for object in object_list %}
+      {% get_comments_for_object object %}
+    {% endfor %}
+
+    The first page of every object is read at once (see
+    api.get_comments_for_objects) instead of per object; the forms share
+    a timestamp. Renders nothing itself.
+    """
+    context[PREFETCHED] = api.get_comments_for_objects(objects)
+    context['tcc_timestamp'] = int(time.time())
+    return ''
+
+
+@register.filter
+def enabled_users(comments, action):
+    """ Resolves c.get_enabled_users(action) for all comments at once
+
+    {% for c in comments|enabled_users('remove') %}
+    """
+    return api.attach_enabled_users(comments, action)
+
+
+@register.filter
+def with_parents(comments):
+    """ Loads c.parent for all comments at once
+
+    {% for c in comments|with_parents %}
+    """
+    return attach_parents(comments)
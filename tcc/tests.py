@@ -1,12 +1,31 @@
+import threading
 import timeit
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.core.cache import get_cache
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import simplejson
 
 from tcc import api
-from tcc.models import Comment
+from tcc import benchmarks
+from tcc import cache
+from tcc import forms
+from tcc import instrument
+from tcc import models
+from tcc import paths
+from tcc import pipeline
+from tcc import repair
+from tcc.models import Comment, CommentRow, Thread
 from tcc import settings
+from tcc import views
+from tcc.templatetags.paginator import CursorPaginator, InvalidCursor
+from tcc.instrument import QueryBudgetMixin
+from tcc.tree import iter_nodes, iter_tree, OPEN, NODE, CLOSE
 
 
 class API(TestCase):
@@ -124,6 +143,82 @@ class API(TestCase):
                              user_id=pk, comment="Reply", parent_id=-1)
         self.assertEqual(c, None)
 
+    def test_single_write(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        c = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        stored = Comment.unfiltered.get(id=c.id)
+        self.assertEqual(stored.path, p.path + c.get_base36().zfill(settings.STEPLEN))
+        self.assertEqual(stored.depth, 1)
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 1)
+        r = Comment(content_type_id=ct.id, object_pk=pk, user_id=pk,
+                    comment="Another root")
+        if not models.reserves_ids():
+            # no MAX(id) + 1 guesses: the INSERT hands out the id
+            self.assertRaises(ValueError, Comment._reserve_ids, 1)
+            r.save()
+            self.assertEqual(Comment.unfiltered.get(id=r.id).path,
+                             r.get_base36().zfill(settings.STEPLEN))
+            return
+        self.assertTrue(Comment()._reserve_id() > c.id)
+        # reserving the id, the INSERT and counting it in the Thread; no
+        # UPDATE to set the path
+        self.assertNumQueries(3, r.save)
+        self.assertEqual(r.path, r.get_base36().zfill(settings.STEPLEN))
+
+    def test_bulk_post_comments(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+
+        def legacy():
+            for i in range(5):
+                yield {'key': i, 'content_type_id': ct.id, 'object_pk': pk,
+                       'user_id': pk, 'comment': "Imported root"}
+                yield {'parent_key': i, 'content_type_id': ct.id,
+                       'object_pk': pk, 'user_id': pk, 'comment': "Reply"}
+            yield {'parent_id': p.id, 'content_type_id': ct.id,
+                   'object_pk': pk, 'user_id': pk, 'comment': "Late reply"}
+
+        keys = {}
+        self.assertEqual(
+            api.bulk_post_comments(legacy(), chunk_size=3, keys=keys), 11)
+        # only the ids of the comments that can get replies are kept
+        self.assertEqual(sorted(keys), range(5))
+        tree = api.get_comments_as_tree(ct.id, pk)
+        self.assertEqual(len(tree), 6)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual(thread.comment_count, 12)
+        self.assertEqual(thread.last_comment_date,
+                         Comment.objects.latest('submit_date').submit_date)
+        for root in tree:
+            self.assertEqual(root.childcount, 1)
+            self.assertEqual(len(root.replies), 1)
+            reply = root.replies[0]
+            self.assertEqual(reply.depth, 1)
+            self.assertEqual(reply.path, root.path + reply.get_base36().zfill(settings.STEPLEN))
+        self.assertRaises(ValueError, api.bulk_post_comments, [
+                {'parent_key': 'x', 'content_type_id': ct.id,
+                 'object_pk': pk, 'user_id': pk, 'comment': "Orphan"}])
+        data = {'content_type_id': ct.id, 'object_pk': pk, 'user_id': pk,
+                'comment': "Reply"}
+        # a reply to a comment at MAX_DEPTH - 1
+        chain = [dict(data, key=0)] + [
+            dict(data, key=i, parent_key=i - 1)
+            for i in range(1, settings.MAX_DEPTH)]
+        self.assertRaisesRegexp(
+            ValueError, "MAX_DEPTH - 1 and cannot get replies",
+            api.bulk_post_comments,
+            chain + [dict(data, parent_key=settings.MAX_DEPTH - 1)])
+        # more than MAX_REPLIES replies; nothing of the chunk is written
+        self.assertRaisesRegexp(
+            ValueError, "MAX_REPLIES", api.bulk_post_comments,
+            [dict(data, parent_id=p.id)] * settings.MAX_REPLIES)
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 1)
+
     def test_post_reply(self):
         ct = ContentType.objects.get_for_model(self.user1)
         pk = self.user1.pk
@@ -194,6 +289,56 @@ class API(TestCase):
         uc = api.get_user_comments(
             self.user2.pk, content_type_id=ct.id, object_pk=pk, site_id=1)
 
+    def test_content_types(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        root = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                user_id=pk, comment="Root message")
+        self.assertTrue(ct.id in settings.get_content_types())
+        self.assertNumQueries(0, settings.get_content_types)
+        with override_settings(TCC_CONTENT_TYPES=['sites.site']):
+            self.assertFalse(ct.id in settings.get_content_types())
+            self.assertEqual(len(api.get_comments(ct.id, pk)), 0)
+        # no content type at all: the queries cannot match anything
+        with override_settings(TCC_CONTENT_TYPES=[]):
+            self.assertEqual(api.get_threads([root.path]), [])
+            paginators = api.get_comments_for_objects([self.user1])
+            self.assertEqual(paginators[self.user1].page(1).object_list, [])
+        self.assertEqual(api.get_comments_for_objects([]), {})
+        self.assertTrue(ct.id in settings.get_content_types())
+        self.assertEqual(len(api.get_comments(ct.id, pk)), 1)
+
+    def test_enabled_users(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        for _ in range(3):
+            api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        calls = []
+
+        def batch(comments, action):
+            calls.append(action)
+            return dict((c.id, [self.user2]) for c in comments)
+
+        orgcallbacks = models._admin_callbacks
+        models._admin_callbacks = (batch, None)
+        try:
+            comments = api.attach_enabled_users(
+                api.get_comments(ct.id, pk), 'remove')
+            self.assertEqual(len(comments), 3)
+            for c in comments:
+                self.assertEqual(c.get_enabled_users('remove'), [self.user2])
+                self.assertTrue(c.can_remove(self.user2))
+            self.assertEqual(calls, ['remove'])
+            # not attached: resolved for the single comment
+            self.assertFalse(comments[0].can_restore(self.user2))
+            self.assertEqual(comments[0].get_enabled_users('close'), [self.user2])
+            self.assertEqual(calls, ['remove', 'close'])
+        finally:
+            models._admin_callbacks = orgcallbacks
+        c = api.get_comment(comments[0].id)
+        self.assertEqual(c.get_enabled_users('remove'), [])
+
     def test_tree_depth(self):
         ct = ContentType.objects.get_for_model(self.user1)
         pk = self.user1.pk
@@ -227,6 +372,325 @@ class API(TestCase):
         if settings.MAX_DEPTH > 3:
             self.assertEqual(len(tree[0].replies[0].replies[0].replies), 1)
 
+    def test_iter_tree(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        c = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        q = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        events = [(e, n.id) for e, n in api.iter_comments_tree(ct.id, pk)]
+        self.assertEqual(events, [(NODE, p.id), (OPEN, p.id), (NODE, c.id),
+                                  (CLOSE, p.id), (NODE, q.id)])
+        node = api.iter_comments_tree(ct.id, pk).next()[1]
+        self.assertEqual(node.username, self.user1.username)
+        self.assertEqual(node.get_base36(), p.get_base36())
+        # deeper trees, independent of MAX_DEPTH
+        nodes = [CommentRow(i, None, '', depth) for i, depth in
+                 enumerate([0, 1, 2, 2, 1, 0, 1, 2])]
+        events = [(e, n.id) for e, n in iter_tree(nodes)]
+        self.assertEqual(events, [
+                (NODE, 0), (OPEN, 0), (NODE, 1), (OPEN, 1), (NODE, 2),
+                (NODE, 3), (CLOSE, 1), (NODE, 4), (CLOSE, 0), (NODE, 5),
+                (OPEN, 5), (NODE, 6), (OPEN, 6), (NODE, 7), (CLOSE, 6),
+                (CLOSE, 5)])
+        # streams not starting at depth 0, or with levels filtered out
+        d = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        events = [(e, n.id) for e, n in iter_tree(
+                iter_nodes(p.get_replies()))]
+        self.assertEqual(events, [(NODE, c.id), (NODE, d.id)])
+        nodes = [CommentRow(i, None, '', depth) for i, depth in
+                 enumerate([0, 2, 2])]
+        events = [(e, n.id) for e, n in iter_tree(nodes)]
+        self.assertEqual(events, [(NODE, 0), (OPEN, 0), (NODE, 1), (NODE, 2),
+                                  (CLOSE, 0)])
+
+    def test_comment_rows(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        api.post_reply(user_id=self.user2.pk, comment="Reply", parent_id=p.id)
+        comments = list(api.get_comments(ct.id, pk))
+        rows = api.get_comment_rows(ct.id, pk)
+        self.assertEqual(rows.count(), 2)
+        self.assertEqual(len(rows[0:1]), 1)
+        self.assertNumQueries(1, list, rows)
+        for c, r in zip(comments, rows):
+            self.assertEqual(r.id, c.id)
+            self.assertEqual(r.get_base36(), c.get_base36())
+            self.assertEqual(r.reply_allowed(), c.reply_allowed())
+            self.assertEqual(unicode(r.user), c.user.username)
+            self.assertEqual(r.user.id, c.user_id)
+            self.assertEqual(r.can_remove(self.user1), c.can_remove(self.user1))
+            self.assertEqual(r.get_root_id(), c.get_root_id())
+        self.assertEqual(rows[1].parent.childcount, 1)
+        self.assertEqual(rows[0].parent, None)
+        self.assertEqual(
+            len(api.get_comment_rows(ct.id, pk, limited=True)), 2)
+        # what the templates render, in one query and without Comment
+        def render(comments):
+            return [(c.id, c.comment, c.submit_date, unicode(c.user),
+                     c.parent and c.parent.childcount, c.is_open)
+                    for c in comments]
+        self.assertNumQueries(1, render, api.get_comment_rows(ct.id, pk))
+        self.assertEqual(render(api.get_comment_rows(ct.id, pk)),
+                         render(api.get_comments(ct.id, pk).select_related(
+                    'user', 'parent')))
+        # the per comment admin callback gets Comment instances
+        calls = []
+
+        def callback(comment, action):
+            calls.append(comment)
+            return [self.user2]
+
+        orgcallbacks = models._admin_callbacks
+        models._admin_callbacks = (None, callback)
+        try:
+            rows = api.attach_enabled_users(
+                api.get_comment_rows(ct.id, pk), 'remove')
+            self.assertTrue(rows[1].can_remove(self.user2))
+        finally:
+            models._admin_callbacks = orgcallbacks
+        self.assertEqual([c.id for c in calls], [c.id for c in comments])
+        self.assertTrue(all(isinstance(c, Comment) for c in calls))
+
+    def test_comment_counts(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        r = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        api.post_comment(content_type_id=ct.id, object_pk=pk,
+                         user_id=pk, comment="Another root")
+        self.assertNumQueries(
+            1, api.get_comment_counts, [self.user1, self.user2])
+        counts = api.get_comment_counts([self.user1, self.user2])
+        self.assertEqual(counts[self.user1].comment_count, 3)
+        self.assertEqual(counts[self.user1].last_comment_date,
+                         Comment.objects.latest('submit_date').submit_date)
+        self.assertEqual(counts[self.user2].comment_count, 0)
+        # removing the root hides its reply as well
+        api.remove_comment(p.id, self.user1)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual(thread.comment_count, 1)
+        self.assertEqual(thread.removed_count, 1)
+        Thread.objects.all().delete()
+        self.assertEqual(api.repair_thread_counts(), 1)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual((thread.comment_count, thread.removed_count), (1, 1))
+        r.delete()
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual(thread.removed_count, 1)
+        self.assertEqual(thread.comment_count, 1)
+
+    def test_comments_for_objects(self):
+        from django.template import Context, Template
+        from django.utils.crypto import salted_hmac
+        ct = ContentType.objects.get_for_model(self.user1)
+        for u in (self.user1, self.user2):
+            p = api.post_comment(content_type_id=ct.id, object_pk=u.pk,
+                                 user_id=u.pk, comment="Root of %s" % u)
+            api.post_reply(user_id=u.pk, comment="Reply", parent_id=p.id)
+        api.post_comment(content_type_id=ct.id, object_pk=self.user2.pk,
+                         user_id=self.user2.pk, comment="Older root")
+        # more replies than are shown
+        for _ in range(settings.REPLY_LIMIT + 2):
+            api.post_reply(user_id=self.user1.pk, comment="Reply",
+                           parent_id=p.id)
+        objects = [self.user1, self.user2]
+        # the roots, then the threads (and their users, with window
+        # functions)
+        self.assertNumQueries(2 + int(api.has_window_functions()),
+                              api.get_comments_for_objects, objects)
+        paginators = api.get_comments_for_objects(objects, per_page=1)
+        for u in objects:
+            single = api.ThreadPaginator(ct.id, u.pk, per_page=1)
+            self.assertNumQueries(0, paginators[u].page, 1)
+            self.assertEqual([c.id for c in paginators[u].page(1).object_list],
+                             [c.id for c in single.page(1).object_list])
+            self.assertEqual(paginators[u].num_pages, single.num_pages)
+        self.assertEqual(len(paginators[self.user2].page(1).object_list),
+                         1 + settings.REPLY_LIMIT)
+        # further pages are read as asked for
+        self.assertEqual([c.id for c in paginators[self.user2].page(
+                    2).object_list], [c.id for c in api.ThreadPaginator(
+                    ct.id, self.user2.pk, per_page=1).page(2).object_list])
+        # the cached HMAC key gives the same hash
+        form = forms.CommentForm(self.user1, timestamp=12)
+        self.assertEqual(form.initial['security_hash'], salted_hmac(
+                "django.contrib.forms.CommentSecurityForm",
+                "%s-%s-12" % (ct.id, self.user1.pk)).hexdigest())
+        t = Template("{% load tcc_tags %}"
+                     "{% get_comments_for_objects objects %}"
+                     "{% for o in objects %}{% get_comments_for_object o %}"
+                     "{% endfor %}")
+        html = t.render(Context({'objects': objects, 'user': self.user1,
+                                 'request': RequestFactory().get('/')}))
+        self.assertTrue("Root of user1" in html and "Root of user2" in html)
+
+    def test_replies_for(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        parents = []
+        for _ in range(3):
+            p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message")
+            for __ in range(3):
+                api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+            parents.append(p)
+        ids = [parent.id for parent in parents] + [-1]
+        self.assertNumQueries(2, api.get_replies_for, ids)
+        replies = api.get_replies_for(ids)
+        self.assertEqual(sorted(replies), sorted(ids[:-1]))
+        for parent in parents:
+            self.assertEqual(
+                [c.id for c in replies[parent.id]],
+                [c.id for c in api.get_comment_replies(parent.id)])
+        # the most recent ones
+        replies = api.get_replies_for(ids, limit_per_parent=2)
+        for parent in parents:
+            self.assertEqual(
+                [c.id for c in replies[parent.id]],
+                [c.id for c in api.get_comment_replies(parent.id)][-2:])
+        # nested parents, in one query and one query each
+        p = parents[0]
+        r, r2 = p.get_replies()[:2]
+        Comment.unfiltered.filter(id=r2.id).update(
+            parent=r, path=paths.codec.join(r.path, r2.id), depth=2)
+        org = api.RANGES_PER_QUERY
+        try:
+            for api.RANGES_PER_QUERY in (org, 1):
+                replies = api.get_replies_for([p.id, r.id])
+                for parent_id in (p.id, r.id):
+                    self.assertEqual(
+                        [c.id for c in replies[parent_id]],
+                        [c.id for c in api.get_comment_replies(parent_id)])
+                self.assertEqual([c.id for c in replies[r.id]], [r2.id])
+        finally:
+            api.RANGES_PER_QUERY = org
+        request = RequestFactory().get('/', {'id': [parents[0].id, -1]})
+        request.user = self.user1
+        response = views.replies_for(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content).keys(),
+                         [str(parents[0].id)])
+
+    def test_bulk_moderation(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        roots = []
+        for _ in range(3):
+            p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message")
+            api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+            roots.append(p)
+        other = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=self.user2.pk, comment="Not mine")
+        ids = [roots[0].id, roots[1].id, other.id]
+        # the other user's comment is skipped
+        removed = api.bulk_remove(ids, self.user1)
+        self.assertEqual(sorted(c.id for c in removed), sorted(ids[:2]))
+        # the replies went with their roots
+        self.assertEqual(api.get_comments(ct.id, pk).count(), 3)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual((thread.comment_count, thread.removed_count), (3, 2))
+        restored = api.bulk_restore(Comment.removed.all(), self.user1)
+        self.assertEqual(len(restored), 2)
+        self.assertEqual(api.get_comments(ct.id, pk).count(), 7)
+        # parent counters follow
+        reply = roots[2].get_replies()[0]
+        api.bulk_disapprove([reply.id], self.user1)
+        self.assertEqual(Comment.unfiltered.get(id=roots[2].id).childcount, 0)
+        api.bulk_approve([reply.id], self.user1)
+        self.assertEqual(Comment.unfiltered.get(id=roots[2].id).childcount, 1)
+        closed = api.bulk_close([c.id for c in roots], self.user1)
+        self.assertEqual(len(closed), 3)
+        self.assertFalse(Comment.objects.filter(
+                id__in=[c.id for c in roots], is_open=True).exists())
+
+    def test_markup(self):
+        from tcc.markup import render
+        self.assertEqual(render(u"<b>bold</b> <script>x</script>"),
+                         u"<b>bold</b> &lt;script&gt;x&lt;/script&gt;")
+        self.assertEqual(
+            render(u'<a href="javascript:x" onclick="y">a</a>\n<i>open'),
+            u'<a>a</a><br /><i>open</i>')
+        self.assertEqual(render(u'<a href="http://x.org/" title=t>x</a></p>'),
+                         u'<a href="http://x.org/" title="t">x</a>&lt;/p&gt;')
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        c = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="<em>Root</em> & <u>u</u>")
+        c = Comment.unfiltered.get(id=c.id)
+        self.assertEqual(c.comment_raw, "<em>Root</em> & <u>u</u>")
+        self.assertEqual(c.comment, "<em>Root</em> &amp; &lt;u&gt;u&lt;/u&gt;")
+        # moderation does not render again
+        c.comment = "stored"
+        c.is_open = False
+        c.save()
+        self.assertEqual(Comment.unfiltered.get(id=c.id).comment, "stored")
+        # but a batch re-render does; old rows only have comment
+        Comment.unfiltered.filter(id=c.id).update(comment_raw="")
+        self.assertEqual(api.rerender_comments(ct.id, pk), 1)
+        c = Comment.unfiltered.get(id=c.id)
+        self.assertEqual((c.comment_raw, c.comment), ("stored", "stored"))
+        self.assertEqual(api.rerender_comments(ct.id, pk), 0)
+
+    def test_post_form(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        ContentType.objects.get_for_id(ct.id)
+        form = views._get_comment_form(ct.id, pk)
+        data = dict((name, field.value()) for name, field in
+                    [(f.name, f) for f in form] if field.value() is not None)
+        data.update({'comment': 'Hi', 'user': pk})
+        # the content type comes from the cache: EXISTS for the object,
+        # then the user when validating
+        self.assertNumQueries(1, views._get_comment_form, ct.id, pk, data)
+        form = views._get_comment_form(ct.id, pk, data)
+        self.assertNumQueries(1, form.is_valid)
+        self.assertTrue(form.is_valid(), form.errors)
+        request = RequestFactory().post('/', data,
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user1
+        response = views.post(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(api.get_comments(ct.id, pk).count(), 1)
+        # no such object
+        self.assertRaises(Http404, views._get_comment_form, ct.id, 9999)
+        # the legacy hash can be switched off
+        form = forms.CommentForm(self.user1)
+        data['security_hash'] = form._generate_security_hash_old(
+            str(ct.id), str(pk), str(data['timestamp']))
+        self.assertTrue(forms.CommentForm(self.user1, data).is_valid())
+        forms.LEGACY_HASH = False
+        try:
+            self.assertFalse(forms.CommentForm(self.user1, data).is_valid())
+        finally:
+            forms.LEGACY_HASH = True
+
+    def test_benchmarks(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        benchmarks.make_workload('wide', 5, ct.id, self.user1.pk,
+                                 self.user1.id)
+        operations = benchmarks.operations(ct.id, self.user1.pk, self.user1)
+        results = benchmarks.run(ct.id, self.user1.pk, self.user1,
+                                 sizes=[20], repeat=1)
+        self.assertEqual(len(results),
+                         len(benchmarks.WORKLOADS) * len(operations))
+        for result in results:
+            self.assertTrue(result['operation'] in operations)
+            self.assertEqual(result['size'], 20)
+            self.assertTrue(result['queries'] > 0)
+        # Comment instances against CommentRow objects, one query each
+        read = [result for result in results
+                if result['operation'] in ('read_models', 'read_rows')]
+        self.assertEqual(len(read), 2 * len(benchmarks.WORKLOADS))
+        self.assertEqual(set(result['queries'] for result in read), set([1]))
+        self.assertEqual(Comment.unfiltered.count(), 0)
+
 
 class ORM(TestCase):
     usernames = ['user1', 'user2']
@@ -249,3 +713,747 @@ class ORM(TestCase):
             for __ in range(settings.REPLY_LIMIT+3):
                 c = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
         self.assertEqual(api.get_comments_limited(ct.id, pk).count(), 5*(settings.REPLY_LIMIT+1))
+        # visibility is on the row itself: the only join is to the
+        # parent's limit
+        self.assertEqual(str(Comment.limited.all().query).count('JOIN'), 1)
+
+    def test_counters(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        replies = []
+        for _ in range(settings.REPLY_LIMIT+2):
+            replies.append(
+                api.post_reply(user_id=pk, comment="Reply", parent_id=p.id))
+        p = Comment.unfiltered.get(id=p.id)
+        self.assertEqual(p.childcount, settings.REPLY_LIMIT+2)
+        self.assertEqual(p.limit, replies[-settings.REPLY_LIMIT].submit_date)
+        # let them drift and repair
+        Comment.unfiltered.filter(id=p.id).update(childcount=0, limit=None)
+        self.assertEqual(api.repair_counters(ct.id, pk), 1)
+        p = Comment.unfiltered.get(id=p.id)
+        self.assertEqual(p.childcount, settings.REPLY_LIMIT+2)
+        self.assertEqual(p.limit, replies[-settings.REPLY_LIMIT].submit_date)
+        # only what differs is written
+        self.assertEqual(api.repair_counters(ct.id, pk), 0)
+        # removing a reply recounts the parent
+        api.remove_comment(replies[-1].id, self.user1)
+        p = Comment.unfiltered.get(id=p.id)
+        self.assertEqual(p.childcount, settings.REPLY_LIMIT+1)
+        self.assertEqual(p.limit, replies[-settings.REPLY_LIMIT-1].submit_date)
+
+    def test_delete_subtree(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        replies = [api.post_reply(user_id=pk, comment="Reply",
+                                  parent_id=p.id) for _ in range(5)]
+        api.remove_comment(replies[0].id, self.user1)
+        # a reply: the parent is recounted; Model.delete's using= works
+        Comment.unfiltered.get(id=replies[-1].id).delete(using='default')
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 3)
+        # no instances are loaded, removed replies go as well
+        p = Comment.unfiltered.get(id=p.id)
+        self.assertNumQueries(1, Comment.delete_subtree, p.path)
+        self.assertEqual(Comment.unfiltered.count(), 0)
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        for _ in range(5):
+            api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        p.delete(chunk_size=2)
+        self.assertEqual(Comment.unfiltered.count(), 0)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual(thread.comment_count, 0)
+
+    def test_visibility(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        r = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        self.assertTrue(r.is_visible)
+        api.remove_comment(p.id, self.user1)
+        self.assertFalse(Comment.unfiltered.get(id=r.id).is_visible)
+        self.assertEqual(api.get_comments(ct.id, pk).count(), 0)
+        api.restore_comment(p.id, self.user1)
+        self.assertTrue(Comment.unfiltered.get(id=r.id).is_visible)
+        self.assertEqual(api.get_comments(ct.id, pk).count(), 2)
+        # let it drift and repair
+        Comment.unfiltered.filter(id=r.id).update(is_visible=False)
+        self.assertEqual(api.repair_visibility(ct.id, pk), 1)
+        self.assertTrue(Comment.unfiltered.get(id=r.id).is_visible)
+        self.assertEqual(api.repair_visibility(ct.id, pk), 0)
+
+    def test_path_ranges(self):
+        self.assertEqual(models.get_path_successor('000001'), '000002')
+        self.assertEqual(models.get_path_successor('00000z'), '00001')
+        self.assertEqual(models.get_path_successor('zz'), None)
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        for _ in range(5):
+            p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message")
+            r = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        self.assertEqual([c.id for c in p.get_thread()], [p.id, r.id])
+        self.assertEqual([c.id for c in p.get_replies(levels=1)], [r.id])
+        self.assertEqual([c.id for c in r.get_parents()], [p.id])
+
+
+class Pagination(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1', password='user1')
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        self.roots = []
+        for i in range(7):
+            p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root %d" % i)
+            api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+            self.roots.append(p)
+        self.comments = api.get_comments(ct.id, pk)
+
+    def test_cursor_path(self):
+        paginator = CursorPaginator(self.comments, 4, count='exact')
+        ids = [c.id for c in self.comments]
+        seen = []
+        page = paginator.page()
+        self.assertFalse(page['has_previous'])
+        self.assertEqual(page['count'], 14)
+        while True:
+            seen.extend(c.id for c in page['object_list'])
+            if not page['has_next']:
+                break
+            page = paginator.page(page['next_cursor'])
+        self.assertEqual(seen, ids)
+        # and back again
+        page = paginator.page(page['previous_cursor'])
+        self.assertEqual([c.id for c in page['object_list']], ids[-6:-2])
+        self.assertTrue(page['has_next'])
+        self.assertRaises(InvalidCursor, paginator.page, 'garbage')
+
+    def test_cursor_sortdate(self):
+        comments = self.comments.extra(select={
+                'sortdate': 'CASE WHEN tcc_comment.parent_id is null '
+                ' THEN tcc_comment.submit_date ELSE (SELECT p.submit_date'
+                ' FROM tcc_comment p WHERE p.id = tcc_comment.parent_id) END'}
+                ).order_by('-sortdate', 'path')
+        ids = [c.id for c in comments]
+        paginator = CursorPaginator(comments, 5, count='approx')
+        page = paginator.page()
+        page = paginator.page(page['next_cursor'])
+        self.assertEqual([c.id for c in page['object_list']], ids[5:10])
+        self.assertEqual(page['count'], 14)
+        self.assertFalse(page['count_is_approximate'])
+
+    def test_cursor_nulls(self):
+        # older rows without thread_activity
+        Comment.unfiltered.filter(id__in=[
+                c.id for c in self.comments][::3]).update(thread_activity=None)
+        for ordering in (('-thread_activity', 'path'),
+                         ('thread_activity', '-path')):
+            comments = self.comments.order_by(*ordering)
+            ids = [c.id for c in comments]
+            paginator = CursorPaginator(comments, 4)
+            seen = []
+            page = paginator.page()
+            while True:
+                seen.extend(c.id for c in page['object_list'])
+                if not page['has_next']:
+                    break
+                page = paginator.page(page['next_cursor'])
+            self.assertEqual(seen, ids)
+            page = paginator.page(page['previous_cursor'])
+            self.assertEqual([c.id for c in page['object_list']], ids[-6:-2])
+
+    def test_threads(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        for _ in range(settings.REPLY_LIMIT + 1):
+            api.post_reply(user_id=pk, comment="Reply",
+                           parent_id=self.roots[4].id)
+        paginator = api.ThreadPaginator(ct.id, pk, per_page=3)
+        self.assertEqual(paginator.count, 7)
+        self.assertEqual(paginator.num_pages, 3)
+        page = paginator.page(1)
+        # the thread with the newest reply comes first
+        roots = [c.id for c in page.object_list if not c.parent_id]
+        self.assertEqual(roots, [self.roots[4].id, self.roots[6].id,
+                                 self.roots[5].id])
+        # every reply follows its root, busy threads are limited
+        self.assertEqual(len(page.object_list), 3 + 2 + settings.REPLY_LIMIT)
+        self.assertEqual(page.object_list[0].parent_id, None)
+        page = paginator.page(3)
+        self.assertEqual([c.id for c in page.object_list if not c.parent_id],
+                         [self.roots[0].id])
+        # both implementations agree
+        roots = list(Comment.objects.filter(parent__isnull=True).order_by(
+                '-path').values_list('path', flat=True)[:4])
+        self.assertEqual([c.id for c in api._get_threads_window(roots, settings.REPLY_LIMIT)],
+                         [c.id for c in api._get_threads_limited(roots)])
+        self.assertNumQueries(1, api._get_threads_limited, roots)
+
+    def test_thread_activity(self):
+        root = self.roots[2]
+        reply = api.post_reply(user_id=self.user1.pk, comment="Reply",
+                               parent_id=root.id)
+        # kept on the root only
+        activity = list(root.get_thread().values_list(
+                'thread_activity', flat=True))
+        self.assertEqual(activity[0], reply.submit_date)
+        self.assertEqual(set(activity[1:]), set([None]))
+        # removing the reply moves the thread back
+        api.remove_comment(reply.id, self.user1)
+        self.assertTrue(Comment.unfiltered.get(id=root.id).thread_activity
+                        < reply.submit_date)
+        Comment.unfiltered.update(thread_activity=reply.submit_date)
+        # every row: the roots are set, the replies are cleared
+        self.assertEqual(api.repair_activity(), Comment.unfiltered.count())
+        self.assertEqual(Comment.unfiltered.filter(
+                thread_activity__isnull=True).count(),
+                         Comment.unfiltered.filter(depth__gt=0).count())
+        self.assertEqual(api.repair_activity(), 0)
+        if connection.vendor == 'sqlite':
+            # sql/comment.sqlite3.sql was run by syncdb
+            cursor = connection.cursor()
+            cursor.execute("SELECT name FROM sqlite_master "
+                           "WHERE type = 'index' AND tbl_name = 'tcc_comment'")
+            self.assertTrue(
+                ('tcc_comment_thread_activity',) in cursor.fetchall())
+
+
+    def test_autopaginate(self):
+        from tcc.templatetags.paginator import AutopaginateExtension
+        from jinja2 import Environment
+        ext = AutopaginateExtension(Environment())
+        request = RequestFactory().get('/', {'foo': 'bar'})
+        pages = ext._render_pages(self.comments, request, cursor=True,
+                                  per_page=10, prefix='c')
+        self.assertEqual(len(pages['object_list']), 10)
+        self.assertTrue(pages['is_paginated'])
+        self.assertEqual(pages['getvars'], '&foo=bar')
+        request = RequestFactory().get('/', {'ccursor': pages['next_cursor']})
+        pages = ext._render_pages(self.comments, request, cursor=True,
+                                  per_page=10, prefix='c')
+        self.assertEqual(len(pages['object_list']), 4)
+        self.assertFalse(pages['has_next'])
+
+
+class Cache(TestCase):
+    usernames = ['user1', 'user2']
+
+    def setUp(self):
+        for name in self.usernames:
+            u = User.objects.create(username=name, password=name)
+            setattr(self, name, u)
+        self.orgcache = cache.cache
+        cache.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+
+    def tearDown(self):
+        cache.cache.clear()
+        cache.cache = self.orgcache
+        for name in self.usernames:
+            User.objects.get(username=name).delete()
+
+    def test_versions(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        renders = []
+
+        def render():
+            renders.append(1)
+            return u"<li>%d</li>" % len(renders)
+
+        objkey = cache.object_version_key(ct.id, pk)
+        rootkey = cache.root_version_key(p.id)
+        self.assertEqual(cache.cached_fragment('index', objkey, render), u"<li>1</li>")
+        self.assertEqual(cache.cached_fragment('index', objkey, render), u"<li>1</li>")
+        self.assertEqual(cache.cached_fragment('thread', rootkey, render), u"<li>2</li>")
+        self.assertEqual(cache.cached_fragment('index', objkey, render, vary='cpage=2'), u"<li>3</li>")
+        # a reply invalidates both the object and the thread
+        api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        self.assertEqual(cache.cached_fragment('index', objkey, render), u"<li>4</li>")
+        self.assertEqual(cache.cached_fragment('thread', rootkey, render), u"<li>5</li>")
+        self.assertEqual(cache.cached_fragment('thread', rootkey, render), u"<li>5</li>")
+        api.close_comment(p.id, self.user1)
+        self.assertEqual(cache.cached_fragment('thread', rootkey, render), u"<li>6</li>")
+        Comment.unfiltered.get(id=p.id).delete()
+        self.assertEqual(cache.cached_fragment('index', objkey, render), u"<li>7</li>")
+
+
+class Pipeline(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1', password='user1')
+        self.saved = pipeline.DEFERRED, pipeline._executor
+        pipeline.DEFERRED = True
+        pipeline._executor = pipeline.SyncExecutor()
+
+    def tearDown(self):
+        pipeline.discard()
+        pipeline.DEFERRED, pipeline._executor = self.saved
+
+    def test_coalescing(self):
+        calls = []
+        for _ in range(3):
+            pipeline.defer(('key', 1), calls.append, 1)
+        pipeline.defer(('key', 2), calls.append, 2)
+        # TestCase runs in a managed transaction: nothing runs until flush
+        self.assertEqual(calls, [])
+        pipeline.flush()
+        self.assertEqual(calls, [1, 2])
+        pipeline.defer(('key', 1), calls.append, 1)
+        pipeline.discard()
+        pipeline.flush()
+        self.assertEqual(calls, [1, 2])
+
+    def test_unflushed(self):
+        calls = []
+        with transaction.commit_on_success():
+            pipeline.defer(('key', 1), calls.append, 1)
+        # never flushed here: another thread's write still gets it done
+        thread = threading.Thread(target=pipeline.defer,
+                                  args=(('key', 1), calls.append, 2))
+        thread.start()
+        thread.join()
+        self.assertEqual(calls, [2])
+        self.assertEqual(pipeline._pending, set())
+        pipeline.flush()
+        self.assertEqual(calls, [2, 1])
+
+    def test_moderation_burst(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        replies = [api.post_reply(user_id=pk, comment="Reply",
+                                  parent_id=p.id) for _ in range(3)]
+        del pipeline._queue()[:]
+        # closing a reply recounts nothing
+        api.close_comment(replies[0].id, self.user1)
+        self.assertEqual(pipeline._queue(), [])
+        for r in replies:
+            api.remove_comment(r.id, self.user1)
+        # one recount of the parent, the thread and the object
+        self.assertEqual(sorted(key[0] for key, func, args in
+                                pipeline._queue()),
+                         ['activity', 'counters', 'thread'])
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 3)
+        pipeline.flush()
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 0)
+
+    def test_reply_past_limit(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        replies = [api.post_reply(user_id=pk, comment="Reply",
+                                  parent_id=p.id)
+                   for _ in range(settings.REPLY_LIMIT)]
+        pipeline.flush()
+        p = Comment.unfiltered.get(id=p.id)
+        before = dict((row[0], row) for row in
+                      Comment.unfiltered.values_list())
+        reply = Comment(content_type_id=ct.id, object_pk=pk, user_id=pk,
+                        parent=p, comment="Reply")
+        # the parent's counters, the thread's activity, the INSERT (and
+        # reserving its id or setting its path) and the object's
+        # counters; no reply is read
+        self.assertNumQueries(5, reply.save)
+        # the limit moves with the recount
+        self.assertEqual([key for key, func, args in pipeline._queue()],
+                         [('counters', p.id)])
+        pipeline.flush()
+        # the limit moved, but the other replies were not written
+        changed = [row[0] for row in Comment.unfiltered.exclude(
+                id=reply.id).values_list() if row != before[row[0]]]
+        self.assertEqual(changed, [p.id])
+        self.assertEqual(Comment.unfiltered.get(id=p.id).limit,
+                         replies[1].submit_date)
+
+    def test_thread_pool(self):
+        executor = pipeline.ThreadPoolExecutor(workers=2)
+        calls = []
+        for i in range(10):
+            executor.submit(calls.append, i)
+        executor.join()
+        self.assertEqual(sorted(calls), range(10))
+
+
+class Instrument(QueryBudgetMixin, TestCase):
+    usernames = ['user1', 'user2', 'user3']
+
+    def setUp(self):
+        for name in self.usernames:
+            u = User.objects.create(username=name, password=name)
+            setattr(self, name, u)
+        self.ct = ContentType.objects.get_for_model(self.user1)
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user1
+
+    def add_threads(self, n):
+        users = [getattr(self, name) for name in self.usernames]
+        for i in range(n):
+            root = api.post_comment(content_type_id=self.ct.id,
+                                    object_pk=self.user1.pk,
+                                    user_id=users[i % 3].pk,
+                                    comment="Root message")
+            for user in users:
+                api.post_reply(user_id=user.pk, comment="Reply",
+                               parent_id=root.id)
+        return root
+
+    def test_records(self):
+        root = self.add_threads(1)
+        with instrument.collect() as collector:
+            views.thread(self.request, root.id)
+        get_comment, = collector.get('api.get_comment')
+        thread, = collector.get('views.thread')
+        self.assertEqual(get_comment['queries'], 1)
+        self.assertEqual(get_comment['rows'], 1)
+        # nested operations count for the outer one too
+        self.assertTrue(thread['queries'] > get_comment['queries'])
+        self.assertTrue(thread['rows'] >= 4)
+        self.assertTrue(thread['render_time'] > 0)
+        self.assertTrue(thread['time'] >= thread['render_time'])
+        # no sink, no records
+        self.assertTrue(instrument.get_sink() is None)
+        with instrument.operation('test') as record:
+            self.assertTrue(record is None)
+
+    def test_budgets(self):
+        # the same number of queries for 2 and 5 threads
+        for n in (2, 3):
+            root = self.add_threads(n)
+            # the count, the paths of the page's roots, the page and its
+            # users
+            self.assertQueryBudget('views.index', 5, views.index,
+                                   self.request, self.ct.id, self.user1.pk)
+            self.assertQueryBudget('views.thread', 4, views.thread,
+                                   self.request, root.id)
+            self.assertQueryBudget('views.replies', 2, views.replies,
+                                   self.request, root.id)
+            self.assertQueryBudget('api.make_tree', 1, api.make_tree,
+                                   api.get_comments(self.ct.id, self.user1.pk))
+        self.assertRaises(AssertionError, self.assertQueryBudget,
+                          'views.index', 1, views.index, self.request,
+                          self.ct.id, self.user1.pk)
+
+    def test_statsd(self):
+        import socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        sink = instrument.StatsdSink('127.0.0.1', listener.getsockname()[1])
+        sink.emit({'operation': 'views.index', 'queries': 3, 'rows': 10,
+                   'db_time': 0.002, 'render_time': 0.01, 'time': 0.015})
+        lines = listener.recv(4096).split('\n')
+        listener.close()
+        self.assertTrue('tcc.views.index.calls:1|c' in lines)
+        self.assertTrue('tcc.views.index.queries:3|c' in lines)
+        self.assertTrue('tcc.views.index.time:15.000|ms' in lines)
+
+
+class Paths(TestCase):
+    usernames = ['user1']
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user1)
+        self.codec = paths.codec
+
+    def tearDown(self):
+        paths.codec = self.codec
+
+    def test_codecs(self):
+        fixed = paths.FixedCodec(steplen=6)
+        varlen = paths.VarlenCodec()
+        self.assertEqual(varlen.encode(5), '15')
+        self.assertEqual(varlen.encode(50000), '412kw')
+        ids = [1, 9, 35, 36, 1295, 1296, 50000, 2 ** 40]
+        segments = [varlen.encode(i) for i in ids]
+        self.assertEqual(sorted(segments), segments)
+        for codec in (fixed, varlen):
+            path = ''.join(codec.encode(i) for i in (36, 1296, 7))
+            self.assertEqual(codec.ids(path), [36, 1296, 7])
+            self.assertEqual(codec.depth(path), 2)
+            self.assertEqual(codec.root(path), codec.encode(36))
+            self.assertEqual(codec.prefixes(path), [
+                    codec.encode(36), codec.encode(36) + codec.encode(1296)])
+            self.assertTrue(codec.matches(path, 7))
+            self.assertFalse(codec.matches(path, 8))
+        self.assertFalse(fixed.matches(varlen.join('', 7), 7))
+        self.assertFalse(varlen.matches(fixed.join('', 7), 7))
+        self.assertRaises(ValueError, fixed.encode, 36 ** 6)
+        self.assertRaises(ValueError, paths.get_codec, 'binary')
+
+    def test_prefix_sql(self):
+        cursor = connection.cursor()
+        for codec in (paths.FixedCodec(steplen=6), paths.VarlenCodec()):
+            path = codec.join(codec.join('', 1296), 5)
+            sql = "SELECT %s, %s" % (codec.prefix_sql('%s', 1),
+                                     codec.prefix_sql('%s', 2))
+            cursor.execute(sql, [path] * sql.count('%s'))
+            self.assertEqual(list(cursor.fetchone()),
+                             [codec.root(path), path])
+
+    def post(self):
+        pk = self.user1.pk
+        roots = [api.post_comment(content_type_id=self.ct.id, object_pk=pk,
+                                  user_id=pk, comment="Root message")
+                 for _ in range(2)]
+        replies = [api.post_reply(user_id=pk, comment="Reply",
+                                  parent_id=roots[0].id) for _ in range(2)]
+        return roots, replies
+
+    def test_varlen(self):
+        paths.codec = paths.VarlenCodec()
+        (p, other), (r1, r2) = self.post()
+        self.assertEqual(r1.path, p.path + paths.codec.encode(r1.id))
+        self.assertEqual(r1.get_root_id(), p.id)
+        self.assertEqual(r1.depth, 1)
+        self.assertEqual(list(p.get_thread()), [p, r1, r2])
+        self.assertEqual(list(p.get_replies()), [r1, r2])
+        self.assertEqual(list(r2.get_parents()), [p])
+        page = api.ThreadPaginator(self.ct.id, self.user1.pk).page(1)
+        self.assertEqual(page.object_list, [p, r1, r2, other])
+        api.remove_comment(p.id, self.user1)
+        self.assertFalse(Comment.unfiltered.get(id=r1.id).is_visible)
+        Comment.unfiltered.update(thread_activity=None)
+        # the two roots
+        self.assertEqual(api.repair_activity(), 2)
+        self.assertEqual(Comment.unfiltered.get(id=p.id).thread_activity,
+                         p.submit_date)
+
+    def test_convert(self):
+        source = paths.codec = paths.FixedCodec(steplen=6)
+        (p, other), (r1, r2) = self.post()
+        fixed = dict(Comment.unfiltered.values_list('id', 'path'))
+        varlen = paths.VarlenCodec()
+        paths.codec = varlen
+        self.assertEqual(api.convert_paths(source, chunk_size=3), 4)
+        self.assertEqual(dict(Comment.unfiltered.values_list('id', 'path')),
+                         dict((i, varlen.convert(path, source))
+                              for i, path in fixed.items()))
+        p = Comment.objects.get(id=p.id)
+        self.assertEqual(list(p.get_thread()), [p, r1, r2])
+        # done already
+        self.assertEqual(api.convert_paths(source), 0)
+        paths.codec = source
+        api.convert_paths(varlen)
+        self.assertEqual(dict(Comment.unfiltered.values_list('id', 'path')),
+                         fixed)
+
+    def test_convert_clash(self):
+        # with 2 digit steps, the old path of 41 ('15') is the new path
+        # of 5
+        short = paths.FixedCodec(steplen=2)
+        (a, b), replies = self.post()
+        Comment.unfiltered.filter(parent__isnull=False).delete()
+        Comment.unfiltered.filter(id=a.id).update(id=5, path='05')
+        Comment.unfiltered.filter(id=b.id).update(id=41, path='15')
+        paths.codec = paths.VarlenCodec()
+        self.assertEqual(api.convert_paths(short, chunk_size=1), 2)
+        self.assertEqual(dict(Comment.unfiltered.values_list('id', 'path')),
+                         {5: '15', 41: '215'})
+
+
+class Repair(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user1)
+        self.codec = paths.codec
+        pk = self.user1.pk
+        self.p, self.other = [
+            api.post_comment(content_type_id=self.ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+            for _ in range(2)]
+        self.replies = [api.post_reply(user_id=pk, comment="Reply",
+                                       parent_id=self.p.id)
+                        for _ in range(settings.REPLY_LIMIT + 1)]
+
+    def tearDown(self):
+        paths.codec = self.codec
+        paths.next_codec = None
+
+    def repair(self, **kwargs):
+        return repair.repair_object(self.ct.id, unicode(self.user1.pk),
+                                   api.SITE_ID, **kwargs)
+
+    def test_repair(self):
+        stored = dict((c.id, (c.path, c.depth, c.childcount, c.limit))
+                      for c in Comment.unfiltered.all())
+        r1 = self.replies[0]
+        Comment.unfiltered.filter(id=self.p.id).update(childcount=0,
+                                                       limit=None)
+        # below the wrong root, with the wrong depth
+        Comment.unfiltered.filter(id=r1.id).update(
+            path=self.other.path + paths.codec.encode(r1.id), depth=5)
+        broken = dict((c.id, (c.path, c.depth, c.childcount, c.limit))
+                      for c in Comment.unfiltered.all())
+        stats = self.repair(dry_run=True)
+        self.assertEqual(stats, {'comments': 6, 'unresolved': 0, 'path': 1,
+                                 'depth': 1, 'childcount': 1, 'limit': 1})
+        self.assertEqual(dict((c.id, (c.path, c.depth, c.childcount,
+                                      c.limit))
+                              for c in Comment.unfiltered.all()), broken)
+        # a parent missing a reply may be written twice in small batches
+        self.assertEqual(self.repair(batch_size=1)['path'], 1)
+        self.assertEqual(dict((c.id, (c.path, c.depth, c.childcount,
+                                      c.limit))
+                              for c in Comment.unfiltered.all()), stored)
+        self.assertEqual(self.repair()['childcount'], 0)
+
+    def test_repath(self):
+        target = paths.FixedCodec(steplen=8)
+        stats = self.repair(target=target)
+        self.assertEqual(stats['path'], 6)
+        self.assertEqual(stats['depth'], 0)
+        paths.codec = target
+        p = Comment.objects.get(id=self.p.id)
+        self.assertEqual(p.path, self.p.get_base36().zfill(8))
+        self.assertEqual(list(p.get_thread()), [p] + self.replies)
+        self.assertEqual(self.repair()['path'], 0)
+
+    def test_next_path(self):
+        paths.next_codec = target = paths.FixedCodec(steplen=8)
+        pk = self.user1.pk
+        r = api.post_reply(user_id=pk, comment="Reply", parent_id=self.p.id)
+        r = Comment.unfiltered.get(id=r.id)
+        self.assertEqual(r.next_path, target.convert(r.path, self.codec))
+        # written before the re-path started
+        Comment.unfiltered.update(next_path=None)
+        stats = self.repair(batch_size=2)
+        self.assertEqual(stats['next_path'], settings.REPLY_LIMIT + 4)
+        self.assertEqual(stats['path'], 0)
+        for path, next_path in Comment.unfiltered.values_list('path',
+                                                              'next_path'):
+            self.assertEqual(next_path, target.convert(path, self.codec))
+        self.assertEqual(self.repair()['next_path'], 0)
+
+    def test_command(self):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        Comment.unfiltered.filter(id=self.p.id).update(childcount=0)
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            out = StringIO()
+            call_command('tcc_repair', dry_run=True, stdout=out)
+            self.assertTrue('childcount: 1' in out.getvalue())
+            self.assertEqual(Comment.unfiltered.get(id=self.p.id).childcount,
+                             0)
+            call_command('tcc_repair', checkpoint=checkpoint,
+                         stdout=StringIO())
+            self.assertEqual(Comment.unfiltered.get(id=self.p.id).childcount,
+                             settings.REPLY_LIMIT + 1)
+            # done already
+            Comment.unfiltered.filter(id=self.p.id).update(childcount=0)
+            out = StringIO()
+            call_command('tcc_repair', checkpoint=checkpoint, stdout=out)
+            self.assertEqual(out.getvalue().strip(), '')
+        finally:
+            os.remove(checkpoint)
+
+
+class Commit(TransactionTestCase):
+    """ Raw writes outside a managed transaction are committed """
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user1)
+
+    def reconnect(self):
+        # what closing the connection does to an open transaction
+        # (closing an in-memory SQLite database is ignored)
+        connection._rollback()
+        connection.close()
+
+    def test_counters(self):
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=self.ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        r = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        api.remove_comment(r.id, self.user1)
+        self.reconnect()
+        p = Comment.unfiltered.get(id=p.id)
+        self.assertEqual((p.childcount, p.limit), (0, None))
+
+    def test_thread_counts(self):
+        pk = self.user1.pk
+        api.post_comment(content_type_id=self.ct.id, object_pk=pk,
+                         user_id=pk, comment="Root message")
+        Thread.objects.all().delete()
+        # created outside a managed transaction, e.g. by tcc_repair
+        Thread.update_counts(self.ct.id, pk)
+        self.reconnect()
+        self.assertEqual(Thread.objects.get(object_pk=pk).comment_count, 1)
+
+    def test_bulk_post_comments(self):
+        pk = self.user1.pk
+        api.bulk_post_comments([
+                {'key': 1, 'content_type_id': self.ct.id, 'object_pk': pk,
+                 'user_id': pk, 'comment': "Imported root"},
+                {'parent_key': 1, 'content_type_id': self.ct.id,
+                 'object_pk': pk, 'user_id': pk, 'comment': "Reply"}])
+        self.reconnect()
+        self.assertEqual(Comment.unfiltered.get(parent=None).childcount, 1)
+        thread = api.get_comment_counts([self.user1])[self.user1]
+        self.assertEqual(thread.comment_count, 2)
+
+    def test_repair(self):
+        pk = self.user1.pk
+        p = api.post_comment(content_type_id=self.ct.id, object_pk=pk,
+                             user_id=pk, comment="Root message")
+        r = api.post_reply(user_id=pk, comment="Reply", parent_id=p.id)
+        Comment.unfiltered.filter(id=r.id).update(is_visible=False)
+        Comment.unfiltered.filter(id=p.id).update(childcount=5)
+        api.repair_visibility()
+        api.repair_counters()
+        self.reconnect()
+        self.assertTrue(Comment.unfiltered.get(id=r.id).is_visible)
+        self.assertEqual(Comment.unfiltered.get(id=p.id).childcount, 1)
+
+
+class QueryPlan(TransactionTestCase):
+    """ ANALYZE commits, hence no TestCase """
+
+    def test_path_index(self):
+        if connection.vendor != 'sqlite':
+            return
+        user1 = User.objects.create(username='user1', password='user1')
+        ct = ContentType.objects.get_for_model(user1)
+        for _ in range(5):
+            p = api.post_comment(content_type_id=ct.id, object_pk=user1.pk,
+                                 user_id=user1.pk, comment="Root message")
+            api.post_reply(user_id=user1.pk, comment="Reply", parent_id=p.id)
+        # with statistics, as on any live database
+        cursor = connection.cursor()
+        cursor.execute("ANALYZE")
+        for qs in (p.get_thread(), p.get_replies(levels=1)):
+            sql, params = qs.query.sql_with_params()
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(row[-1] for row in cursor.fetchall())
+            self.assertTrue("(path>? AND path<?)" in plan, plan)
+            self.assertFalse("TEMP B-TREE" in plan, plan)
+
+    def test_path_encodings(self):
+        user1 = User.objects.create(username='user1', password='user1')
+        ct = ContentType.objects.get_for_model(user1)
+        codec = paths.codec
+        results = benchmarks.path_encodings(ct.id, user1.pk, user1, size=40,
+                                            repeat=1)
+        self.assertTrue(paths.codec is codec)
+        self.assertEqual(Comment.unfiltered.count(), 0)
+        self.assertTrue(results['varlen']['path_bytes'] <
+                        results['fixed']['path_bytes'])
+        for result in results.values():
+            self.assertTrue('get_thread' in result)
@@ -0,0 +1,57 @@
+""" A compact, streaming alternative to api.make_tree
+
+make_tree hangs a replies list on every (full) Comment instance and
+needs the entire thread in memory. Here comments are read as slotted
+CommentRow objects holding only what is rendered, and iter_tree turns a
+stream of them (in path order) into open/node/close events, keeping
+nothing but the stack of currently open reply lists (at most MAX_DEPTH).
+
+    for event, node in iter_tree(iter_nodes(comments)):
+        if event == OPEN:
+            ... <ul class="replies"> (replies of node follow)
+        elif event == NODE:
+            ... <li>node
+        else: # CLOSE
+            ... </ul> (end of the replies of node)
+"""
+from tcc.models import CommentRow
+
+OPEN = 'open'
+NODE = 'node'
+CLOSE = 'close'
+
+
+def iter_nodes(comments):
+    """ Streams a Comment queryset as CommentRow objects
+
+    The rows are not cached by the queryset.
+    """
+    for values in comments.values_list(*CommentRow.FIELDS).iterator():
+        yield CommentRow(*values)
+
+
+def iter_tree(nodes):
+    """ Yields (event, node) for nodes in path order
+
+    (NODE, n)  a comment
+    (OPEN, n)  the replies of n (the previous NODE) start
+    (CLOSE, n) the replies of n end
+
+    Depths are compared between nodes, so the stream may start at any
+    depth (e.g. the replies of a comment); a node deeper than its
+    predecessor is a reply to it, even if levels in between were filtered
+    out, and a node closes every open node at least as deep.
+    """
+    stack = []
+    prev = None
+    for node in nodes:
+        if prev is not None and node.depth > prev.depth:
+            stack.append(prev)
+            yield OPEN, prev
+        else:
+            while stack and node.depth <= stack[-1].depth:
+                yield CLOSE, stack.pop()
+        yield NODE, node
+        prev = node
+    while stack:
+        yield CLOSE, stack.pop()
@@ -6,6 +6,7 @@ urlpatterns = patterns(
     url(r'^(?P<content_type_id>\d+)/(?P<object_pk>\d+)/$', 'index',
         name='tcc_index'),
     url(r'^replies/(?P<parent_id>\d+)/$', 'replies', name='tcc_replies'),
+    url(r'^replies/$', 'replies_for', name='tcc_replies_for'),
     url(r'^thread/(?P<thread_id>\d+)/$', 'thread', name='tcc_thread'),
     url(r'^post/$', 'post', name='tcc_post'),
     url(r'^remove/(?P<comment_id>\d+)/$', 'remove', name='tcc_remove'),
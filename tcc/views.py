@@ -1,22 +1,27 @@
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.http import (HttpResponseBadRequest, HttpResponseRedirect,
                          HttpResponse, Http404)
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from django.template import RequestContext
 from django.utils import simplejson
 from django.utils.translation import ugettext as _
 from django.views.decorators.http import require_POST
 
 from tcc import api
-from tcc.settings import CONTENT_TYPES
+from tcc import cache
+from tcc.instrument import instrumented, rendering
+from tcc.settings import TARGET_CHECK, get_content_types
 from tcc.forms import CommentForm
 
 # jinja
 from coffin.shortcuts import render_to_response
+from coffin.template import dict_from_django_context
+from coffin.template.loader import render_to_string
 '''Monkeypatch Django to mimic Jinja2 behaviour'''
 from django.utils import safestring
 if not hasattr(safestring, '__html__'):
@@ -29,52 +34,111 @@ def _get_tcc_index(comment):
                    args=[comment.content_type_id, comment.object_pk])
 
 
+def _get_target(ct, object_pk):
+    """ The commented object, as far as TCC_TARGET_CHECK needs it """
+    try:
+        if TARGET_CHECK == 'load':
+            return ct.get_object_for_this_type(pk=object_pk)
+        if TARGET_CHECK == 'exists' and not ct.model_class()._default_manager.\
+                filter(pk=object_pk).exists():
+            raise Http404()
+    except (ObjectDoesNotExist, ValueError):
+        raise Http404()
+    return None
+
+
 def _get_comment_form(content_type_id, object_pk, data=None):
-    if not content_type_id or int(content_type_id) not in CONTENT_TYPES:
+    if not content_type_id or int(content_type_id) not in get_content_types():
         raise Http404()
-    ct = get_object_or_404(ContentType, pk=content_type_id)
     try:
-        target = ct.get_object_for_this_type(pk=object_pk)
-    except ObjectDoesNotExist:
+        # cached, unlike a query on ContentType
+        ct = ContentType.objects.get_for_id(int(content_type_id))
+    except ContentType.DoesNotExist:
         raise Http404()
+    target = _get_target(ct, object_pk)
     initial = {'content_type': ct.id, 'object_pk': object_pk}
     form = CommentForm(target, data, initial=initial)
     return form
 
 
+def _render_comments(name, version_key, context, vary=''):
+    """ Renders the (user independent) list of comments, cached """
+    with rendering():
+        return cache.cached_fragment(
+            name, version_key,
+            lambda: render_to_string('tcc/comment-list.html',
+                                     context_instance=context),
+            vary=vary)
+
+
+@instrumented('views.index')
 def index(request, content_type_id, object_pk):
-    comments = api.get_comments_limited(
-        content_type_id, object_pk
-        ).extra(select={
-            'sortdate': 'CASE WHEN tcc_comment.parent_id is null ' \
-                ' THEN tcc_comment.submit_date ELSE T3.submit_date END'}
-                ).order_by('-sortdate', 'path')
+    # paginated by thread; a page is fetched with one query
+    comments = api.ThreadPaginator(content_type_id, object_pk)
     form = _get_comment_form(content_type_id, object_pk)
     context = RequestContext(request, {'comments': comments, 'form': form })
-    return render_to_response('tcc/index.html', context)
+    context['comments_html'] = _render_comments(
+        'index', cache.object_version_key(content_type_id, object_pk),
+        context, vary=request.GET.urlencode())
+    with rendering():
+        return render_to_response('tcc/index.html', context)
 
 
+@instrumented('views.replies')
 def replies(request, parent_id):
     comments = api.get_comment_replies(parent_id)
     context = RequestContext(request, {'comments': comments})
-    return render_to_response('tcc/replies.html', context)
+    with rendering():
+        return render_to_response('tcc/replies.html', context)
 
 
+@instrumented('views.replies_for')
+def replies_for(request):
+    """ The replies of many parents (?id=1&id=2...) as {id: html} """
+    try:
+        parent_ids = [int(i) for i in request.GET.getlist('id')]
+        limit = request.GET.get('limit', None)
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not parent_ids or len(parent_ids) > api.RANGES_PER_QUERY:
+        return HttpResponseBadRequest()
+    html = {}
+    # the context processors run once, not once per parent
+    context = dict_from_django_context(RequestContext(request))
+    for parent_id, comments in api.get_replies_for(
+        parent_ids, limit).items():
+        with rendering():
+            html[parent_id] = render_to_string('tcc/replies.html',
+                                               dict(context,
+                                                    comments=comments))
+    return HttpResponse(simplejson.dumps(html), mimetype="application/json")
+
+
+@instrumented('views.thread')
 def thread(request, thread_id):
     # thead_id here should be the root_id of the thread (even though
     # any comment_id will work) so the entire thread can cached *and*
     # invalidated with one entry
-    comments = api.get_comment_thread(thread_id)
-    if not comments:
+    comment = api.get_comment(thread_id)
+    if not comment:
         raise Http404()
-    rootcomment = comments[0]
-    form = _get_comment_form(rootcomment.content_type_id, rootcomment.object_pk)
+    # one page: a page must not start in the middle of the thread
+    comments = Paginator(comment.get_thread().select_related('user'),
+                         api.MAX_THREAD_SIZE)
+    form = _get_comment_form(comment.content_type_id, comment.object_pk)
     context = RequestContext(request, {'comments': comments, 'form': form})
-    return render_to_response('tcc/index.html', context)
+    context['comments_html'] = _render_comments(
+        'thread', cache.root_version_key(comment.get_root_id()),
+        context, vary=request.GET.urlencode())
+    with rendering():
+        return render_to_response('tcc/index.html', context)
 
 
 @login_required
 @require_POST
+@instrumented('views.post')
 def post(request):
     data = request.POST.copy()
     content_type_id = data.get('content_type', None)
@@ -97,7 +161,8 @@ def post(request):
         if comment:
             if request.is_ajax():
                 context = RequestContext(request, {'c': comment})
-                return render_to_response('tcc/comment.html', context)
+                with rendering():
+                    return render_to_response('tcc/comment.html', context)
             next = form.cleaned_data['next']
             if not next:
                 next = comment.get_absolute_url()
@@ -127,6 +192,7 @@ def unflag(request):
 
 @login_required
 @require_POST
+@instrumented('views.approve')
 def approve(request, comment_id):
     comment = api.approve_comment(comment_id, request.user)
     if comment:
@@ -136,6 +202,7 @@ def approve(request, comment_id):
 
 @login_required
 @require_POST
+@instrumented('views.disapprove')
 def disapprove(request, comment_id):
     comment = api.disapprove_comment(comment_id, request.user)
     if comment:
@@ -146,6 +213,7 @@ def disapprove(request, comment_id):
 
 @login_required
 @require_POST
+@instrumented('views.remove')
 def remove(request, comment_id):
     comment = api.remove_comment(comment_id, request.user)
     if comment:
@@ -158,6 +226,7 @@ def remove(request, comment_id):
 
 @login_required
 @require_POST
+@instrumented('views.restore')
 def restore(request, comment_id):
     comment = api.restore_comment(comment_id, request.user)
     if comment: